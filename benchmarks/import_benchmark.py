@@ -0,0 +1,108 @@
+"""
+Benchmark of cold import time, with `python -X importtime` in a fresh interpreter per module.
+Reports the cumulative import time of each module, the slowest modules it pulls in, and whether it loaded any
+module it must not (the visualisation stack for parsing). The top-level imports of the app (main.py, streamlit
+aside) are checked the same way. Exits with 1 if a module is over its budget or loads a forbidden module, so it can
+guard the cold start in CI.
+
+Usage (from the repository root):
+    python -m benchmarks.import_benchmark [--repeat 5] [--scale 1.0]
+"""
+import argparse
+import ast
+import subprocess
+import sys
+
+# module -> (budget in ms, modules it must not import)
+IMPORT_BUDGETS = {
+    "utils.parse_utils": (60, ("networkx", "pyvis", "streamlit", "numpy", "pandas")),
+    "utils.cache_utils": (60, ("networkx", "pyvis", "streamlit", "numpy", "pandas")),
+    "utils.worker_utils": (80, ("networkx", "pyvis", "streamlit", "numpy", "pandas")),
+    "utils.network_utils": (60, ("networkx", "pyvis", "streamlit")),
+    "utils.graph_utils": (250, ("networkx", "pyvis", "streamlit")),
+    "utils.hotspot_utils": (250, ("networkx", "pyvis", "streamlit")),
+    "utils.deck_utils": (250, ("networkx", "pyvis", "streamlit", "pydeck")),
+    "utils.layout_utils": (250, ("networkx", "pyvis", "streamlit")),
+    "utils.metrics_utils": (20, ("networkx", "pyvis", "streamlit", "numpy", "pandas")),
+}
+
+# App script -> (budget in ms for its top-level imports, modules they must not import)
+APP_BUDGETS = {
+    "main.py": (150, ("networkx", "pyvis", "numpy", "pandas")),
+}
+
+
+def app_imports(script):
+    """
+    :return: str, the module-level import statements of a script except streamlit, which is profiled on its own
+    """
+    with open(script, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    statements = [
+        ast.unparse(node) for node in tree.body
+        if isinstance(node, (ast.Import, ast.ImportFrom))
+        and not any(name.startswith("streamlit") for name in (
+            [alias.name for alias in node.names] if isinstance(node, ast.Import) else [node.module or ""]))
+    ]
+    return "; ".join(statements)
+
+
+def import_profile(module, statements=None):
+    """
+    Imports `module` in a fresh interpreter with -X importtime.
+    :param statements: import statements to run instead of `import module`, e.g. app_imports(script). The time is
+                       then the wall time of running them
+    :return: (total import time of the module in ms, {module: cumulative ms}, set of loaded top-level packages)
+    :raises ImportError: if the module can't be imported, e.g. a missing dependency
+    """
+    code = (f"import sys, time; _start = time.perf_counter(); {statements or f'import {module}'}; "
+            "print((time.perf_counter() - _start) * 1000); "
+            "print(' '.join(sorted({m.split('.')[0] for m in sys.modules})))")
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise ImportError(result.stderr.strip().splitlines()[-1])
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        # "import time:   self [us] | cumulative | imported package"
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumul, name = line[len("import time:"):].split("|")
+        cumulative[name.strip()] = int(cumul) / 1000
+    elapsed, loaded = result.stdout.splitlines()[-2:]
+    total = cumulative.get(module, 0.0) if statements is None else float(elapsed)
+    return total, cumulative, set(loaded.split())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="best of this many cold imports")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply every budget, e.g. for slow CI machines")
+    parser.add_argument("--top", type=int, default=3, help="slowest imported modules to show")
+    args = parser.parse_args()
+
+    failed = False
+    print(f"{'module':<22} {'ms':>7} {'budget':>7}  slowest imports / forbidden")
+    checks = [(module, budget, forbidden, None) for module, (budget, forbidden) in IMPORT_BUDGETS.items()]
+    checks += [(script, budget, forbidden, app_imports(script)) for script, (budget, forbidden) in APP_BUDGETS.items()]
+    for module, budget, forbidden, statements in checks:
+        try:
+            profiles = [import_profile(module, statements) for _ in range(args.repeat)]
+        except ImportError as e:
+            failed = True
+            print(f"{module:<22} {'-':>7} {budget * args.scale:>7.0f}  FAIL {e}")
+            continue
+        total, cumulative, loaded = min(profiles, key=lambda p: p[0])
+        budget *= args.scale
+        bad = sorted(loaded.intersection(forbidden))
+        slowest = sorted(((ms, name) for name, ms in cumulative.items() if name != module and "." not in name),
+                         reverse=True)[:args.top]
+        ok = total <= budget and not bad
+        failed |= not ok
+        details = f"FORBIDDEN: {', '.join(bad)}" if bad else ", ".join(f"{name} {ms:.0f}" for ms, name in slowest)
+        print(f"{module:<22} {total:>7.1f} {budget:>7.0f}  {'' if ok else 'FAIL '}{details}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Benchmark of force-directed layout on graphs of many components: one spring_layout over the whole graph vs.
+component_layout (per component, in parallel, packed into a grid), cold and with its component cache warm.
+Also times the largest component alone, the lower bound of component_layout.
+
+Usage (from the repository root):
+    python -m benchmarks.layout_benchmark --largest 500 1500 --components 500
+"""
+import argparse
+import random
+import time
+
+import networkx as nx
+
+from utils.layout_utils import component_layout, LayoutCache, spring_component
+
+
+def random_components(largest, n_components, seed=42):
+    """
+    One component of `largest` nodes, one of half its size, and small components of 1-8 nodes.
+    :return: (nodes, edges, nodes of the largest component, its edges)
+    """
+    rnd = random.Random(seed)
+    nodes, edges = [], set()
+    sizes = [largest, largest // 2] + [rnd.randint(1, 8) for _ in range(n_components)]
+    for c, size in enumerate(sizes):
+        names = [f"LIB_{c}.TABLE_{i}" for i in range(size)]
+        nodes.extend(names)
+        # A random spanning tree keeps the component connected, plus some extra edges
+        for i in range(1, size):
+            edges.add((names[rnd.randrange(i)], names[i]))
+        for _ in range(size // 2):
+            edges.add((rnd.choice(names), rnd.choice(names)))
+    largest_nodes = nodes[:largest]
+    largest_edges = [(u, v) for u, v in edges if u.startswith("LIB_0.")]
+    return nodes, list(edges), largest_nodes, largest_edges
+
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--largest", type=int, nargs="+", default=[300, 1000])
+    parser.add_argument("--components", type=int, default=500, help="number of small components")
+    args = parser.parse_args()
+
+    print(f"{'nodes':>7} {'edges':>7} | {'whole s':>8} | {'cold s':>7} {'warm s':>7} | {'largest s':>9}")
+    for largest in args.largest:
+        nodes, edges, largest_nodes, largest_edges = random_components(largest, args.components)
+
+        def whole():
+            G = nx.DiGraph()
+            G.add_nodes_from(nodes)
+            G.add_edges_from(edges)
+            nx.spring_layout(G, seed=42)
+
+        index = {node: i for i, node in enumerate(largest_nodes)}
+        cache = LayoutCache()
+        t_whole = timed(whole)
+        t_cold = timed(lambda: component_layout(nodes, edges, cache=cache))
+        t_warm = timed(lambda: component_layout(nodes, edges, cache=cache))
+        t_largest = timed(lambda: spring_component(len(largest_nodes), [(index[u], index[v]) for u, v in largest_edges]))
+        print(f"{len(nodes):>7} {len(edges):>7} | {t_whole:>8.2f} | {t_cold:>7.2f} {t_warm:>7.3f} | {t_largest:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Benchmark of the transitive reduction (utils.graph_utils.transitive_reduction) on merge-heavy lineage graphs:
+edges removed, reduction time cold and cached, and html render time of the full vs. the reduced graph.
+
+Usage (from the repository root):
+    python -m benchmarks.reduction_benchmark --nodes 500 1000 2000
+"""
+import argparse
+import time
+
+import numpy as np
+
+from utils.graph_utils import transitive_reduction
+from utils.network_utils import create_pyvis_hierarchical_layout, render_network_html
+
+
+def merge_heavy_lineage(n_nodes, inputs_per_step=4, window=50, seed=42):
+    """
+    Every dataset is built from a few datasets created shortly before it, as chains of MERGE steps are,
+    so most long-range edges are implied by shorter paths.
+    """
+    rng = np.random.default_rng(seed)
+    nodes = [f"LIB_{i % 7}.TABLE_{i}" for i in range(n_nodes)]
+    dst = np.repeat(np.arange(1, n_nodes), inputs_per_step)
+    src = dst - rng.integers(1, window, size=dst.size)
+    keep = src >= 0
+    edges = list(dict.fromkeys((nodes[u], nodes[v]) for u, v in zip(src[keep].tolist(), dst[keep].tolist())))
+    return nodes, edges
+
+
+def render_seconds(nodes, edges):
+    start = time.perf_counter()
+    render_network_html(create_pyvis_hierarchical_layout(nodes, edges), vis_resources="remote")
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nodes", type=int, nargs="+", default=[500, 1000, 2000])
+    args = parser.parse_args()
+
+    print(f"{'nodes':>7} {'edges':>8} {'kept':>8} {'removed':>8} | {'reduce s':>8} {'cached s':>8} | "
+          f"{'render s':>8} {'reduced s':>9} {'saved s':>8}")
+    for n_nodes in args.nodes:
+        nodes, edges = merge_heavy_lineage(n_nodes)
+        start = time.perf_counter()
+        reduced, report = transitive_reduction(nodes, edges)
+        t_reduce = time.perf_counter() - start
+        start = time.perf_counter()
+        transitive_reduction(nodes, edges)
+        t_cached = time.perf_counter() - start
+
+        t_full = render_seconds(nodes, edges)
+        t_reduced = render_seconds(nodes, reduced)
+        print(f"{n_nodes:>7} {report['edges']:>8} {report['kept']:>8} {report['removed']:>8} | "
+              f"{t_reduce:>8.2f} {t_cached:>8.3f} | {t_full:>8.2f} {t_reduced:>9.2f} {t_full - t_reduced:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
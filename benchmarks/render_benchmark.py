@@ -0,0 +1,60 @@
+"""
+Benchmark of network html generation: PyVis template + inject_js_features vs. render_network_html.
+Reports render-prep time and size of the html and of the node/edge payload.
+
+Usage (from the repository root):
+    python -m benchmarks.render_benchmark --nodes 1000 5000 20000
+"""
+import argparse
+import random
+import time
+
+from utils.network_utils import (
+    create_pyvis_force_layout,
+    inject_js_features,
+    get_network_payload,
+    render_network_html,
+)
+
+
+def random_lineage(n_nodes, edges_per_node=1.5, seed=42):
+    rnd = random.Random(seed)
+    nodes = [f"LIB_{i % 7}_TABLE_{i}" for i in range(n_nodes)]
+    edges = list({(rnd.choice(nodes), rnd.choice(nodes)) for _ in range(int(n_nodes * edges_per_node))})
+    return nodes, edges
+
+
+def best_of(func, repeat):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nodes", type=int, nargs="+", default=[500, 2000, 10000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'nodes':>7} {'edges':>7} | {'pyvis ms':>9} {'pyvis KB':>9} | "
+          f"{'payload ms':>10} {'payload KB':>10} {'html ms':>8} {'html KB':>8} {'inline KB':>9}")
+    for n_nodes in args.nodes:
+        nodes, edges = random_lineage(n_nodes)
+        net = create_pyvis_force_layout(nodes, edges)
+
+        t_pyvis, html_pyvis = best_of(lambda: inject_js_features(net), args.repeat)
+        t_payload, payload = best_of(lambda: get_network_payload(net), args.repeat)
+        t_html, html = best_of(lambda: render_network_html(net, payload, vis_resources="remote"), args.repeat)
+        html_inline = render_network_html(net, payload, vis_resources="inline")
+
+        print(f"{n_nodes:>7} {len(edges):>7} | {t_pyvis * 1000:>9.1f} {len(html_pyvis) / 1024:>9.0f} | "
+              f"{t_payload * 1000:>10.1f} {len(payload) / 1024:>10.0f} {t_html * 1000:>8.1f} "
+              f"{len(html) / 1024:>8.0f} {len(html_inline) / 1024:>9.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Load benchmark of the lineage HTTP service (utils/service_utils.py).
+
+Starts a local instance (unless --url is given), then sends concurrent requests:
+parses of distinct scripts, repeated parses of the same script (served from the parse cache),
+and upstream/downstream queries. Reports throughput and latency percentiles per request type.
+
+Usage (from the repository root):
+    python -m benchmarks.service_benchmark --concurrency 32 --requests 2000
+"""
+import sys
+import time
+import json
+import random
+import signal
+import socket
+import asyncio
+import argparse
+import subprocess
+from collections import defaultdict
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+
+
+def random_script(n_runs, seed):
+    rnd = random.Random(seed)
+    return "".join(f"DATA t{rnd.randrange(n_runs)}; SET t{rnd.randrange(n_runs)}; RUN;\n" for _ in range(n_runs))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_until_up(client, url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            await client.fetch(f"{url}/stats")
+            return
+        except Exception:
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"Service at {url} did not start")
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run(args):
+    client = AsyncHTTPClient(max_clients=args.concurrency)
+    url = args.url
+    server = None
+    if url is None:
+        port = free_port()
+        url = f"http://127.0.0.1:{port}"
+        server = subprocess.Popen([sys.executable, "-m", "utils.service_utils", str(port)],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        await wait_until_up(client, url)
+
+        # A hot script, queried and re-posted by most requests
+        hot = random_script(args.runs, seed=0)
+        key = json.loads((await client.fetch(HTTPRequest(f"{url}/parse", "POST", body=hot))).body)["key"]
+
+        kinds = ["parse_new"] * 1 + ["parse_cached"] * 3 + ["upstream"] * 3 + ["downstream"] * 3
+        latencies = defaultdict(list)
+        counter = iter(range(args.requests))
+
+        async def worker():
+            for i in counter:
+                kind = kinds[i % len(kinds)]
+                if kind == "parse_new":
+                    request = HTTPRequest(f"{url}/parse", "POST", body=random_script(args.runs, seed=i + 1),
+                                          request_timeout=300)
+                elif kind == "parse_cached":
+                    request = HTTPRequest(f"{url}/parse", "POST", body=hot)
+                else:
+                    request = HTTPRequest(f"{url}/scripts/{key}/{kind}?dataset=t{i % args.runs}&hops=3")
+                start = time.perf_counter()
+                response = await client.fetch(request, raise_error=False)
+                latencies[kind if response.code < 400 or response.code == 404 else f"{kind} (error)"].append(
+                    time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+
+        total = sum(len(v) for v in latencies.values())
+        print(f"{total} requests in {elapsed:.2f}s ({total / elapsed:.0f} req/s), concurrency {args.concurrency}, "
+              f"{args.runs} runs per script")
+        print(f"{'request':>20} {'count':>6} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8}")
+        for kind, values in sorted(latencies.items()):
+            print(f"{kind:>20} {len(values):>6} {percentile(values, 0.5) * 1000:>8.1f} "
+                  f"{percentile(values, 0.95) * 1000:>8.1f} {max(values) * 1000:>8.1f}")
+    finally:
+        if server is not None:
+            # SIGINT lets the service shut its process pool down
+            server.send_signal(signal.SIGINT)
+            server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="Benchmark a running service instead of starting one")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--runs", type=int, default=2000, help="RUN blocks per generated script")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
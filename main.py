@@ -1,6 +1,17 @@
+import os
+import time
 import streamlit as st
-from utils.parse_utils import StructuredSAS
-from utils.network_utils import *
+from utils.parse_utils import DATASET_CLASSES
+from utils.network_utils import (
+    create_pyvis_force_layout, create_pyvis_hierarchical_layout, create_pyvis_multipartite_layout, render_network_html,
+)
+from utils.worker_utils import ParseJob
+from utils.cache_utils import get_parse_store, script_key
+from utils.schedule_utils import ExecutionPlan
+from utils.streamlit_utils import StLink
+# Modules built on numpy (graph_utils, hotspot_utils, deck_utils) are imported in the sections that use them,
+# so they load on first use and not when the app starts (see benchmarks/import_benchmark.py)
+from utils.metrics_utils import get_metrics, start_metrics_server, start_metrics_dump
 
 ############################################################
 # 1. Set page configuration
@@ -15,19 +26,28 @@ st.set_page_config(layout="wide")
 # We will store certain data in the session state to re-use it across interactions.
 
 # Keys used in session_state:
-# - 'sas_script': store the SAS script text
-# - 'struct_SAS': store the StructuredSAS object
+# - 'script_key': content address of the uploaded SAS script in the shared parse store
+# - 'parse_job': background ParseJob of the currently uploaded script
 # - 'flow_chart': store the generated mermaid markdown
 # - 'show_flow_chart': boolean flag to show/hide flow chart
 # - 'show_network_graph': boolean flag to show/hide network graph
 # - 'show_metadata': boolean flag to show/hide metadata
+# - 'st_link': StLink elements of the graph last shown in the link analysis view
+# - 'search_results': (script key, indices into pre_processed) of the last code search
+# - 'search_page': page of search results shown
+# - 'code_line': first line of the window shown by the code viewer
+# - 'render_seconds': seconds it took to render the network graph html, by render key
+#
+# The SAS script and its StructuredSAS object live in the process-wide parse store (utils/cache_utils.py),
+# shared between sessions. Sessions keep only the key into it.
 
 # Initialize session state variables if they don't exist
-if 'sas_script' not in st.session_state:
-    st.session_state['sas_script'] = None
+if 'script_key' not in st.session_state:
+    st.session_state['script_key'] = None
+    get_metrics().inc("sessions_total")
 
-if 'struct_SAS' not in st.session_state:
-    st.session_state['struct_SAS'] = None
+if 'parse_job' not in st.session_state:
+    st.session_state['parse_job'] = None
 
 if 'flow_chart' not in st.session_state:
     st.session_state['flow_chart'] = None
@@ -41,6 +61,32 @@ if 'show_network_graph' not in st.session_state:
 if 'show_metadata' not in st.session_state:
     st.session_state['show_metadata'] = False
 
+if 'st_link' not in st.session_state:
+    st.session_state['st_link'] = None
+
+if 'search_results' not in st.session_state:
+    st.session_state['search_results'] = None
+
+if 'search_page' not in st.session_state:
+    st.session_state['search_page'] = 1
+
+if 'code_line' not in st.session_state:
+    st.session_state['code_line'] = 1
+
+if 'render_seconds' not in st.session_state:
+    st.session_state['render_seconds'] = {}
+
+# Lines of the code viewer and search results per page. Only the visible page is sent to the browser.
+CODE_PAGE_LINES = int(os.environ.get("SAS2PY_CODE_PAGE_LINES", 200))
+SEARCH_PAGE_SIZE = int(os.environ.get("SAS2PY_SEARCH_PAGE_SIZE", 20))
+
+parse_store = get_parse_store()
+
+# Parse, layout and render timings, input sizes and cache statistics of this process, in the Prometheus text format,
+# served on SAS2PY_METRICS_PORT and/or written to SAS2PY_METRICS_FILE (utils/metrics_utils.py). Started once per process
+start_metrics_server()
+start_metrics_dump()
+
 ############################################################
 # 3. Application Header
 ############################################################
@@ -51,21 +97,112 @@ st.title("SAS code analyser")
 ############################################################
 uploaded_file = st.file_uploader("##Upload SAS code as txt", type=["txt"])
 
-# If a file is uploaded, read and store in session_state
+# If a file is uploaded, read it and look it up in the shared parse store
 if uploaded_file is not None:
     # Read uploaded file
-    content = uploaded_file.read().decode('utf-8')
-    st.session_state['sas_script'] = content
+    content = uploaded_file.getvalue().decode('utf-8')
+    key = script_key(content)
 
-# If we have SAS script in session state, parse it
-if st.session_state['sas_script']:
-    st.session_state['struct_SAS'] = StructuredSAS(st.session_state['sas_script']).execute_all_processing_steps()
+    if key != st.session_state['script_key']:
+        if st.session_state['parse_job'] is not None:
+            st.session_state['parse_job'].cancel()
+            st.session_state['parse_job'] = None
+        st.session_state['script_key'] = key
 
+    # Parse in the background unless the store already has it (uploaded before by anyone, and not evicted)
+    if key not in parse_store and st.session_state['parse_job'] is None:
+        st.session_state['parse_job'] = ParseJob(content, key)
+
+struct_SAS = parse_store.get(st.session_state['script_key']) if st.session_state['script_key'] else None
+
+if struct_SAS is not None and struct_SAS.degraded_runs:
+    # Blocks over the parse budget were parsed with a heuristic, their lineage may be incomplete
+    reasons = {"size": "too large", "time": "too slow to parse", "total_time": "parse time limit reached"}
+    st.warning(
+        f"{len(struct_SAS.degraded_runs)} code block(s) were parsed approximately, lineage from them may be "
+        "incomplete:\n" + "\n".join(
+            f"- lines {block['lines'][0]}-{block['lines'][1]} ({block['bytes'] // 1024} KB): {reasons[block['reason']]}"
+            for block in struct_SAS.degraded_runs[:20]
+        )
+    )
+
+
+############################################################
+# 5. Parsing progress
+############################################################
+@st.fragment(run_every="0.5s")
+def show_parse_progress():
+    """
+    Polls the background parse. Only this fragment reruns while parsing, the rest of the page stays responsive.
+    Once the parse finishes, the whole app is rerun to show its results.
+    """
+    job = st.session_state['parse_job']
+    if job is None:
+        return
+
+    if not job.done:
+        progress = job.progress.snapshot()
+        st.progress(
+            job.progress.fraction,
+            text=f"Parsing SAS code ({progress['stage']}): "
+                 f"{progress['sections_done']}/{progress['sections_total']} sections, {progress['runs_done']} runs"
+        )
+        if st.button("Cancel parsing"):
+            job.cancel()
+        return
+
+    if job.cancelled or job.error is not None:
+        # The finished job is kept in session, so reruns don't start the parse again until it's retried
+        if job.cancelled:
+            st.warning("Parsing was cancelled")
+        else:
+            st.error(f"Parsing failed: {job.error}")
+        if st.button("Retry parsing"):
+            # Without a job, the file uploader section submits a new one for the uploaded script
+            st.session_state['parse_job'] = None
+            st.rerun(scope="app")
+    else:
+        st.session_state['parse_job'] = None
+        st.rerun(scope="app")
+
+
+show_parse_progress()
 
 
 ############################################################
 # 6. Show Network Graph
 ############################################################
+def build_node_styles(struct_SAS, style_metric, hops):
+    """
+    Node sizes/colours of a hotspot metric, and for a neighbourhood view, hop counts in the tooltips
+    with the chosen dataset drawn as a star.
+    """
+    node_styles = struct_SAS.get_hotspots().node_styles(style_metric) if style_metric else None
+    if hops is not None:
+        node_styles = dict(node_styles or {})
+        for node, hop in hops.items():
+            style = node_styles.get(node, {})
+            if hop == 0:
+                node_styles[node] = {**style, "shape": "star"}
+            else:
+                direction = "upstream" if hop < 0 else "downstream"
+                title = f"{style.get('title', node)}\n{abs(hop)} hops {direction}"
+                node_styles[node] = {**style, "title": title}
+    return node_styles
+
+
+@st.cache_resource(max_entries=8)
+def get_deck(key, render_key, _struct_SAS, _nodes, _edges, _hops):
+    """
+    pydeck chart of a script's graph, built once per script key and rendering options
+    """
+    from utils.deck_utils import create_deck_layout
+    style_metric, view_key, height = render_key
+    # The whole graph reuses the parse's LineageGraph with its cached depth
+    graph = _struct_SAS.get_lineage_graph() if view_key is None else (_nodes, _edges)
+    return create_deck_layout(graph, build_node_styles(_struct_SAS, style_metric, _hops), height)
+
+
 with st.container(border=True):
     st.markdown(
         """
@@ -77,7 +214,7 @@ with st.container(border=True):
     if st.button("Show Network Graph"):
         st.session_state['show_network_graph'] = True
 
-    if st.session_state['show_network_graph'] and st.session_state['struct_SAS']:
+    if st.session_state['show_network_graph'] and struct_SAS:
 
         # Widgets
         graph_net_ins_outs_height = st.slider("Select height for network graph", min_value=100, max_value=800, step=10, value=750)
@@ -85,33 +222,214 @@ with st.container(border=True):
         # selected_layout = st.radio('Try different layouts',options=['barnes_hut',"repulsion","force_atlas_2based","hierarchical_repulsion"])
 
 
-        nodes = st.session_state['struct_SAS'].nodes
-        edges = st.session_state['struct_SAS'].edges
+        nodes = struct_SAS.nodes
+        edges = struct_SAS.edges
+
+        graph_view = st.radio("Show:", options=["Whole graph", "Neighbourhood of a dataset"], horizontal=True)
+        view_key = None
+        hops = None
+        if graph_view == "Neighbourhood of a dataset":
+            # Ego network: only datasets within the chosen hops are laid out and rendered
+            col_focus, col_up, col_down = st.columns([2, 1, 1])
+            with col_focus:
+                focus = st.selectbox("Dataset", sorted(nodes), index=None, placeholder="Choose a dataset")
+            with col_up:
+                upstream_hops = st.number_input("Upstream hops", min_value=0, max_value=50, value=2)
+            with col_down:
+                downstream_hops = st.number_input("Downstream hops", min_value=0, max_value=50, value=2)
+            if focus is None:
+                nodes, edges, hops = [], [], {}
+            else:
+                nodes, edges, hops = struct_SAS.get_lineage_graph().neighbourhood(focus, upstream_hops, downstream_hops)
+                st.caption(f"{sum(h < 0 for h in hops.values())} datasets upstream, "
+                           f"{sum(h > 0 for h in hops.values())} downstream, {len(edges)} edges")
+            view_key = ("neighbourhood", focus, upstream_hops, downstream_hops)
+
+        # Pruned graph: leaves out datasets classified as clutter by StructuredSAS.classify_datasets
+        elif st.toggle("Pruned graph", help="Hide orphan and dead datasets, collapse chains of pass-through datasets"):
+            col_drop, col_collapse = st.columns(2)
+            with col_drop:
+                drop_classes = st.multiselect("Hide datasets that are:", DATASET_CLASSES, default=["orphan", "dead"])
+            with col_collapse:
+                collapse_pass_through = st.checkbox("Collapse pass-through datasets", value=True)
+            nodes, edges = struct_SAS.get_pruned_graph(drop_classes, collapse_pass_through)
+            view_key = ("pruned", tuple(sorted(drop_classes)), collapse_pass_through)
+            st.caption(f"Showing {len(nodes)} of {len(struct_SAS.nodes)} datasets, "
+                       f"{len(edges)} of {len(set(struct_SAS.edges))} edges")
 
+        # Transitive reduction: edges implied by a longer path (A -> C next to A -> B -> C) are not drawn
+        full_view_key = view_key
+        if st.toggle("Transitive reduction", help="Hide edges implied by longer paths, e.g. A -> C when there is "
+                                                  "A -> B -> C. Every dependency stays visible as a path"):
+            from utils.graph_utils import transitive_reduction
+            edges, reduction_report = transitive_reduction(nodes, edges)
+            view_key = ("reduced", view_key)
+            st.caption(f"Transitive reduction removed {reduction_report['removed']} of {reduction_report['edges']} "
+                       f"edges ({reduction_report['removed_ratio']:.0%}) in {reduction_report['seconds']:.2f}s")
 
         layout_choice = st.selectbox(
             "Choose a layout:",
-            ["Force-directed (spring_layout)", "BFS hierarchical", "Multipartite"]
+            ["Force-directed (spring_layout)", "BFS hierarchical", "Multipartite", "WebGL (pydeck)",
+             "Link analysis (st-link-analysis)"],
+            help="WebGL draws on the GPU and stays smooth for graphs with tens of thousands of datasets"
         )
-        if layout_choice == "Force-directed (spring_layout)":
-            net = create_pyvis_force_layout(nodes, edges)
-        elif layout_choice == "BFS hierarchical":
-            net = create_pyvis_hierarchical_layout(nodes, edges)
-        else:  # "Multipartite"
-            # For multipartite layout, define which layer each node belongs to
-            layer_map = {
-                "A": 0,
-                "B": 1,
-                "C": 1,
-                "D": 2,
-                "E": 2,
-                "F": 3
-            }
-            net = create_pyvis_multipartite_layout(nodes, edges, layer_map)
-        # html_data = net.generate_html()
-        html_data = inject_js_features(net)
-        st.markdown("**Double click a node to copy its name!**")
-        st.components.v1.html(html_data, height=graph_net_ins_outs_height)
+        layer_mode = None
+        if layout_choice == "Multipartite":
+            layer_mode = st.radio(
+                "Layers by:", options=["depth", "role"] + (["hops"] if hops is not None else []), horizontal=True,
+                format_func=lambda x: {"depth": "Depth in lineage", "role": "Source / intermediate / sink",
+                                       "hops": "Hops from the dataset"}[x]
+            )
+        # Node size and colour by a hotspot metric (see section 6a)
+        from utils.hotspot_utils import HOTSPOT_METRICS
+        style_metric = st.selectbox("Size and colour nodes by:", [None, *HOTSPOT_METRICS],
+                                    format_func=lambda x: "Nothing" if x is None else x)
+        show_run_tooltips = st.toggle(
+            "Show run code on hover", help="Code is fetched from a lineage service in this process when an edge or "
+                                           "dataset is hovered, the graph itself carries none"
+        )
+
+        if layout_choice == "WebGL (pydeck)":
+            deck = get_deck(st.session_state['script_key'], (style_metric, view_key, graph_net_ins_outs_height),
+                            struct_SAS, nodes, edges, hops)
+            event = st.pydeck_chart(deck, height=graph_net_ins_outs_height, on_select="rerun",
+                                    selection_mode="single-object", key="deck_graph")
+            picked = event.selection["objects"].get("datasets", []) if event and event.selection else []
+            if picked:
+                picked_graph = struct_SAS.get_lineage_graph()
+                picked_name = picked[0]["name"]
+                st.json({
+                    "dataset": picked_name,
+                    "role": picked[0]["role"],
+                    "upstream": len(picked_graph.reachable([picked_name], "upstream")) - 1,
+                    "downstream": len(picked_graph.reachable([picked_name], "downstream")) - 1,
+                })
+        elif layout_choice == "Link analysis (st-link-analysis)":
+            try:
+                from st_link_analysis import st_link_analysis, NodeStyle, EdgeStyle
+            except ImportError:
+                st.warning("This view needs the st-link-analysis package: `pip install st-link-analysis`")
+            else:
+                # One StLink per session: a new script or view only changes the elements that differ
+                if st.session_state['st_link'] is None:
+                    st.session_state['st_link'] = StLink()
+                st_link = st.session_state['st_link']
+                delta = st_link.update(nodes, edges)
+                st.caption(f"Since the previous view: {len(delta['added_nodes'])} datasets and "
+                           f"{len(delta['added_edges'])} edges added, {len(delta['removed_nodes'])} datasets and "
+                           f"{len(delta['removed_edges'])} edges removed")
+                st_link_analysis(
+                    st_link.st_link_data, layout="cose",
+                    node_styles=[NodeStyle(StLink.NODE_LABEL, "#FF7F3E", "name")],
+                    edge_styles=[EdgeStyle(StLink.EDGE_LABEL, directed=True)],
+                    height=graph_net_ins_outs_height, key="link_graph",
+                )
+        else:
+            # Rendered html is stored next to the parse result, so it's shared by every session viewing this script
+            tooltip_url = None
+            if show_run_tooltips:
+                from utils.service_utils import start_tooltip_service, is_local_origin, TOOLTIP_URL
+                # Origin of this session's browser, sent with the websocket handshake
+                app_origin = st.context.headers.get("Origin")
+                service_url = start_tooltip_service(app_origin)
+                if service_url is not None:
+                    tooltip_url = f"{service_url}/scripts/{st.session_state['script_key']}"
+                elif TOOLTIP_URL is None and not is_local_origin(app_origin):
+                    st.warning("Run code tooltips need SAS2PY_TOOLTIP_URL: the public URL routed to the tooltip "
+                               "service (SAS2PY_TOOLTIP_PORT), when the app isn't opened on the server itself")
+                else:
+                    st.warning("Couldn't start the tooltip service, is SAS2PY_TOOLTIP_PORT in use?")
+            render_key = (layout_choice, layer_mode, style_metric, view_key, tooltip_url)
+            html_data = parse_store.get_html(st.session_state['script_key'], render_key)
+            if html_data is None:
+                render_start = time.perf_counter()
+                node_styles = build_node_styles(struct_SAS, style_metric, hops)
+                if layout_choice == "Force-directed (spring_layout)":
+                    net = create_pyvis_force_layout(nodes, edges, node_styles)
+                elif layout_choice == "BFS hierarchical":
+                    net = create_pyvis_hierarchical_layout(nodes, edges, node_styles)
+                else:  # "Multipartite"
+                    # Layer of each node: topological depth in the lineage, or its source/intermediate/sink role
+                    layer_map = hops if layer_mode == "hops" else struct_SAS.get_lineage_graph().layers(layer_mode)
+                    net = create_pyvis_multipartite_layout(nodes, edges, layer_map, node_styles)
+                # html_data = inject_js_features(net)
+                html_data = render_network_html(net, tooltip_url=tooltip_url)
+                parse_store.put_html(st.session_state['script_key'], render_key, html_data)
+                st.session_state['render_seconds'][render_key] = time.perf_counter() - render_start
+            if view_key != full_view_key:
+                # Render time saved by the reduction, once both versions were rendered in this session
+                full_seconds = st.session_state['render_seconds'].get(
+                    (layout_choice, layer_mode, style_metric, full_view_key, tooltip_url))
+                reduced_seconds = st.session_state['render_seconds'].get(render_key)
+                if full_seconds is not None and reduced_seconds is not None:
+                    st.caption(f"Rendering took {reduced_seconds:.2f}s instead of {full_seconds:.2f}s "
+                               f"({full_seconds - reduced_seconds:.2f}s saved)")
+            st.markdown("**Double click a node to copy its name!**")
+            st.components.v1.html(html_data, height=graph_net_ins_outs_height)
+
+############################################################
+# 6a. Pipeline hotspots
+############################################################
+with st.container(border=True):
+    st.markdown(
+        """
+        ### Pipeline hotspots
+
+        Datasets everything depends on, and the longest chain of dependencies, which bounds the runtime of a batch.
+        """
+    )
+    # Betweenness and PageRank take a while on large graphs, so they are computed only when asked for (once per
+    # parse result, see StructuredSAS.get_hotspots)
+    if struct_SAS and st.toggle("Show hotspots"):
+        from utils.hotspot_utils import HOTSPOT_METRICS
+        hotspots = struct_SAS.get_hotspots()
+        critical_path = hotspots.critical_path
+        shown_path = critical_path if len(critical_path) <= 100 else critical_path[:50] + ["…"] + critical_path[-50:]
+        st.markdown(f"**Critical path** ({len(critical_path)} datasets): " + " → ".join(shown_path))
+        col_sort, col_top = st.columns(2)
+        with col_sort:
+            hotspot_sort = st.selectbox("Rank datasets by:", HOTSPOT_METRICS)
+        with col_top:
+            hotspot_top = st.number_input("Rows", min_value=5, max_value=1000, value=25, step=5)
+        st.dataframe(hotspots.table(hotspot_sort, hotspot_top), use_container_width=True)
+
+############################################################
+# 6b. Parallel execution plan
+############################################################
+@st.cache_resource(max_entries=16)
+def get_execution_plan(key, _struct_SAS):
+    """
+    Plan of a parsed script, built once per script key. It keeps its simulations, so moving the Workers slider
+    simulates each number of workers once per script, and other reruns don't simulate at all.
+    """
+    return ExecutionPlan(_struct_SAS).build()
+
+
+with st.container(border=True):
+    st.markdown(
+        """
+        ### Parallel execution plan
+
+        Steps grouped into waves that can run at the same time, respecting every read/write dependency of the
+        file order. Costs are the number of lines of each step.
+        """
+    )
+    if struct_SAS:
+        plan = get_execution_plan(st.session_state['script_key'], struct_SAS)
+        plan_workers = st.slider("Workers", min_value=1, max_value=64, value=4)
+        path, path_cost = plan.critical_path()
+        total_cost = sum(plan.costs)
+        simulation = plan.simulate(plan_workers)
+        col_waves, col_path, col_makespan = st.columns(3)
+        col_waves.metric("Waves", len(plan.waves), help=f"{len(plan.runs)} steps")
+        col_path.metric("Critical path", f"{path_cost:g}", help=f"{len(path)} steps, total cost {total_cost:g}")
+        col_makespan.metric(f"Makespan with {plan_workers} workers", f"{simulation['makespan']:g}",
+                            delta=f"{simulation['speedup']:.2f}x speedup", delta_color="off")
+        st.dataframe([
+            {"wave": i, "steps": len(wave),
+             "first lines": ", ".join(f"{plan.runs[j]['run_lines'][0][0]}" for j in wave[:20]) + (" …" if len(wave) > 20 else "")}
+            for i, wave in enumerate(plan.waves)
+        ], use_container_width=True)
 
 ############################################################
 # 7. Capture Metadata
@@ -119,16 +437,25 @@ with st.container(border=True):
 if st.button("Capture metadata"):
     st.session_state['show_metadata'] = True
 
-if st.session_state['show_metadata'] and st.session_state['struct_SAS']:
+if st.session_state['show_metadata'] and struct_SAS:
     with st.container():
         st.text("Inputs")
-        st.code(st.session_state['struct_SAS'].inputs)
+        st.code(struct_SAS.inputs)
 
         st.text("Outputs")
-        st.code(st.session_state['struct_SAS'].outputs)
+        st.code(struct_SAS.outputs)
 
         st.text("Sub graphs")
-        st.code(st.session_state['struct_SAS'].subgraphs)
+        st.code(struct_SAS.subgraphs)
+
+        st.text("Datasets by class")
+        st.json({
+            dataset_class: sorted(n for n, c in struct_SAS.dataset_classes.items() if c == dataset_class)
+            for dataset_class in DATASET_CLASSES
+        }, expanded=False)
+
+        st.text("Duplicate run blocks")
+        st.json(struct_SAS.dedup_stats, expanded=False)
 
 ############################################################
 # 8. Search in the Code
@@ -138,9 +465,100 @@ with st.form("Capture code snippets"):
     search_in = st.radio("What are you interested in?", options=['inputs', 'outputs', 'run_code'])
     submit = st.form_submit_button("Search")
     if submit:
-        if st.session_state['struct_SAS']:
-            search_results = [x for x in st.session_state['struct_SAS'].pre_processed if query in x[search_in]]
-            st.json(search_results)
+        if struct_SAS:
+            # Only positions of the matches are kept, their code is sliced from raw_code for the page shown
+            if search_in == 'run_code':
+                matches = [i for i, x in enumerate(struct_SAS.pre_processed) if query in struct_SAS.get_run_code(x)]
+            else:
+                matches = [i for i, x in enumerate(struct_SAS.pre_processed) if query in x[search_in]]
+            st.session_state['search_results'] = (st.session_state['script_key'], matches)
+            st.session_state['search_page'] = 1
+
+
+def jump_to_line(line):
+    # on_click callback: runs before the code viewer's widgets are created, so its line input can be set
+    st.session_state['code_line'] = max(1, line - 5)
+
+
+@st.fragment
+def show_search_results(struct_SAS):
+    """
+    One page of search results. Paging reruns only this fragment.
+    """
+    results_key, matches = st.session_state['search_results']
+    if results_key != st.session_state['script_key']:
+        return
+    if not matches:
+        st.info("No matches")
+        return
+
+    n_pages = (len(matches) - 1) // SEARCH_PAGE_SIZE + 1
+    page = st.number_input(f"Page of {n_pages} ({len(matches)} matching runs)", min_value=1, max_value=n_pages,
+                           key='search_page')
+    for i in matches[(page - 1) * SEARCH_PAGE_SIZE:page * SEARCH_PAGE_SIZE]:
+        run = struct_SAS.pre_processed[i]
+        first_line, last_line = run["run_lines"][0][0], run["run_lines"][-1][1]
+        with st.expander(f"Lines {first_line}-{last_line}: {', '.join(sorted(run['inputs'])) or '-'} -> "
+                         f"{', '.join(sorted(run['outputs'])) or '-'}"):
+            st.code(struct_SAS.get_run_code(run))
+            if st.button("Show in script", key=f"jump_{i}", on_click=jump_to_line, args=(first_line,)):
+                st.rerun(scope="app")  # The code viewer is another fragment
+
+
+if struct_SAS and st.session_state['search_results'] is not None:
+    show_search_results(struct_SAS)
+
+############################################################
+# 8a. Lineage of a watched code directory
+############################################################
+# Set SAS2PY_WATCH_DIR to a directory of SAS programs. One watcher per process keeps its merged lineage fresh,
+# sessions only query it.
+if os.environ.get("SAS2PY_WATCH_DIR"):
+    from utils.watch_utils import get_watcher
+
+    watcher = get_watcher(os.environ["SAS2PY_WATCH_DIR"])
+    with st.container(border=True):
+        st.markdown(f"### Lineage of `{watcher.directory}`")
+        watch_stats = watcher.lineage.stats()
+        st.caption(f"{watch_stats['files']} files, {watch_stats['nodes']} datasets, {watch_stats['edges']} edges. "
+                   f"Parse errors: {len(watcher.errors)}")
+        with st.form("Watched lineage query"):
+            watched_dataset = st.text_input("Dataset")
+            watched_direction = st.radio("Direction", options=['upstream', 'downstream'], horizontal=True)
+            if st.form_submit_button("Query") and watched_dataset:
+                st.json({
+                    watched_direction: sorted(set(watcher.lineage.reachable([watched_dataset], watched_direction))
+                                              - {watched_dataset}),
+                    "files": watcher.lineage.files_with(watched_dataset),
+                })
+
+############################################################
+# 8b. Lineage catalog
+############################################################
+# Set SAS2PY_CATALOG to a SQLite catalog built with `python -m utils.catalog_utils catalog.db index dir`.
+# Queries run in SQLite, the corpus is never loaded into memory.
+if os.environ.get("SAS2PY_CATALOG"):
+    from utils.catalog_utils import LineageCatalog
+
+    @st.cache_resource
+    def get_catalog(db_path):
+        return LineageCatalog(db_path)
+
+    catalog = get_catalog(os.environ["SAS2PY_CATALOG"])
+    with st.container(border=True):
+        st.markdown("### Lineage catalog")
+        catalog_stats = catalog.stats()
+        st.caption(f"{catalog_stats['programs']} programs, {catalog_stats['datasets']} datasets, "
+                   f"{catalog_stats['edges']} edges")
+        with st.form("Catalog query"):
+            catalog_dataset = st.text_input("Dataset")
+            catalog_direction = st.radio("Direction", options=['upstream', 'downstream'], horizontal=True)
+            catalog_depth = st.number_input("Max hops (0 = unlimited)", min_value=0, value=0)
+            if st.form_submit_button("Query") and catalog_dataset:
+                st.json({
+                    catalog_direction: catalog.lineage(catalog_dataset, catalog_direction, catalog_depth or None),
+                    "runs": catalog.runs_of(catalog_dataset),
+                })
 
 ############################################################
 # 9. Flow Chart Generation
@@ -165,8 +583,10 @@ with st.form("Capture code snippets"):
 #     with col2:
 #         if st.button("Get Flow Chart"):
 #             # Generate flow chart only if we have a struct_SAS
-#             if st.session_state['struct_SAS']:
-#                 flow_chart = generate_mermaid_markdown(st.session_state['struct_SAS'].struct_code)
+#             if struct_SAS:
+#                 flow_chart = generate_mermaid_markdown(
+#                     [{**run, 'run_code': escape_run_code(struct_SAS.get_run_code(run))} for run in struct_SAS.struct_code]
+#                 )
 #                 st.session_state['flow_chart'] = flow_chart
 #                 # st.session_state['show_flow_chart'] = True
 #
@@ -180,6 +600,33 @@ with st.form("Capture code snippets"):
 ############################################################
 # 10. Show the original SAS script
 ############################################################
-if st.session_state['sas_script']:
+@st.fragment
+def show_code_viewer(struct_SAS):
+    """
+    Window of CODE_PAGE_LINES lines of the script, sliced with the parse's line index. Scrolling reruns only
+    this fragment and sends only the window, whatever the size of the script.
+    """
+    n_lines = struct_SAS.line_count
+    st.session_state['code_line'] = min(st.session_state['code_line'], n_lines)
+
+    def move(lines):
+        st.session_state['code_line'] = min(max(1, st.session_state['code_line'] + lines), n_lines)
+
+    col_prev, col_line, col_next = st.columns([1, 4, 1], vertical_alignment="bottom")
+    col_prev.button("Previous", on_click=move, args=(-CODE_PAGE_LINES,), use_container_width=True)
+    first = col_line.number_input(f"Go to line (of {n_lines})", min_value=1, max_value=n_lines, key='code_line')
+    col_next.button("Next", on_click=move, args=(CODE_PAGE_LINES,), use_container_width=True)
+
+    last = min(first + CODE_PAGE_LINES - 1, n_lines)
+    width = len(str(last))
+    numbered = "\n".join(
+        f"{line:>{width}}  {text}"
+        for line, text in enumerate(struct_SAS.get_lines(first, last).split("\n"), start=first)
+    )
+    st.caption(f"Lines {first}-{last} of {n_lines}")
+    st.code(numbered)
+
+
+if struct_SAS:
     st.subheader("Original SAS Script")
-    st.code(st.session_state['sas_script'])
+    show_code_viewer(struct_SAS)
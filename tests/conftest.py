@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The utils modules import each other as `utils.x`, so the tests run against the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
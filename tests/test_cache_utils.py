@@ -0,0 +1,59 @@
+from utils.cache_utils import ParseStore, RunBlockStore, script_key
+from utils.parse_utils import StructuredSAS
+
+STEP = "data work.{out};\n  set work.{inp};\n  x = 1;\nrun;\n\n"
+
+
+def parse(code):
+    return StructuredSAS(code).execute_all_processing_steps()
+
+
+def test_copied_blocks_reuse_their_first_parse():
+    # Unique dataset names, so the blocks weren't memoized by another test of this process
+    step = STEP.format(out="memo_out", inp="memo_in")
+    first = parse(step + STEP.format(out="memo_other", inp="memo_out"))
+    copied = parse(STEP.format(out="memo_in", inp="memo_source") + step + step)
+
+    assert first.dedup_stats["memo_hits"] == 0
+    assert copied.dedup_stats["memo_hits"] == 2
+    assert copied.dedup_stats["unique_runs"] == 2
+    # References of the copies are shifted to their own offsets
+    starts = [run["output_refs"][0][1] for run in copied.pre_processed[1:]]
+    assert [copied.raw_code[start:start + 12] for start in starts] == ["work.memo_ou"] * 2
+    assert starts[1] - starts[0] == len(step)
+
+
+def test_run_block_store_is_an_lru():
+    store = RunBlockStore(max_entries=2)
+    for key in ("a", "b"):
+        store.put(key, [], [], None)
+    store.get("a")
+    store.put("c", [], [], None)
+    assert store.get("b") is None
+    assert store.get("a") is not None
+    assert store.stats()["blocks"] == 2
+    assert store.escaped("x", str.upper) is store.escaped("x", str.lower)
+
+
+def test_parse_store_evicts_least_recently_used():
+    parsed = {name: parse(STEP.format(out=f"{name}_out", inp=f"{name}_in")) for name in ("one", "two", "three")}
+    store = ParseStore(max_bytes=1)
+    for name, struct_SAS in parsed.items():
+        store.put(script_key(name), struct_SAS)
+    # Only the most recent entry is kept once the budget is exceeded
+    assert len(store) == 1
+    assert store.get(script_key("three")) is parsed["three"]
+    assert store.get(script_key("one")) is None
+    assert store.stats()["evictions"] == 2
+
+
+def test_parse_store_accounts_for_derived_caches():
+    struct_SAS = parse("".join(STEP.format(out=f"sized{i + 1}", inp=f"sized{i}") for i in range(50)))
+    store = ParseStore()
+    key = script_key("sized")
+    store.put(key, struct_SAS)
+    before = store.stats()["total_bytes"]
+
+    struct_SAS.get_provenance_index()
+    store.get(key)
+    assert store.stats()["total_bytes"] > before
@@ -0,0 +1,62 @@
+import pytest
+
+from utils.catalog_utils import LineageCatalog
+
+
+def write_programs(directory):
+    (directory / "first.sas").write_text("data work.b;\n  set work.a;\nrun;\n")
+    (directory / "second.sas").write_text("data work.c;\n  set work.b;\nrun;\n\ndata work.d;\n  set work.c;\nrun;\n")
+    (directory / "notes.md").write_text("not a program")
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    catalog = LineageCatalog(str(tmp_path / "catalog.db"))
+    yield catalog
+    catalog.close()
+
+
+def test_index_and_query(tmp_path, catalog):
+    code = tmp_path / "code"
+    code.mkdir()
+    write_programs(code)
+
+    assert catalog.index_directory(str(code)) == (2, 0)
+    assert catalog.stats() == {"programs": 2, "runs": 3, "datasets": 4, "edges": 3}
+    assert catalog.ancestors("d") == ["a", "b", "c"]
+    assert catalog.descendants("a", max_depth=2) == [("b", 1), ("c", 2)]
+    runs = catalog.runs_of("b", kind="output")
+    assert [(run["path"].rsplit("/", 1)[-1], run["first_line"]) for run in runs] == [("first.sas", 1)]
+
+    with pytest.raises(ValueError):
+        catalog.lineage("a", "sideways")
+
+
+def test_reindex_skips_unchanged_and_removes_deleted(tmp_path, catalog):
+    code = tmp_path / "code"
+    code.mkdir()
+    write_programs(code)
+    catalog.index_directory(str(code))
+
+    assert catalog.index_directory(str(code)) == (0, 0)
+
+    (code / "first.sas").write_text("data work.b;\n  set work.z;\nrun;\n")
+    (code / "second.sas").unlink()
+    assert catalog.index_directory(str(code)) == (1, 1)
+    assert catalog.ancestors("b") == ["z"]
+    assert catalog.descendants("b") == []
+    # Datasets only the deleted program referred to are gone with it
+    assert catalog.stats() == {"programs": 1, "runs": 1, "datasets": 2, "edges": 1}
+
+
+def test_index_commits_once_per_batch(tmp_path, catalog):
+    code = tmp_path / "code"
+    code.mkdir()
+    for i in range(5):
+        (code / f"prog{i}.sas").write_text(f"data work.out{i};\n  set work.in{i};\nrun;\n")
+    statements = []
+    catalog.connection().set_trace_callback(statements.append)
+
+    assert catalog.index_directory(str(code), batch=2) == (5, 0)
+    assert sum(statement.upper() == "COMMIT" for statement in statements) == 3
+    assert catalog.stats()["programs"] == 5
@@ -0,0 +1,93 @@
+import pytest
+
+from utils.include_utils import IncludeResolver
+
+MAIN = """data work.raw;
+  set lib.source;
+run;
+
+%include 'steps.sas';
+
+data work.report;
+  set work.clean;
+run;
+"""
+STEPS = """data work.clean;
+  set work.raw;
+run;
+"""
+
+
+@pytest.fixture
+def programs(tmp_path):
+    (tmp_path / "main.sas").write_text(MAIN)
+    (tmp_path / "steps.sas").write_text(STEPS)
+    return tmp_path
+
+
+def test_included_runs_are_spliced_at_the_include(programs):
+    resolver = IncludeResolver(search_path=[])
+    struct_SAS = resolver.parse_program(str(programs / "main.sas"))
+
+    assert sorted(struct_SAS.edges) == [("clean", "report"), ("raw", "clean"), ("source", "raw")]
+    assert resolver.dependencies == {str(programs / "main.sas"): [str(programs / "steps.sas")],
+                                     str(programs / "steps.sas"): []}
+    outputs = [run["outputs"] for run in struct_SAS.struct_code]
+    assert outputs == [["raw"], ["clean"], ["report"]]
+    included = struct_SAS.struct_code[1]
+    assert included["source_file"] == str(programs / "steps.sas")
+    assert struct_SAS.get_run_code(included) == "data work.clean;\n  set work.raw;"
+
+
+def test_locators_work_on_spliced_programs(programs):
+    struct_SAS = IncludeResolver(search_path=[]).parse_program(str(programs / "main.sas"))
+
+    locations = struct_SAS.reference_locations("report")
+    assert [(location["kind"], location["line"], location["column"]) for location in locations] == [("output", 7, 6)]
+    assert struct_SAS.line_col(MAIN.index("set work.clean")) == (8, 3)
+    assert struct_SAS.line_count == MAIN.count("\n") + 1
+
+
+def test_unchanged_includes_are_not_parsed_again(programs):
+    resolver = IncludeResolver(search_path=[])
+    resolver.parse_program(str(programs / "main.sas"))
+    assert resolver.parsed_files == 2
+
+    (programs / "main.sas").write_text(MAIN.replace("work.report", "work.summary"))
+    struct_SAS = resolver.parse_program(str(programs / "main.sas"))
+    assert resolver.parsed_files == 3
+    assert ("clean", "summary") in struct_SAS.edges
+    assert resolver.dependents(str(programs / "steps.sas")) == {str(programs / "main.sas")}
+
+
+def test_unresolved_include_is_reported(tmp_path):
+    (tmp_path / "main.sas").write_text(MAIN)
+    resolver = IncludeResolver(search_path=[])
+    struct_SAS = resolver.parse_program(str(tmp_path / "main.sas"))
+    assert resolver.unresolved[str(tmp_path / "main.sas")] == ["steps.sas"]
+    assert sorted(struct_SAS.edges) == [("clean", "report"), ("source", "raw")]
+
+
+def test_included_references_are_located_in_their_file(programs):
+    struct_SAS = IncludeResolver(search_path=[]).parse_program(str(programs / "main.sas"))
+
+    locations = struct_SAS.reference_locations("clean")
+    assert [(location["kind"], location["source_file"], location["line"], location["column"])
+            for location in locations] == [("input", None, 8, 7),
+                                           ("output", str(programs / "steps.sas"), 1, 6)]
+    included = struct_SAS.struct_code[1]
+    source = struct_SAS.source_of(included)
+    first, last = included["run_lines"][0]
+    assert source.get_lines(first, last) == "data work.clean;\n  set work.raw;"
+    assert struct_SAS.source_of(struct_SAS.struct_code[0]) is struct_SAS
+
+
+def test_identity_runs_are_merged_per_file(tmp_path):
+    (tmp_path / "main.sas").write_text("data work.a;\n  set work.a;\nrun;\n\n%include 'fix.sas';\n")
+    (tmp_path / "fix.sas").write_text("data work.a;\n  set work.a;\n  x = 1;\nrun;\n")
+    struct_SAS = IncludeResolver(search_path=[]).parse_program(str(tmp_path / "main.sas"))
+
+    assert [(run.get("source_file"), run["run_lines"]) for run in struct_SAS.struct_code] == [
+        (str(tmp_path / "main.sas"), [(1, 2)]),
+        (str(tmp_path / "fix.sas"), [(1, 3)]),
+    ]
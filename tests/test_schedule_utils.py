@@ -0,0 +1,58 @@
+from types import SimpleNamespace
+
+import pytest
+
+from utils.schedule_utils import ExecutionPlan, run_lines_cost
+
+
+def plan_of(*runs, costs=None):
+    """
+    :param runs: (inputs, outputs) of each run, in file order
+    """
+    struct_SAS = SimpleNamespace(struct_code=[{"inputs": list(i), "outputs": list(o)} for i, o in runs])
+    return ExecutionPlan(struct_SAS, costs=costs if costs is not None else [1] * len(runs)).build()
+
+
+def test_dependencies_follow_file_order_hazards():
+    plan = plan_of(
+        ([], ["a"]),     # 0
+        (["a"], ["b"]),  # 1 reads a after 0 wrote it
+        (["a"], ["c"]),  # 2 reads a after 0 wrote it
+        ([], ["a"]),     # 3 rewrites a: after 0 wrote it and 1, 2 read it
+        (["a"], ["a"]),  # 4 updates a in place
+    )
+    assert plan.dependencies == [[], [0], [0], [0, 1, 2], [3]]
+    assert plan.hazards == {"read_after_write": 3, "write_after_read": 2, "write_after_write": 2}
+    assert plan.waves == [[0], [1, 2], [3], [4]]
+
+
+def test_critical_path_and_simulation():
+    # Two independent chains: 0 -> 1 (cost 5) and 2 -> 3 (cost 2)
+    plan = plan_of(([], ["a"]), (["a"], ["b"]), ([], ["c"]), (["c"], ["d"]), costs=[2, 3, 1, 1])
+    assert plan.critical_path() == ([0, 1], 5)
+
+    one = plan.simulate(1)
+    assert one["makespan"] == 7
+    two = plan.simulate(2)
+    assert (two["makespan"], two["speedup"]) == (5, 7 / 5)
+    # Longest remaining path first: the heavy chain starts on worker 0 at time 0
+    assert two["schedule"][0] == (0, 0, 0.0, 2.0)
+
+    with pytest.raises(ValueError):
+        plan.simulate(0)
+
+
+def test_simulations_are_kept_per_number_of_workers():
+    plan = plan_of(([], ["a"]), (["a"], ["b"]))
+    assert plan.simulate(4) is plan.simulate(4)
+    assert plan.simulate(4) is not plan.simulate(2)
+    first = plan.simulate(4)
+    plan.build()
+    assert plan.simulate(4) is not first
+
+
+def test_costs():
+    assert run_lines_cost({"run_lines": [(3, 5), (10, 10)]}) == 4
+    assert run_lines_cost({}) == 1
+    with pytest.raises(ValueError):
+        plan_of(([], ["a"]), costs=[1, 2])
@@ -0,0 +1,134 @@
+import json
+import threading
+
+from tornado.testing import AsyncHTTPTestCase
+
+from utils.cache_utils import ParseStore, script_key
+from utils.parse_utils import StructuredSAS
+from utils.service_utils import LineageService, make_app, make_tooltip_app
+
+SCRIPT = "data work.b;\n  set work.a;\nrun;\n\ndata work.c;\n  set work.b;\nrun;\n"
+ORIGIN = "http://localhost:8501"
+
+
+class RecordingStore(ParseStore):
+    """
+    ParseStore remembering the threads it was used from.
+    """
+    def __init__(self):
+        super().__init__()
+        self.threads = set()
+
+    def get(self, key):
+        self.threads.add(threading.current_thread())
+        return super().get(key)
+
+    def put(self, key, struct_SAS):
+        self.threads.add(threading.current_thread())
+        return super().put(key, struct_SAS)
+
+
+class LineageServiceTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.store = RecordingStore()
+        self.service = LineageService(workers=1, store=self.store, allowed_origins=[ORIGIN])
+        return make_app(self.service)
+
+    def tearDown(self):
+        super().tearDown()
+        self.service.shutdown()
+
+    def get_json(self, path, **headers):
+        response = self.fetch(path, headers=headers)
+        return response, json.loads(response.body)
+
+    def parse(self):
+        response = self.fetch("/parse", method="POST", body=SCRIPT)
+        self.assertEqual(response.code, 200)
+        return json.loads(response.body)
+
+    def test_parse_and_graph(self):
+        parsed = self.parse()
+        self.assertEqual(parsed["key"], script_key(SCRIPT))
+        self.assertEqual((parsed["nodes"], parsed["edges"]), (3, 2))
+
+        _, nodes = self.get_json(f"/scripts/{parsed['key']}/nodes")
+        self.assertEqual(nodes, {"nodes": ["a", "b", "c"]})
+        _, edges = self.get_json(f"/scripts/{parsed['key']}/edges")
+        self.assertEqual(edges, {"edges": [["a", "b"], ["b", "c"]]})
+
+    def test_store_is_used_off_the_event_loop(self):
+        key = self.parse()["key"]
+        self.get_json(f"/scripts/{key}/downstream?dataset=a")
+        self.assertEqual(len(self.store), 1)
+        self.assertNotIn(threading.main_thread(), self.store.threads)
+
+    def test_lineage(self):
+        key = self.parse()["key"]
+        _, body = self.get_json(f"/scripts/{key}/downstream?dataset=a")
+        self.assertEqual(body, {"dataset": "a", "downstream": {"b": 1, "c": 2}})
+        _, body = self.get_json(f"/scripts/{key}/upstream?dataset=c&hops=1")
+        self.assertEqual(body, {"dataset": "c", "upstream": {"b": 1}})
+        _, body = self.get_json(f"/scripts/{key}/upstream?dataset=c&hops=0")
+        self.assertEqual(body, {"dataset": "c", "upstream": {}})
+
+    def test_lineage_errors(self):
+        key = self.parse()["key"]
+        for hops in ("-1", "two"):
+            response, body = self.get_json(f"/scripts/{key}/upstream?dataset=c&hops={hops}")
+            self.assertEqual(response.code, 400)
+            self.assertIn("hops", body["error"])
+        response, _ = self.get_json(f"/scripts/{key}/upstream?dataset=missing")
+        self.assertEqual(response.code, 404)
+        response, _ = self.get_json(f"/scripts/{key}/upstream")
+        self.assertEqual(response.code, 400)
+        response, _ = self.get_json("/scripts/0123abcd/nodes")
+        self.assertEqual(response.code, 404)
+
+    def test_runs(self):
+        key = self.parse()["key"]
+        _, body = self.get_json(f"/scripts/{key}/runs?source=b&target=c")
+        self.assertEqual(body["total"], 1)
+        self.assertTrue(body["direct"])
+        self.assertEqual(body["runs"][0]["lines"], [5, 6])
+        self.assertIn("set work.b", body["runs"][0]["code"])
+
+        _, body = self.get_json(f"/scripts/{key}/runs?source=a&target=c")
+        self.assertEqual((body["total"], body["direct"]), (1, False))
+        _, body = self.get_json(f"/scripts/{key}/runs?dataset=b")
+        self.assertEqual(body["runs"][0]["lines"], [1, 2])
+
+    def test_cors_only_for_allowed_origins(self):
+        key = self.parse()["key"]
+        response, _ = self.get_json(f"/scripts/{key}/nodes", Origin=ORIGIN)
+        self.assertEqual(response.headers["Access-Control-Allow-Origin"], ORIGIN)
+        response, _ = self.get_json(f"/scripts/{key}/nodes", Origin="http://evil.example.com")
+        self.assertNotIn("Access-Control-Allow-Origin", response.headers)
+
+    def test_stats_and_metrics(self):
+        self.parse()
+        _, body = self.get_json("/stats")
+        self.assertEqual(body["store"]["entries"], 1)
+        self.assertEqual(body["parses_in_flight"], 0)
+        response = self.fetch("/metrics")
+        self.assertIn(b"sas2py_service_parse_seconds_count", response.body)
+
+
+class TooltipAppTest(AsyncHTTPTestCase):
+    def get_app(self):
+        self.key = script_key(SCRIPT)
+        store = ParseStore()
+        store.put(self.key, StructuredSAS(SCRIPT).execute_all_processing_steps())
+        self.service = LineageService(workers=0, store=store, allowed_origins=[ORIGIN])
+        return make_tooltip_app(self.service)
+
+    def test_serves_runs_only(self):
+        self.assertIsNone(self.service.executor)
+        response = self.fetch(f"/scripts/{self.key}/runs?dataset=c", headers={"Origin": ORIGIN})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(json.loads(response.body)["total"], 1)
+        self.assertEqual(response.headers["Access-Control-Allow-Origin"], ORIGIN)
+
+        self.assertEqual(self.fetch("/parse", method="POST", body=SCRIPT).code, 404)
+        for path in (f"/scripts/{self.key}/nodes", f"/scripts/{self.key}/upstream?dataset=c", "/stats", "/metrics"):
+            self.assertEqual(self.fetch(path).code, 404, path)
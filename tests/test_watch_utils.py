@@ -0,0 +1,74 @@
+import time
+
+from utils.watch_utils import LineageWatcher, MergedLineage
+
+DEBOUNCE = 0.05
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.02)
+    return condition()
+
+
+def start_counting(directory):
+    watcher = LineageWatcher(directory, debounce=DEBOUNCE)
+    refreshes = []
+    refresh = watcher.refresh
+
+    def counting_refresh(paths):
+        refreshes.append(set(paths))
+        return refresh(paths)
+
+    watcher.refresh = counting_refresh
+    watcher.start()
+    refreshes.clear()  # The initial scan
+    return watcher, refreshes
+
+
+def test_merged_lineage_patches_adjacency():
+    lineage = MergedLineage()
+    lineage.update_file("x.sas", ["a", "b"], [("a", "b")])
+    lineage.update_file("y.sas", ["a", "b", "c"], [("a", "b"), ("b", "c")])
+    assert sorted(lineage.reachable(["a"])) == ["a", "b", "c"]
+
+    lineage.remove_file("y.sas")
+    assert sorted(lineage.reachable(["a"])) == ["a", "b"]
+    assert lineage.hop_distances(["b"], "upstream") == {"b": 0, "a": 1}
+    assert lineage.update_file("x.sas", ["a", "b"], [("a", "b")]) is False
+
+
+def test_idle_directory_is_not_refreshed_by_reads(tmp_path):
+    program = tmp_path / "prog.sas"
+    program.write_text("data work.b;\n  set work.a;\nrun;\n")
+    watcher, refreshes = start_counting(tmp_path)
+    try:
+        for _ in range(3):
+            program.read_text()
+        time.sleep(10 * DEBOUNCE)
+        assert refreshes == []
+    finally:
+        watcher.stop()
+
+
+def test_saved_program_is_refreshed(tmp_path):
+    program = tmp_path / "prog.sas"
+    program.write_text("data work.b;\n  set work.a;\nrun;\n")
+    watcher, refreshes = start_counting(tmp_path)
+    try:
+        program.write_text("data work.c;\n  set work.b;\nrun;\n")
+        assert wait_for(lambda: "c" in watcher.lineage.nodes)
+        assert watcher.lineage.edges == [("b", "c")]
+
+        # The watcher's own parse of the saved file must not queue another refresh
+        count = len(refreshes)
+        time.sleep(10 * DEBOUNCE)
+        assert len(refreshes) == count
+
+        program.unlink()
+        assert wait_for(lambda: watcher.lineage.stats()["files"] == 0)
+    finally:
+        watcher.stop()
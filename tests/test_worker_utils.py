@@ -0,0 +1,74 @@
+import pickle
+import time
+
+import pytest
+
+from utils import worker_utils
+from utils.cache_utils import get_parse_store
+from utils.worker_utils import ParseJob, SharedParseProgress
+
+
+def script(name, runs=3):
+    return "".join(f"data work.{name}{i + 1};\n  set work.{name}{i};\nrun;\n\n" for i in range(runs))
+
+
+def wait_done(job, timeout=60):
+    deadline = time.monotonic() + timeout
+    while not job.done and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert job.done
+
+
+def test_shared_progress_crosses_processes_by_file():
+    progress = SharedParseProgress()
+    try:
+        worker_side = pickle.loads(pickle.dumps(progress))
+        worker_side.set_stage("parsing")
+        worker_side.start_sections(4)
+        worker_side.advance(sections=1, runs=3)
+        assert progress.snapshot() == {"stage": "parsing", "sections_total": 4, "sections_done": 1, "runs_done": 3}
+        assert progress.fraction == 0.25
+
+        progress.cancel()
+        with pytest.raises(worker_utils.ParseCancelled):
+            worker_side.check_cancelled()
+        worker_side.close()
+    finally:
+        progress.close()
+    # The last values stay readable
+    assert progress.snapshot()["runs_done"] == 3
+
+
+def test_job_parses_in_the_pool_into_the_store():
+    job = ParseJob(script("single"))
+    wait_done(job)
+    assert job.error is None and not job.cancelled
+    struct_SAS = job.result()
+    assert len(struct_SAS.edges) == 3
+    assert get_parse_store().get(job.key) is struct_SAS
+    assert job.progress.snapshot()["stage"] == "done"
+    assert job.key not in worker_utils._in_flight
+
+
+def test_identical_scripts_share_one_parse():
+    sas_script = script("shared", runs=2000)
+    first, second = ParseJob(sas_script), ParseJob(sas_script)
+    assert first._parse is second._parse
+    assert first.progress is second.progress
+
+    # One session cancelling doesn't cancel the other's parse
+    first.cancel()
+    assert first.done and first.cancelled
+    wait_done(second)
+    assert not second.cancelled
+    assert second.result() is not None
+
+
+def test_cancel_stops_the_parse():
+    job = ParseJob(script("cancelled", runs=20000))
+    job.cancel()
+    assert job.cancelled and job.result() is None and job.error is None
+    assert job.key not in worker_utils._in_flight
+    assert job._parse.progress.cancelled or job._parse.future.cancelled()
+    job._parse.finished.wait(60)
+    assert isinstance(job._parse.error, worker_utils.ParseCancelled)
@@ -0,0 +1,300 @@
+import os
+import sys
+import hashlib
+import threading
+from collections import OrderedDict
+
+from utils.metrics_utils import get_metrics
+
+# Default memory budget of the process-wide parse store, in MB
+PARSE_STORE_MAX_MB = int(os.environ.get("SAS2PY_PARSE_STORE_MB", 512))
+
+# Distinct run blocks whose extraction results the process-wide RunBlockStore keeps
+RUN_BLOCK_CACHE_SIZE = int(os.environ.get("SAS2PY_RUN_BLOCK_CACHE", 65536))
+
+
+def script_key(sas_script):
+    """
+    Content address of a SAS script. Identical uploads get identical keys, no matter who uploads them.
+    :param sas_script: str or bytes
+    :return: str, sha256 hex digest
+    """
+    if isinstance(sas_script, str):
+        sas_script = sas_script.encode("utf-8")
+    return hashlib.sha256(sas_script).hexdigest()
+
+
+def block_key(buf, start, end):
+    """
+    Content address of the exact text of a run block in a parse buffer. str and bytes (memory-mapped) buffers get
+    different keys, as offsets count characters in one and bytes in the other.
+    :return: str
+    """
+    data = buf[start:end]
+    if isinstance(data, str):
+        return "s" + hashlib.blake2b(data.encode("utf-8"), digest_size=16).hexdigest()
+    return "b" + hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def estimate_size(obj, skip=()):
+    """
+    Approximate deep size of an object in bytes. Follows dicts, lists, tuples, sets and object __dict__s,
+    counting every object once.
+    :param skip: objects that are neither counted nor followed
+    """
+    seen = {id(o) for o in skip}
+    size = 0
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+        elif hasattr(o, "__dict__"):
+            stack.append(vars(o))
+    return size
+
+
+class _Entry:
+    __slots__ = ("struct_SAS", "html", "size", "derived_size", "derived_signature")
+
+    def __init__(self, struct_SAS, size):
+        self.struct_SAS = struct_SAS
+        self.html = {}  # render key -> html str
+        self.size = size  # parse result, its derived caches and html
+        self.derived_size = 0
+        self.derived_signature = None
+
+
+class ParseStore:
+    """
+    Process-wide, content-addressed LRU store of parse results (StructuredSAS) and the graph HTML rendered from them.
+
+    Entries are keyed by `script_key` of the SAS script, so identical scripts uploaded by different sessions
+    are parsed and kept in memory once. Sessions hold only the key.
+    When the accounted memory goes over `max_bytes`, the least recently used entries are evicted.
+    Caches a parse result builds on demand after it's stored (lineage graph, hotspots, pruned graphs...) are
+    measured again whenever its `derived_signature` changed, on the next access of the entry.
+    """
+    def __init__(self, max_bytes=PARSE_STORE_MAX_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        :return: StructuredSAS stored under key, None if it was never stored or was evicted
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        self._reaccount(key, entry)
+        return entry.struct_SAS
+
+    def put(self, key, struct_SAS):
+        size = estimate_size(struct_SAS, skip=struct_SAS.derived_caches().values())
+        entry = _Entry(struct_SAS, size)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old.size
+            self._entries[key] = entry
+            self.total_bytes += size
+        self._reaccount(key, entry)
+        return struct_SAS
+
+    def _reaccount(self, key, entry):
+        """
+        Measures the derived caches of an entry if they changed since they were last measured, and evicts
+        entries if that puts the store over budget.
+        """
+        signature = entry.struct_SAS.derived_signature()
+        if signature == entry.derived_signature:
+            return
+        # Measured outside the lock, other sessions aren't blocked by it
+        derived_size = estimate_size(list(entry.struct_SAS.derived_caches().values()))
+        with self._lock:
+            if self._entries.get(key) is not entry:
+                return  # Evicted or replaced meanwhile
+            entry.size += derived_size - entry.derived_size
+            self.total_bytes += derived_size - entry.derived_size
+            entry.derived_size = derived_size
+            entry.derived_signature = signature
+            self._evict()
+
+    def get_html(self, key, render_key):
+        """
+        :param key: script key
+        :param render_key: hashable description of the rendering, e.g. layout name
+        :return: cached html str or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or render_key not in entry.html:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.html[render_key]
+
+    def put_html(self, key, render_key, html):
+        """
+        Stores rendered html next to its parse result. Ignored if the parse result is not (or no longer) stored.
+        """
+        size = sys.getsizeof(html)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return html
+            old = entry.html.get(render_key)
+            if old is not None:
+                entry.size -= sys.getsizeof(old)
+                self.total_bytes -= sys.getsizeof(old)
+            entry.html[render_key] = html
+            entry.size += size
+            self.total_bytes += size
+            self._entries.move_to_end(key)
+            self._evict()
+        # Rendering usually builds the caches it was rendered from
+        self._reaccount(key, entry)
+        return html
+
+    def _evict(self):
+        # The most recent entry is always kept, even if it alone is over budget
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            _, entry = self._entries.popitem(last=False)
+            self.total_bytes -= entry.size
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "total_bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+
+class RunBlockStore:
+    """
+    Process-wide LRU memo of what `parse_sas_script` extracts from a run block, keyed by `block_key` of its text.
+
+    Copy-pasted DATA/PROC steps, within one program or across the programs parsed by this process, are scanned
+    once: later copies get the memoized references shifted to their own offsets, and share the dataset name and
+    code hash strings of the first copy. Escaped (Mermaid) run code is shared the same way, see `escaped`.
+    """
+    def __init__(self, max_entries=RUN_BLOCK_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._blocks = OrderedDict()  # block key -> (input refs, output refs, code hash), offsets relative to block
+        self._escaped = OrderedDict()  # run code -> escaped run code
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        :return: (input_refs, output_refs, code_hash) memoized for a block key, None if not memoized
+        """
+        with self._lock:
+            entry = self._blocks.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._blocks.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, input_refs, output_refs, code_hash):
+        """
+        :param input_refs, output_refs: lists of (name, start, end), offsets relative to the start of the block
+        :param code_hash: run_code_hash of the block's code, or None
+        """
+        with self._lock:
+            self._blocks[key] = (input_refs, output_refs, code_hash)
+            self._blocks.move_to_end(key)
+            while len(self._blocks) > self.max_entries:
+                self._blocks.popitem(last=False)
+
+    def escaped(self, run_code, escape):
+        """
+        :param escape: function run code -> escaped run code, called only for code not seen before
+        :return: escape(run_code), one shared str for identical run code
+        """
+        with self._lock:
+            result = self._escaped.get(run_code)
+            if result is not None:
+                self._escaped.move_to_end(run_code)
+                return result
+        result = escape(run_code)
+        with self._lock:
+            result = self._escaped.setdefault(run_code, result)
+            while len(self._escaped) > self.max_entries:
+                self._escaped.popitem(last=False)
+        return result
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "blocks": len(self._blocks),
+                "escaped": len(self._escaped),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+_parse_store = None
+_run_block_store = None
+_parse_store_lock = threading.Lock()
+
+
+def get_parse_store():
+    """
+    :return: the ParseStore shared by every session of this process
+    """
+    global _parse_store
+    with _parse_store_lock:
+        if _parse_store is None:
+            _parse_store = ParseStore()
+            get_metrics().register_collector("parse_store", _parse_store.stats)
+    return _parse_store
+
+
+def get_run_block_store():
+    """
+    :return: the RunBlockStore shared by every parse of this process
+    """
+    global _run_block_store
+    with _parse_store_lock:
+        if _run_block_store is None:
+            _run_block_store = RunBlockStore()
+            get_metrics().register_collector("run_block_store", _run_block_store.stats)
+    return _run_block_store
@@ -0,0 +1,330 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import threading
+
+from utils.cache_utils import script_key
+
+# Programs written per transaction by index_directory: one commit (and WAL sync) per batch instead of per program
+INDEX_BATCH = int(os.environ.get("SAS2PY_CATALOG_BATCH", 200))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS programs (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    content_hash TEXT NOT NULL,
+    parsed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS datasets (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    program_id INTEGER NOT NULL REFERENCES programs(id) ON DELETE CASCADE,
+    section_index INTEGER NOT NULL,
+    run_index INTEGER NOT NULL,
+    start_offset INTEGER,
+    end_offset INTEGER,
+    first_line INTEGER,
+    last_line INTEGER
+);
+CREATE TABLE IF NOT EXISTS run_datasets (
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    dataset_id INTEGER NOT NULL REFERENCES datasets(id),
+    kind TEXT NOT NULL CHECK (kind IN ('input', 'output'))
+);
+CREATE TABLE IF NOT EXISTS edges (
+    program_id INTEGER NOT NULL REFERENCES programs(id) ON DELETE CASCADE,
+    src_id INTEGER NOT NULL REFERENCES datasets(id),
+    dst_id INTEGER NOT NULL REFERENCES datasets(id),
+    PRIMARY KEY (program_id, src_id, dst_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_runs_program ON runs(program_id);
+CREATE INDEX IF NOT EXISTS idx_run_datasets_run ON run_datasets(run_id);
+CREATE INDEX IF NOT EXISTS idx_run_datasets_dataset ON run_datasets(dataset_id, kind);
+CREATE INDEX IF NOT EXISTS idx_edges_src ON edges(src_id, dst_id);
+CREATE INDEX IF NOT EXISTS idx_edges_dst ON edges(dst_id, src_id);
+"""
+
+# Recursive lineage queries. Without a depth limit UNION removes repeated rows, so cycles terminate.
+_LINEAGE_SQL = {
+    "upstream": (
+        "WITH RECURSIVE walk(id) AS ("
+        " SELECT id FROM datasets WHERE name = ?"
+        " UNION SELECT e.src_id FROM edges e JOIN walk w ON e.dst_id = w.id)"
+        " SELECT d.name FROM walk JOIN datasets d ON d.id = walk.id WHERE d.name != ? ORDER BY d.name"
+    ),
+    "downstream": (
+        "WITH RECURSIVE walk(id) AS ("
+        " SELECT id FROM datasets WHERE name = ?"
+        " UNION SELECT e.dst_id FROM edges e JOIN walk w ON e.src_id = w.id)"
+        " SELECT d.name FROM walk JOIN datasets d ON d.id = walk.id WHERE d.name != ? ORDER BY d.name"
+    ),
+}
+_LINEAGE_DEPTH_SQL = {
+    "upstream": (
+        "WITH RECURSIVE walk(id, depth) AS ("
+        " SELECT id, 0 FROM datasets WHERE name = ?"
+        " UNION SELECT e.src_id, w.depth + 1 FROM edges e JOIN walk w ON e.dst_id = w.id WHERE w.depth < ?)"
+        " SELECT d.name, MIN(walk.depth) FROM walk JOIN datasets d ON d.id = walk.id"
+        " WHERE d.name != ? GROUP BY d.name ORDER BY d.name"
+    ),
+    "downstream": (
+        "WITH RECURSIVE walk(id, depth) AS ("
+        " SELECT id, 0 FROM datasets WHERE name = ?"
+        " UNION SELECT e.dst_id, w.depth + 1 FROM edges e JOIN walk w ON e.src_id = w.id WHERE w.depth < ?)"
+        " SELECT d.name, MIN(walk.depth) FROM walk JOIN datasets d ON d.id = walk.id"
+        " WHERE d.name != ? GROUP BY d.name ORDER BY d.name"
+    ),
+}
+
+
+class LineageCatalog:
+    """
+    SQLite catalog of parsed SAS programs: programs, runs, datasets and edges in indexed tables.
+
+    A program is upserted in a single transaction, index_directory writes INDEX_BATCH programs per transaction;
+    runs and edges are written with executemany.
+    Lineage questions are answered with recursive CTEs in SQLite, so the corpus doesn't need to fit in memory.
+    Connections are per thread, the database runs in WAL mode so readers don't block the writer.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        with self.connection() as con:
+            con.executescript(SCHEMA)
+
+    def connection(self):
+        con = getattr(self._local, "con", None)
+        if con is None:
+            con = sqlite3.connect(self.db_path, timeout=30)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")
+            con.execute("PRAGMA foreign_keys=ON")
+            self._local.con = con
+        return con
+
+    def close(self):
+        con = getattr(self._local, "con", None)
+        if con is not None:
+            con.close()
+            self._local.con = None
+
+    def program_hash(self, path):
+        row = self.connection().execute("SELECT content_hash FROM programs WHERE path = ?", (path,)).fetchone()
+        return row[0] if row else None
+
+    def _dataset_ids(self, con, names):
+        names = list(names)
+        con.executemany("INSERT OR IGNORE INTO datasets(name) VALUES (?)", ((name,) for name in names))
+        ids = {}
+        # Looked up in chunks to stay under SQLite's variable limit
+        for i in range(0, len(names), 500):
+            chunk = names[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            ids.update(con.execute(f"SELECT name, id FROM datasets WHERE name IN ({placeholders})", chunk))
+        return ids
+
+    def upsert_program(self, path, struct_SAS, content_hash=None):
+        """
+        Replaces everything stored for a program with its current parse.
+        :param path: program identifier, usually the file path
+        :param struct_SAS: StructuredSAS processed with execute_all_processing_steps
+        :param content_hash: hash of the program text, defaults to script_key of struct_SAS.raw_code
+        """
+        if content_hash is None:
+            content_hash = script_key(struct_SAS.raw_code) if isinstance(struct_SAS.raw_code, str) \
+                else script_key(bytes(struct_SAS.raw_code))
+        con = self.connection()
+        with con:
+            return self._write_program(con, path, struct_SAS, content_hash)
+
+    def _write_program(self, con, path, struct_SAS, content_hash):
+        """
+        upsert_program inside the caller's transaction.
+        """
+        con.execute(
+            "INSERT INTO programs(path, content_hash, parsed_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(path) DO UPDATE SET content_hash = excluded.content_hash, parsed_at = excluded.parsed_at",
+            (path, content_hash, time.time())
+        )
+        program_id = con.execute("SELECT id FROM programs WHERE path = ?", (path,)).fetchone()[0]
+        con.execute("DELETE FROM run_datasets WHERE run_id IN (SELECT id FROM runs WHERE program_id = ?)",
+                    (program_id,))
+        con.execute("DELETE FROM runs WHERE program_id = ?", (program_id,))
+        con.execute("DELETE FROM edges WHERE program_id = ?", (program_id,))
+
+        ids = self._dataset_ids(con, struct_SAS.nodes)
+
+        run_rows = []
+        for run in struct_SAS.struct_code:
+            spans = run.get("run_spans") or [(None, None)]
+            lines = run.get("run_lines") or [(None, None)]
+            run_rows.append((program_id, run["section_index"], run["run_index"],
+                             spans[0][0], spans[-1][1], lines[0][0], lines[-1][1]))
+        first_id = con.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM runs").fetchone()[0]
+        con.executemany(
+            "INSERT INTO runs(id, program_id, section_index, run_index, start_offset, end_offset, "
+            "first_line, last_line) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            ((first_id + i, *row) for i, row in enumerate(run_rows))
+        )
+        con.executemany(
+            "INSERT INTO run_datasets(run_id, dataset_id, kind) VALUES (?, ?, ?)",
+            ((first_id + i, ids[name], kind)
+             for i, run in enumerate(struct_SAS.struct_code)
+             for kind, key in (("input", "inputs"), ("output", "outputs"))
+             for name in set(run[key]) if name in ids)
+        )
+        con.executemany(
+            "INSERT OR IGNORE INTO edges(program_id, src_id, dst_id) VALUES (?, ?, ?)",
+            ((program_id, ids[u], ids[v]) for u, v in struct_SAS.edges)
+        )
+        return program_id
+
+    def remove_program(self, path):
+        con = self.connection()
+        with con:
+            return self._delete_program(con, path)
+
+    def _delete_program(self, con, path):
+        row = con.execute("SELECT id FROM programs WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return False
+        con.execute("DELETE FROM run_datasets WHERE run_id IN (SELECT id FROM runs WHERE program_id = ?)", (row[0],))
+        con.execute("DELETE FROM programs WHERE id = ?", (row[0],))
+        return True
+
+    def remove_missing(self, directory, seen):
+        """
+        Removes the programs under a directory that aren't in `seen`, e.g. files deleted since it was last indexed,
+        with their runs and edges, and the datasets no program refers to any more.
+        :param seen: set of absolute paths of the directory's current programs
+        :return: list of removed paths
+        """
+        removed = [path for path in self._directory_hashes(directory) if path not in seen]
+        if removed:
+            con = self.connection()
+            with con:
+                for path in removed:
+                    self._delete_program(con, path)
+                con.execute(
+                    "DELETE FROM datasets WHERE id NOT IN (SELECT dataset_id FROM run_datasets) "
+                    "AND id NOT IN (SELECT src_id FROM edges) AND id NOT IN (SELECT dst_id FROM edges)"
+                )
+        return removed
+
+    def _directory_hashes(self, directory):
+        """
+        :return: dict path -> content hash of the stored programs under a directory
+        """
+        prefix = os.path.join(os.path.abspath(directory), "")
+        return {path: content_hash
+                for path, content_hash in self.connection().execute("SELECT path, content_hash FROM programs")
+                if path.startswith(prefix)}
+
+    def index_directory(self, directory, patterns=(".sas", ".txt"), batch=INDEX_BATCH):
+        """
+        Parses and upserts every program of a directory whose content changed since it was last indexed, and
+        removes programs of the directory whose files are gone (see remove_missing).
+        Parsed programs are written `batch` at a time, each batch in one transaction.
+        :return: (number of programs (re)indexed, number of programs removed)
+        """
+        from utils.parse_utils import StructuredSAS
+
+        stored = self._directory_hashes(directory)
+        indexed = 0
+        seen = set()
+        pending = []  # (path, struct_SAS, content_hash) parsed but not written yet
+        for root, _, files in os.walk(directory):
+            for name in files:
+                if not name.lower().endswith(patterns):
+                    continue
+                path = os.path.abspath(os.path.join(root, name))
+                seen.add(path)
+                with open(path, "r", encoding="utf-8", errors="replace") as f:
+                    text = f.read()
+                content_hash = script_key(text)
+                if stored.get(path) == content_hash:
+                    continue
+                pending.append((path, StructuredSAS(text).execute_all_processing_steps(), content_hash))
+                if len(pending) >= batch:
+                    indexed += self._write_batch(pending)
+                    pending = []
+        indexed += self._write_batch(pending)
+        return indexed, len(self.remove_missing(directory, seen))
+
+    def _write_batch(self, programs):
+        """
+        Upserts (path, struct_SAS, content_hash) tuples in one transaction.
+        :return: number of programs written
+        """
+        if not programs:
+            return 0
+        con = self.connection()
+        with con:
+            for path, struct_SAS, content_hash in programs:
+                self._write_program(con, path, struct_SAS, content_hash)
+        return len(programs)
+
+    def lineage(self, dataset, direction="upstream", max_depth=None):
+        """
+        Ancestors (upstream) or descendants (downstream) of a dataset across every program in the catalog.
+        :param max_depth: limit on the number of hops, None for no limit
+        :return: list of dataset names, or of (name, hops) when max_depth is given
+        """
+        if direction not in _LINEAGE_SQL:
+            raise ValueError(f"direction must be 'upstream' or 'downstream', not {direction!r}")
+        con = self.connection()
+        if max_depth is None:
+            return [row[0] for row in con.execute(_LINEAGE_SQL[direction], (dataset, dataset))]
+        return con.execute(_LINEAGE_DEPTH_SQL[direction], (dataset, max_depth, dataset)).fetchall()
+
+    def ancestors(self, dataset, max_depth=None):
+        return self.lineage(dataset, "upstream", max_depth)
+
+    def descendants(self, dataset, max_depth=None):
+        return self.lineage(dataset, "downstream", max_depth)
+
+    def runs_of(self, dataset, kind=None):
+        """
+        :param kind: "input", "output" or None for both
+        :return: list of dicts: program path, run position and lines, and whether dataset is read or written there
+        """
+        sql = ("SELECT p.path, r.section_index, r.run_index, r.first_line, r.last_line, rd.kind "
+               "FROM datasets d JOIN run_datasets rd ON rd.dataset_id = d.id "
+               "JOIN runs r ON r.id = rd.run_id JOIN programs p ON p.id = r.program_id WHERE d.name = ?")
+        params = [dataset]
+        if kind is not None:
+            sql += " AND rd.kind = ?"
+            params.append(kind)
+        sql += " ORDER BY p.path, r.section_index, r.run_index"
+        columns = ("path", "section_index", "run_index", "first_line", "last_line", "kind")
+        return [dict(zip(columns, row)) for row in self.connection().execute(sql, params)]
+
+    def stats(self):
+        con = self.connection()
+        return {table: con.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                for table in ("programs", "runs", "datasets", "edges")}
+
+
+if __name__ == '__main__':
+    # Usage:
+    #   python -m utils.catalog_utils catalog.db index sas_code_dir
+    #   python -m utils.catalog_utils catalog.db upstream|downstream dataset [max_depth]
+    #   python -m utils.catalog_utils catalog.db runs dataset
+    catalog = LineageCatalog(sys.argv[1])
+    command = sys.argv[2]
+    if command == "index":
+        start = time.perf_counter()
+        indexed, removed = catalog.index_directory(sys.argv[3])
+        print(f"Indexed {indexed} programs, removed {removed} in {time.perf_counter() - start:.1f}s: {catalog.stats()}")
+        from utils.cache_utils import get_run_block_store
+        print(f"Duplicate run blocks: {get_run_block_store().stats()}")
+    elif command in ("upstream", "downstream"):
+        max_depth = int(sys.argv[4]) if len(sys.argv) > 4 else None
+        print(json.dumps(catalog.lineage(sys.argv[3], command, max_depth), indent=4))
+    elif command == "runs":
+        print(json.dumps(catalog.runs_of(sys.argv[3]), indent=4))
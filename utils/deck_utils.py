@@ -0,0 +1,144 @@
+import numpy as np
+
+from utils.graph_utils import LineageGraph
+from utils.metrics_utils import get_metrics
+
+# Distance between layers and between nodes of a layer, in deck.gl units
+X_GAP = 40.0
+Y_GAP = 4.0
+
+# Node labels are drawn as a text layer only up to this many nodes, hover shows names for larger graphs
+LABEL_LIMIT = 2000
+
+# RGBA colours of LineageGraph.roles
+ROLE_COLOURS = {
+    "source": [102, 194, 165, 220],
+    "intermediate": [141, 160, 203, 220],
+    "sink": [252, 141, 98, 220],
+}
+EDGE_COLOUR = [200, 200, 200, 60]
+
+
+def layered_positions(graph):
+    """
+    Layered layout computed with array operations: x is the topological depth of a node (LineageGraph.depth),
+    nodes of a layer are ordered by the mean position of their predecessors in earlier layers, so edges mostly run
+    straight. Linear in nodes and edges, which keeps 50k+ node graphs in the sub-second range.
+
+    :param graph: LineageGraph
+    :return: (x, y) float arrays
+    """
+    depth = graph.depth
+    x = depth * X_GAP
+    y = np.zeros(graph.n, dtype=np.float64)
+    if graph.n == 0:
+        return x, y
+
+    # Edges from an earlier layer, grouped by the layer of their target
+    forward = depth[graph.src] < depth[graph.dst]
+    e_src, e_dst = graph.src[forward], graph.dst[forward]
+    e_order = np.argsort(depth[e_dst], kind="stable")
+    e_src, e_dst = e_src[e_order], e_dst[e_order]
+    e_bounds = np.searchsorted(depth[e_dst], np.arange(depth.max() + 2))
+
+    n_order = np.argsort(depth, kind="stable")
+    n_bounds = np.searchsorted(depth[n_order], np.arange(depth.max() + 2))
+
+    local = np.zeros(graph.n, dtype=np.int64)  # position of a node within its layer
+    for layer in range(depth.max() + 1):
+        members = n_order[n_bounds[layer]:n_bounds[layer + 1]]
+        local[members] = np.arange(len(members))
+        src = e_src[e_bounds[layer]:e_bounds[layer + 1]]
+        dst = local[e_dst[e_bounds[layer]:e_bounds[layer + 1]]]
+        sums = np.bincount(dst, weights=y[src], minlength=len(members))
+        counts = np.bincount(dst, minlength=len(members))
+        # Nodes without predecessors keep their relative order, spread over the layer
+        barycenter = np.where(counts > 0, sums / np.maximum(counts, 1),
+                              (np.arange(len(members)) - len(members) / 2) * Y_GAP)
+        order = np.argsort(barycenter, kind="stable")
+        y[members[order]] = (np.arange(len(members)) - len(members) / 2) * Y_GAP
+    return x, y
+
+
+def _rgba(colour, alpha=220):
+    """
+    :param colour: "#rrggbb" or [r, g, b(, a)]
+    """
+    if isinstance(colour, str):
+        colour = colour.lstrip("#")
+        return [int(colour[i:i + 2], 16) for i in (0, 2, 4)] + [alpha]
+    return list(colour)
+
+
+@get_metrics().timed("layout_seconds", layout="deck")
+def create_deck_layout(graph, node_styles=None, height=600):
+    """
+    WebGL rendering of the lineage graph with pydeck (deck.gl): datasets as a scatterplot layer, edges as a line
+    layer, positions from layered_positions. Hovering a node shows its name and role, nodes can be picked
+    (selected) in st.pydeck_chart. The browser draws everything on the GPU, so this stays interactive for graphs far
+    larger than vis-network can handle.
+
+    :param graph: LineageGraph, or (nodes, edges) to build one from
+    :param node_styles: optional dict node -> {"size", "color"}, e.g. HotspotAnalysis.node_styles
+    :param height: int, height of the chart in pixels
+    :return: pydeck.Deck
+    """
+    import pydeck as pdk
+
+    if not isinstance(graph, LineageGraph):
+        graph = LineageGraph(*graph)
+    node_styles = node_styles or {}
+    x, y = layered_positions(graph)
+    roles = graph.roles
+    xs, ys = x.round(1).tolist(), y.round(1).tolist()
+
+    node_data = []
+    for i, node in enumerate(graph.nodes):
+        style = node_styles.get(node, {})
+        node_data.append({
+            "name": node,
+            "role": roles[i],
+            "position": [xs[i], ys[i]],
+            "radius": style.get("size", 8) / 2,
+            "color": _rgba(style["color"]) if "color" in style else ROLE_COLOURS[roles[i]],
+        })
+    edge_data = [
+        {"source": [xs[u], ys[u]], "target": [xs[v], ys[v]]}
+        for u, v in zip(graph.src.tolist(), graph.dst.tolist())
+    ]
+
+    layers = [
+        pdk.Layer(
+            "LineLayer", edge_data, id="edges",
+            get_source_position="source", get_target_position="target",
+            get_color=EDGE_COLOUR, get_width=1, width_units="pixels",
+        ),
+        pdk.Layer(
+            "ScatterplotLayer", node_data, id="datasets",
+            get_position="position", get_radius="radius", radius_units="pixels",
+            get_fill_color="color", pickable=True, auto_highlight=True,
+        ),
+    ]
+    if graph.n <= LABEL_LIMIT:
+        layers.append(pdk.Layer(
+            "TextLayer", node_data, id="labels",
+            get_position="position", get_text="name", get_size=11, get_color=[255, 255, 255, 200],
+            get_alignment_baseline="'top'", get_pixel_offset=[0, 8],
+        ))
+
+    # Fit the whole graph in an assumed 1000px wide view
+    width = max(float(x.max() - x.min()) if graph.n else 0.0, 1.0)
+    tall = max(float(y.max() - y.min()) if graph.n else 0.0, 1.0)
+    zoom = float(np.log2(min(1000.0 / width, height / tall)))
+    view_state = pdk.ViewState(
+        target=[float(x.mean()) if graph.n else 0.0, float(y.mean()) if graph.n else 0.0, 0],
+        zoom=zoom, min_zoom=zoom - 2, max_zoom=zoom + 12,
+    )
+    return pdk.Deck(
+        layers=layers,
+        views=[pdk.View(type="OrthographicView", controller=True)],
+        initial_view_state=view_state,
+        map_style=None,
+        tooltip={"text": "{name}\n{role}"},
+        height=height,
+    )
@@ -0,0 +1,154 @@
+import sys
+import json
+from collections import Counter
+
+from utils.parse_utils import StructuredSAS
+from utils.cache_utils import script_key
+
+
+def get_parsed(sas_script, store=None):
+    """
+    Parses a SAS script, or takes its parse from a ParseStore if it's there.
+    :param sas_script: str
+    :param store: optional utils.cache_utils.ParseStore
+    :return: StructuredSAS
+    """
+    if store is None:
+        return StructuredSAS(sas_script).execute_all_processing_steps()
+    key = script_key(sas_script)
+    struct_SAS = store.get(key)
+    if struct_SAS is None:
+        struct_SAS = store.put(key, StructuredSAS(sas_script).execute_all_processing_steps())
+    return struct_SAS
+
+
+class SASDiff:
+    """
+    Impact analysis between two versions of a SAS program.
+
+    Runs are matched by the content hash of their code together with their inputs and outputs, datasets by name.
+    Changed edges and the datasets touched by added/removed runs seed a reachability search over the lineage graph,
+    which gives the downstream datasets, and the final outputs, affected by the change.
+
+    Usage:
+    >>> diff = SASDiff(old_struct_SAS, new_struct_SAS).compare()
+    >>> diff.summary()
+    """
+    def __init__(self, old, new):
+        """
+        :param old: StructuredSAS of the old version, processed with execute_all_processing_steps
+        :param new: StructuredSAS of the new version, processed with execute_all_processing_steps
+        """
+        self.old = old
+        self.new = new
+        self.added_runs = None
+        self.removed_runs = None
+        self.unchanged_runs = None
+        self.added_datasets = None
+        self.removed_datasets = None
+        self.added_edges = None
+        self.removed_edges = None
+        self.impacted_datasets = None
+        self.impacted_outputs = None
+
+    @staticmethod
+    def run_key(struct_SAS, run):
+        return (
+            struct_SAS.get_code_hash(run),
+            tuple(sorted(run["inputs"])),
+            tuple(sorted(run["outputs"])),
+        )
+
+    def match_runs(self):
+        """
+        Matches runs of both versions as multisets of run keys: a run that appears twice in the old version
+        and once in the new one is one removed run.
+        """
+        old_runs = {}
+        for run in self.old.struct_code:
+            old_runs.setdefault(self.run_key(self.old, run), []).append(run)
+        new_runs = {}
+        for run in self.new.struct_code:
+            new_runs.setdefault(self.run_key(self.new, run), []).append(run)
+
+        old_counts = Counter({k: len(v) for k, v in old_runs.items()})
+        new_counts = Counter({k: len(v) for k, v in new_runs.items()})
+
+        self.removed_runs = [run for k, n in (old_counts - new_counts).items() for run in old_runs[k][-n:]]
+        self.added_runs = [run for k, n in (new_counts - old_counts).items() for run in new_runs[k][-n:]]
+        self.unchanged_runs = sum((old_counts & new_counts).values())
+        return self
+
+    def compare_graphs(self):
+        old_nodes, new_nodes = set(self.old.nodes), set(self.new.nodes)
+        old_edges, new_edges = set(self.old.edges), set(self.new.edges)
+
+        self.added_datasets = sorted(new_nodes - old_nodes)
+        self.removed_datasets = sorted(old_nodes - new_nodes)
+        self.added_edges = sorted(new_edges - old_edges)
+        self.removed_edges = sorted(old_edges - new_edges)
+        return self
+
+    def compute_impact(self):
+        """
+        Datasets affected by the change: everything downstream of changed edges, added datasets and outputs of
+        added/removed runs in the new graph, plus whatever used to be downstream of removed datasets and is
+        still there.
+        """
+        seeds = set(self.added_datasets)
+        seeds.update(v for _, v in self.added_edges)
+        seeds.update(v for _, v in self.removed_edges)
+        for run in self.added_runs + self.removed_runs:
+            seeds.update(run["outputs"])
+
+        new_graph = self.new.get_lineage_graph()
+        impacted = set(new_graph.reachable(seeds, "downstream"))
+
+        if self.removed_datasets:
+            old_downstream = self.old.get_lineage_graph().reachable(self.removed_datasets, "downstream")
+            impacted.update(ds for ds in old_downstream if ds in new_graph.index)
+            impacted.update(new_graph.reachable(impacted, "downstream"))
+
+        roles = new_graph.roles
+        self.impacted_datasets = sorted(impacted)
+        self.impacted_outputs = sorted(ds for ds in impacted if roles[new_graph.index[ds]] == "sink")
+        return self
+
+    def compare(self):
+        return self.match_runs().compare_graphs().compute_impact()
+
+    def summary(self):
+        """
+        :return: dict, JSON serializable
+        """
+        return {
+            "runs": {
+                "added": len(self.added_runs),
+                "removed": len(self.removed_runs),
+                "unchanged": self.unchanged_runs,
+            },
+            "added_datasets": self.added_datasets,
+            "removed_datasets": self.removed_datasets,
+            "added_edges": self.added_edges,
+            "removed_edges": self.removed_edges,
+            "impacted_datasets": self.impacted_datasets,
+            "impacted_outputs": self.impacted_outputs,
+        }
+
+
+def diff_scripts(old_script, new_script, store=None):
+    """
+    :param old_script: str, old version of SAS program
+    :param new_script: str, new version of SAS program
+    :param store: optional ParseStore, versions already in it aren't parsed again
+    :return: SASDiff
+    """
+    return SASDiff(get_parsed(old_script, store), get_parsed(new_script, store)).compare()
+
+
+if __name__ == '__main__':
+    # Usage: python -m utils.diff_utils old.sas new.sas
+    old_path, new_path = sys.argv[1], sys.argv[2]
+    old_SAS = StructuredSAS.from_file(old_path).execute_all_processing_steps()
+    new_SAS = StructuredSAS.from_file(new_path).execute_all_processing_steps()
+    print(json.dumps(SASDiff(old_SAS, new_SAS).compare().summary(), indent=4))
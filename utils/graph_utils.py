@@ -0,0 +1,446 @@
+import time
+import json
+import hashlib
+import threading
+import numpy as np
+from functools import cached_property
+from collections import OrderedDict
+
+# Layer modes of LineageGraph.layers
+LAYER_MODES = ("depth", "role")
+
+# Layers of the "role" mode
+ROLE_LAYERS = {"source": 0, "intermediate": 1, "sink": 2}
+
+# Target components per pass of the bitset reachability of transitive_reduction_dag: memory of a pass is
+# (components x REDUCTION_BLOCK) bits
+REDUCTION_BLOCK = 4096
+
+# Graphs whose transitive reduction is kept by transitive_reduction, by fingerprint
+REDUCTION_CACHE_SIZE = 32
+
+
+def _csr(src, dst, n):
+    """
+    Compressed adjacency of edges src -> dst over n nodes.
+    :return: (indptr, indices), successors of node i are indices[indptr[i]:indptr[i + 1]]
+    """
+    order = np.argsort(src, kind="stable")
+    indices = dst[order]
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=n), out=indptr[1:])
+    return indptr, indices
+
+
+def gather_neighbours(indptr, indices, frontier):
+    """
+    Vectorized lookup of the neighbours of every node in frontier.
+    :return: int array, concatenated neighbours (with repetitions)
+    """
+    starts = indptr[frontier]
+    counts = indptr[frontier + 1] - starts
+    total = int(counts.sum())
+    if total == 0:
+        return np.empty(0, dtype=indices.dtype)
+    offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    return indices[offsets + np.arange(total)]
+
+
+def strongly_connected_components(indptr, indices, n):
+    """
+    Iterative Tarjan's algorithm over a CSR adjacency.
+    :return: (labels, n_components), labels[i] is the component of node i.
+             Components are numbered in reverse topological order of the condensation.
+    """
+    indptr_l = indptr.tolist()
+    indices_l = indices.tolist()
+    index_of = [-1] * n
+    lowlink = [0] * n
+    on_stack = [False] * n
+    labels = [-1] * n
+    stack = []
+    counter = 0
+    n_components = 0
+
+    for root in range(n):
+        if index_of[root] != -1:
+            continue
+        work = [(root, indptr_l[root])]
+        index_of[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        while work:
+            v, pos = work[-1]
+            end = indptr_l[v + 1]
+            descended = False
+            while pos < end:
+                w = indices_l[pos]
+                pos += 1
+                if index_of[w] == -1:
+                    work[-1] = (v, pos)
+                    index_of[w] = lowlink[w] = counter
+                    counter += 1
+                    stack.append(w)
+                    on_stack[w] = True
+                    work.append((w, indptr_l[w]))
+                    descended = True
+                    break
+                elif on_stack[w] and index_of[w] < lowlink[v]:
+                    lowlink[v] = index_of[w]
+            if descended:
+                continue
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                if lowlink[v] < lowlink[parent]:
+                    lowlink[parent] = lowlink[v]
+            if lowlink[v] == index_of[v]:
+                while True:
+                    w = stack.pop()
+                    on_stack[w] = False
+                    labels[w] = n_components
+                    if w == v:
+                        break
+                n_components += 1
+
+    return np.asarray(labels, dtype=np.int64), n_components
+
+
+def transitive_reduction_dag(c_src, c_dst, k, block=REDUCTION_BLOCK):
+    """
+    Transitive reduction of a DAG: an edge u -> v is redundant if v can be reached from another successor of u.
+
+    Reachability is kept as bitsets, one row of uint64 words per node, filled level by level from the sinks up,
+    each level with array operations: the nodes a node reaches through its successors are the OR of their rows.
+    Targets are processed in blocks of `block` nodes, so memory stays at k * block bits whatever the size of the graph.
+
+    :param c_src, c_dst: int arrays of edges without duplicates, every edge from a higher to a lower node number
+                         (reverse topological order, as the condensation of LineageGraph)
+    :param k: number of nodes
+    :return: bool array, True for edges of the reduction
+    """
+    keep = np.ones(len(c_src), dtype=bool)
+    if not len(c_src):
+        return keep
+
+    # Levels by height: sinks first, every node after all its successors
+    out_degree = np.bincount(c_src, minlength=k)
+    pred_indptr, pred_indices = _csr(c_dst, c_src, k)
+    height = np.zeros(k, dtype=np.int64)
+    frontier = np.flatnonzero(out_degree == 0)
+    n_levels = 0
+    while frontier.size:
+        height[frontier] = n_levels
+        preds, counts = np.unique(gather_neighbours(pred_indptr, pred_indices, frontier), return_counts=True)
+        out_degree[preds] -= counts
+        frontier = preds[out_degree[preds] == 0]
+        n_levels += 1
+
+    # Edges grouped by the level of their source. Sinks (level 0) have none.
+    edge_order = np.argsort(height[c_src], kind="stable")
+    edge_bounds = np.searchsorted(height[c_src][edge_order], np.arange(n_levels + 1))
+
+    for b0 in range(0, k, block):
+        words = (min(b0 + block, k) - b0 + 63) // 64
+        reach = np.zeros((k, words), dtype=np.uint64)
+        for level in range(1, n_levels):
+            e = edge_order[edge_bounds[level]:edge_bounds[level + 1]]
+            if not e.size:
+                continue
+            u, v = c_src[e], c_dst[e]
+            sources, local = np.unique(u, return_inverse=True)
+            # Reached through a successor, the successors themselves not included
+            through = np.zeros((len(sources), words), dtype=np.uint64)
+            np.bitwise_or.at(through, local, reach[v])
+
+            in_block = (v >= b0) & (v < b0 + block)
+            offset = v[in_block] - b0
+            word, bit = offset // 64, (offset % 64).astype(np.uint64)
+            redundant = (through[local[in_block], word] >> bit) & np.uint64(1)
+            keep[e[in_block][redundant.astype(bool)]] = False
+
+            np.bitwise_or.at(through, (local[in_block], word), np.left_shift(np.uint64(1), bit))
+            reach[sources] = through
+    return keep
+
+
+def graph_fingerprint(nodes, edges):
+    """
+    Content address of a graph, independent of the order of nodes and edges.
+    :return: str, sha1 hex digest
+    """
+    data = json.dumps([sorted(nodes), sorted(edges)], separators=(",", ":"))
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+_reductions = OrderedDict()
+_reductions_lock = threading.Lock()
+
+
+def transitive_reduction(nodes, edges):
+    """
+    Edges of the transitive reduction of a lineage graph, computed on its condensation (see transitive_reduction_dag),
+    so cycles are allowed: edges within a strongly connected component are all kept, and an edge between two
+    components is kept if the condensation edge it belongs to is. On a DAG this is the exact transitive reduction.
+    Results are cached per graph_fingerprint, so another view of the same graph isn't reduced again.
+
+    :param nodes: list of node names
+    :param edges: list of (source, target)
+    :return: (edges of the reduction in input order, report dict: edges, kept, removed, removed_ratio, seconds)
+    """
+    edges = list(dict.fromkeys(edges))
+    fingerprint = graph_fingerprint(nodes, edges)
+    with _reductions_lock:
+        cached = _reductions.get(fingerprint)
+        if cached is not None:
+            _reductions.move_to_end(fingerprint)
+            return cached
+
+    start = time.perf_counter()
+    graph = LineageGraph(nodes, edges)
+    labels, _ = graph.scc
+    c_src, c_dst, k = graph.condensation
+    keep_component_edge = transitive_reduction_dag(c_src, c_dst, k)
+    kept_pairs = (c_src * k + c_dst)[keep_component_edge]
+
+    e_src, e_dst = labels[graph.src], labels[graph.dst]
+    keep = (e_src == e_dst) | np.isin(e_src * k + e_dst, kept_pairs)
+    reduced = [edge for edge, kept in zip(edges, keep.tolist()) if kept]
+    report = {
+        "edges": len(edges),
+        "kept": len(reduced),
+        "removed": len(edges) - len(reduced),
+        "removed_ratio": (len(edges) - len(reduced)) / len(edges) if edges else 0.0,
+        "seconds": time.perf_counter() - start,
+    }
+
+    with _reductions_lock:
+        _reductions[fingerprint] = (reduced, report)
+        while len(_reductions) > REDUCTION_CACHE_SIZE:
+            _reductions.popitem(last=False)
+    return reduced, report
+
+
+class LineageGraph:
+    """
+    Array representation of the lineage graph (datasets as nodes, input -> output as edges).
+
+    Nodes are numbered by their position in `nodes`, edges are kept as numpy arrays `src`, `dst` of node numbers.
+    Derived structures (adjacency, strongly connected components, condensation, layers) are computed on first use
+    and cached on the object, so keep one LineageGraph per graph (see StructuredSAS.get_lineage_graph).
+    """
+    def __init__(self, nodes, edges):
+        self.nodes = list(nodes)
+        self.index = {node: i for i, node in enumerate(self.nodes)}
+        self.n = len(self.nodes)
+        self.src = np.fromiter((self.index[u] for u, _ in edges), dtype=np.int64, count=len(edges))
+        self.dst = np.fromiter((self.index[v] for _, v in edges), dtype=np.int64, count=len(edges))
+        self._layers = {}
+
+    @cached_property
+    def out_adjacency(self):
+        """(indptr, indices) of successors"""
+        return _csr(self.src, self.dst, self.n)
+
+    @cached_property
+    def in_adjacency(self):
+        """(indptr, indices) of predecessors"""
+        return _csr(self.dst, self.src, self.n)
+
+    @cached_property
+    def in_degree(self):
+        return np.bincount(self.dst, minlength=self.n)
+
+    @cached_property
+    def out_degree(self):
+        return np.bincount(self.src, minlength=self.n)
+
+    @cached_property
+    def scc(self):
+        """
+        :return: (labels, n_components) of strongly connected components
+        """
+        indptr, indices = self.out_adjacency
+        return strongly_connected_components(indptr, indices, self.n)
+
+    @cached_property
+    def condensation(self):
+        """
+        DAG of strongly connected components, without self loops and duplicate edges.
+        :return: (c_src, c_dst, n_components)
+        """
+        labels, n_components = self.scc
+        c_src, c_dst = labels[self.src], labels[self.dst]
+        keep = c_src != c_dst
+        pairs = np.unique(c_src[keep] * n_components + c_dst[keep])
+        return pairs // n_components, pairs % n_components, n_components
+
+    @cached_property
+    def weak_components(self):
+        """
+        Weakly connected components: strongly connected components of the graph with every edge in both directions.
+        :return: (labels, n_components)
+        """
+        both_src = np.concatenate([self.src, self.dst])
+        both_dst = np.concatenate([self.dst, self.src])
+        return strongly_connected_components(*_csr(both_src, both_dst, self.n), self.n)
+
+    @cached_property
+    def depth(self):
+        """
+        Topological depth of every node: length of the longest path from a source to its component
+        in the condensation. Nodes of one cycle share a depth.
+        Computed level by level (Kahn's algorithm), each level vectorized.
+        :return: int array, depth per node
+        """
+        labels, _ = self.scc
+        c_src, c_dst, n_components = self.condensation
+        indptr, indices = _csr(c_src, c_dst, n_components)
+        in_degree = np.bincount(c_dst, minlength=n_components)
+
+        component_depth = np.zeros(n_components, dtype=np.int64)
+        frontier = np.flatnonzero(in_degree == 0)
+        level = 0
+        while frontier.size:
+            component_depth[frontier] = level
+            successors, counts = np.unique(gather_neighbours(indptr, indices, frontier), return_counts=True)
+            in_degree[successors] -= counts
+            frontier = successors[in_degree[successors] == 0]
+            level += 1
+        return component_depth[labels]
+
+    @cached_property
+    def roles(self):
+        """
+        :return: str array, 'source' (nothing flows in), 'sink' (nothing flows out) or 'intermediate' per node
+        """
+        roles = np.full(self.n, "intermediate", dtype=object)
+        roles[self.out_degree == 0] = "sink"
+        roles[self.in_degree == 0] = "source"
+        return roles
+
+    def hop_distances(self, start_nodes, direction="downstream", max_hops=None):
+        """
+        Breadth-first search from start_nodes over the cached adjacency, one vectorized step per hop.
+        :param start_nodes: iterable of node names, names not in the graph are ignored
+        :param direction: "downstream" follows edges, "upstream" follows them backwards
+        :param max_hops: stop after this many hops, None for no limit
+        :return: int array, hops from the nearest start node per node, -1 where not reached
+        """
+        if direction == "downstream":
+            indptr, indices = self.out_adjacency
+        elif direction == "upstream":
+            indptr, indices = self.in_adjacency
+        else:
+            raise ValueError(f"direction must be 'downstream' or 'upstream', not {direction!r}")
+
+        distances = np.full(self.n, -1, dtype=np.int64)
+        frontier = np.unique(np.fromiter((self.index[n] for n in start_nodes if n in self.index), dtype=np.int64))
+        distances[frontier] = 0
+        hops = 0
+        while frontier.size and (max_hops is None or hops < max_hops):
+            hops += 1
+            neighbours = np.unique(gather_neighbours(indptr, indices, frontier))
+            frontier = neighbours[distances[neighbours] == -1]
+            distances[frontier] = hops
+        return distances
+
+    def reachable(self, start_nodes, direction="downstream", max_hops=None):
+        """
+        :return: list of node names reachable from start_nodes (start nodes included)
+        """
+        distances = self.hop_distances(start_nodes, direction, max_hops)
+        return [self.nodes[i] for i in np.flatnonzero(distances >= 0)]
+
+    def neighbourhood(self, center, upstream_hops=1, downstream_hops=1):
+        """
+        Ego network of a node: everything within upstream_hops against the edges and downstream_hops along them,
+        with the edges between those nodes. Uses the cached adjacency, the rest of the graph isn't touched or copied.
+        :param center: node name
+        :param upstream_hops: int, None for no limit
+        :param downstream_hops: int, None for no limit
+        :return: (nodes, edges, hops), hops is a dict node -> hops from center, negative upstream
+        """
+        if center not in self.index:
+            raise KeyError(f"{center!r} is not a node of the graph")
+        upstream = self.hop_distances([center], "upstream", upstream_hops)
+        downstream = self.hop_distances([center], "downstream", downstream_hops)
+        down_idx = np.flatnonzero(downstream >= 0)
+        # Nodes both upstream and downstream (on a cycle through center) are listed once, as downstream
+        up_idx = np.flatnonzero((upstream > 0) & (downstream < 0))
+
+        hops = {self.nodes[i]: -int(upstream[i]) for i in up_idx}
+        hops.update((self.nodes[i], int(downstream[i])) for i in down_idx)
+        selected = np.concatenate([up_idx, down_idx])
+
+        indptr, indices = self.out_adjacency
+        counts = indptr[selected + 1] - indptr[selected]
+        src = np.repeat(selected, counts)
+        dst = gather_neighbours(indptr, indices, selected)
+        keep = (upstream[dst] > 0) | (downstream[dst] >= 0)
+        pairs = np.unique(src[keep] * self.n + dst[keep])
+
+        nodes = [self.nodes[i] for i in selected]
+        edges = [(self.nodes[u], self.nodes[v]) for u, v in zip((pairs // self.n).tolist(), (pairs % self.n).tolist())]
+        return nodes, edges, hops
+
+    def layers(self, mode="depth"):
+        """
+        Layer of every node, for layered layouts.
+        :param mode: "depth" - topological depth over the SCC condensation,
+                     "role" - 0 for sources, 1 for intermediates, 2 for sinks
+        :return: dict node -> layer
+        """
+        if mode not in self._layers:
+            if mode == "depth":
+                values = self.depth.tolist()
+            elif mode == "role":
+                values = [ROLE_LAYERS[role] for role in self.roles]
+            else:
+                raise ValueError(f"mode must be one of {LAYER_MODES}, not {mode!r}")
+            self._layers[mode] = dict(zip(self.nodes, values))
+        return self._layers[mode]
+
+
+def prune_graph(nodes, edges, node_classes, drop=(), collapse_pass_through=False):
+    """
+    Shrinks a graph for rendering (see StructuredSAS.classify_datasets for the classes).
+    Pass-through nodes are collapsed first, so a chain ending in a dropped node still disappears.
+
+    :param nodes: list of nodes
+    :param edges: list of (u, v)
+    :param node_classes: dict node -> class
+    :param drop: classes of nodes to remove together with their edges
+    :param collapse_pass_through: replace u -> p1 -> ... -> pk -> v by u -> v, where p1...pk are 'pass_through'
+    :return: (nodes, edges), in the order of the input
+    """
+    edges = list(dict.fromkeys(edges))
+    if collapse_pass_through:
+        successor = {}
+        for u, v in edges:
+            if node_classes.get(u) == "pass_through":
+                successor[u] = v
+        collapsed = []
+        reached = set()
+        for u, v in edges:
+            if u in successor:
+                continue
+            seen = set()
+            while v in successor and v not in seen:
+                seen.add(v)
+                v = successor[v]
+            reached |= seen
+            if u != v:
+                collapsed.append((u, v))
+        # Cycles made only of pass-through nodes aren't reached from outside and stay as they are
+        collapsed.extend((u, v) for u, v in edges if u in successor and u not in reached)
+        removed = reached
+        edges = list(dict.fromkeys(collapsed))
+    else:
+        removed = set()
+
+    removed |= {node for node in nodes if node_classes.get(node) in drop}
+    nodes = [node for node in nodes if node not in removed]
+    edges = [(u, v) for u, v in edges if u not in removed and v not in removed]
+    return nodes, edges
@@ -0,0 +1,295 @@
+import os
+import sys
+import json
+import numpy as np
+from functools import cached_property
+
+from utils.graph_utils import _csr, gather_neighbours
+
+# Metrics of HotspotAnalysis, for ranking and node styling
+HOTSPOT_METRICS = ("pagerank", "betweenness", "fan_in", "fan_out", "critical_path")
+
+# Betweenness is estimated from this many BFS sources (Brandes' algorithm on a sample). Exact on smaller graphs.
+BETWEENNESS_SAMPLES = int(os.environ.get("SAS2PY_BETWEENNESS_SAMPLES", 128))
+
+# Node colours of node_styles, from least to most central
+HEAT_COLOURS = ("#4575b4", "#91bfdb", "#fee090", "#fc8d59", "#d73027")
+
+
+def frontier_edges(indptr, indices, frontier):
+    """
+    Like gather_neighbours, but also returns the frontier node every neighbour was reached from.
+    :return: (sources, neighbours), int arrays of equal length
+    """
+    counts = indptr[frontier + 1] - indptr[frontier]
+    return np.repeat(frontier, counts), gather_neighbours(indptr, indices, frontier)
+
+
+def longest_paths(indptr, indices, weights):
+    """
+    Heaviest path ending in every node of a DAG, level by level (Kahn's algorithm), each level vectorized.
+    :param indptr, indices: CSR adjacency of the DAG
+    :param weights: weight of every node
+    :return: float array, weight of the heaviest path ending in each node (the node included)
+    """
+    n = len(weights)
+    in_degree = np.bincount(indices, minlength=n)
+    best_in = np.zeros(n, dtype=np.float64)
+    result = np.zeros(n, dtype=np.float64)
+    frontier = np.flatnonzero(in_degree == 0)
+    while frontier.size:
+        result[frontier] = best_in[frontier] + weights[frontier]
+        sources, successors = frontier_edges(indptr, indices, frontier)
+        np.maximum.at(best_in, successors, result[sources])
+        unique, counts = np.unique(successors, return_counts=True)
+        in_degree[unique] -= counts
+        frontier = unique[in_degree[unique] == 0]
+    return result
+
+
+def pagerank(src, dst, n, damping=0.85, tol=1e-10, max_iter=200):
+    """
+    PageRank by power iteration. Rank of datasets without outputs is spread evenly over all datasets.
+    :param src, dst: int arrays of edges, without duplicates
+    :return: float array, sums to 1
+    """
+    if n == 0:
+        return np.zeros(0)
+    out_degree = np.bincount(src, minlength=n).astype(np.float64)
+    dangling = out_degree == 0
+    inv_out = np.divide(1.0, out_degree, out=np.zeros(n), where=~dangling)
+    rank = np.full(n, 1.0 / n)
+    for _ in range(max_iter):
+        new = damping * np.bincount(dst, weights=(rank * inv_out)[src], minlength=n)
+        new += (damping * rank[dangling].sum() + 1.0 - damping) / n
+        converged = np.abs(new - rank).sum() < n * tol
+        rank = new
+        if converged:
+            break
+    return rank
+
+
+def betweenness(indptr, indices, n, samples=BETWEENNESS_SAMPLES, seed=42):
+    """
+    Betweenness centrality of a directed graph with Brandes' algorithm: one BFS per source, counting shortest
+    paths forward and accumulating dependencies backward, level by level with array operations.
+    With more nodes than `samples`, only `samples` random sources are used and the result is scaled up.
+    :return: float array, normalized by (n - 1)(n - 2) as in networkx
+    """
+    result = np.zeros(n, dtype=np.float64)
+    if n < 3:
+        return result
+    if n <= samples:
+        sources = np.arange(n)
+    else:
+        sources = np.random.default_rng(seed).choice(n, size=samples, replace=False)
+
+    distance = np.full(n, -1, dtype=np.int64)
+    sigma = np.zeros(n, dtype=np.float64)
+    delta = np.zeros(n, dtype=np.float64)
+    for s in sources:
+        distance[:] = -1
+        sigma[:] = 0.0
+        delta[:] = 0.0
+        distance[s] = 0
+        sigma[s] = 1.0
+        levels = []  # edges on shortest paths, per BFS level
+        frontier = np.array([s])
+        level = 0
+        while frontier.size:
+            u, v = frontier_edges(indptr, indices, frontier)
+            new = np.unique(v[distance[v] == -1])
+            distance[new] = level + 1
+            on_path = distance[v] == level + 1
+            u, v = u[on_path], v[on_path]
+            np.add.at(sigma, v, sigma[u])
+            levels.append((u, v))
+            frontier = new
+            level += 1
+        for u, v in reversed(levels):
+            np.add.at(delta, u, sigma[u] / sigma[v] * (1.0 + delta[v]))
+        delta[s] = 0.0
+        result += delta
+
+    return result * (n / len(sources)) / ((n - 1) * (n - 2))
+
+
+class HotspotAnalysis:
+    """
+    Bottleneck analytics of a lineage graph (utils.graph_utils.LineageGraph): fan-in/fan-out, PageRank,
+    betweenness, and the critical path, i.e. the longest chain of dependencies, which bounds the runtime of a batch.
+
+    Cycles are handled on the condensation: the datasets of one cycle count together on a path.
+    Every metric is computed on first use and cached on the object (see StructuredSAS.get_hotspots).
+
+    Usage:
+    >>> hotspots = struct_SAS.get_hotspots()
+    >>> hotspots.table("pagerank", top=20)
+    """
+    def __init__(self, graph, betweenness_samples=BETWEENNESS_SAMPLES):
+        self.graph = graph
+        self.betweenness_samples = betweenness_samples
+
+    @cached_property
+    def simple_edges(self):
+        """
+        (src, dst) without duplicate edges and self loops
+        """
+        g = self.graph
+        keep = g.src != g.dst
+        pairs = np.unique(g.src[keep] * g.n + g.dst[keep])
+        return pairs // max(g.n, 1), pairs % max(g.n, 1)
+
+    @cached_property
+    def fan_in(self):
+        return np.bincount(self.simple_edges[1], minlength=self.graph.n)
+
+    @cached_property
+    def fan_out(self):
+        return np.bincount(self.simple_edges[0], minlength=self.graph.n)
+
+    def degree_distribution(self):
+        """
+        :return: {"fan_in": {degree: number of datasets}, "fan_out": {...}}
+        """
+        result = {}
+        for name, degrees in (("fan_in", self.fan_in), ("fan_out", self.fan_out)):
+            counts = np.bincount(degrees)
+            result[name] = {int(d): int(counts[d]) for d in np.flatnonzero(counts)}
+        return result
+
+    @cached_property
+    def pagerank(self):
+        src, dst = self.simple_edges
+        return pagerank(src, dst, self.graph.n)
+
+    @cached_property
+    def betweenness(self):
+        src, dst = self.simple_edges
+        indptr, indices = _csr(src, dst, self.graph.n)
+        return betweenness(indptr, indices, self.graph.n, self.betweenness_samples)
+
+    @cached_property
+    def _path_lengths(self):
+        """
+        (longest path ending in, longest path starting at) every component of the condensation,
+        in number of datasets
+        """
+        labels, _ = self.graph.scc
+        c_src, c_dst, k = self.graph.condensation
+        weights = np.bincount(labels, minlength=k).astype(np.float64)
+        to_component = longest_paths(*_csr(c_src, c_dst, k), weights)
+        from_component = longest_paths(*_csr(c_dst, c_src, k), weights)
+        return to_component, from_component, weights
+
+    @cached_property
+    def critical_path_length(self):
+        """
+        :return: int array, datasets on the longest dependency chain through each dataset
+        """
+        labels, _ = self.graph.scc
+        to_component, from_component, weights = self._path_lengths
+        return (to_component + from_component - weights).astype(np.int64)[labels]
+
+    @cached_property
+    def critical_path(self):
+        """
+        :return: list of dataset names on the longest dependency chain, from source to sink.
+                 Datasets of a cycle on the chain are listed together.
+        """
+        if self.graph.n == 0:
+            return []
+        labels, _ = self.graph.scc
+        c_src, c_dst, k = self.graph.condensation
+        to_component, _, weights = self._path_lengths
+        pred_indptr, pred_indices = _csr(c_dst, c_src, k)
+
+        component = int(np.argmax(to_component))
+        chain = [component]
+        while pred_indptr[component + 1] > pred_indptr[component]:
+            preds = pred_indices[pred_indptr[component]:pred_indptr[component + 1]]
+            component = int(preds[np.argmax(to_component[preds])])
+            chain.append(component)
+
+        members = {}
+        for i, label in enumerate(labels.tolist()):
+            members.setdefault(label, []).append(self.graph.nodes[i])
+        return [node for component in reversed(chain) for node in sorted(members[component])]
+
+    def metric(self, name):
+        """
+        :param name: one of HOTSPOT_METRICS
+        :return: array, value per node
+        """
+        if name not in HOTSPOT_METRICS:
+            raise ValueError(f"metric must be one of {HOTSPOT_METRICS}, not {name!r}")
+        if name == "critical_path":
+            return self.critical_path_length
+        return getattr(self, name)
+
+    def table(self, sort_by="pagerank", top=50):
+        """
+        Datasets ranked by a metric.
+        :param sort_by: one of HOTSPOT_METRICS
+        :param top: number of rows, None for all datasets
+        :return: list of dicts, one per dataset
+        """
+        values = self.metric(sort_by)
+        order = np.argsort(-values, kind="stable")[:top]
+        on_critical_path = set(self.critical_path)
+        roles = self.graph.roles
+        return [
+            {
+                "dataset": self.graph.nodes[i],
+                "role": roles[i],
+                "fan_in": int(self.fan_in[i]),
+                "fan_out": int(self.fan_out[i]),
+                "pagerank": round(float(self.pagerank[i]), 6),
+                "betweenness": round(float(self.betweenness[i]), 6),
+                "critical_path": int(self.critical_path_length[i]),
+                "on_critical_path": self.graph.nodes[i] in on_critical_path,
+            }
+            for i in order.tolist()
+        ]
+
+    def node_styles(self, metric="pagerank", min_size=10, max_size=50):
+        """
+        vis node attributes showing a metric: size grows with it, colour goes from blue to red by its quantile.
+        :return: dict node -> {"size", "color", "title"}, for the node_styles of the create_pyvis_* layouts
+        """
+        values = self.metric(metric).astype(np.float64)
+        if values.size == 0:
+            return {}
+        span = values.max() - values.min()
+        scaled = np.sqrt((values - values.min()) / span) if span > 0 else np.zeros_like(values)
+        sizes = min_size + scaled * (max_size - min_size)
+        ranks = np.argsort(np.argsort(values, kind="stable"), kind="stable")
+        buckets = ranks * len(HEAT_COLOURS) // len(values)
+        return {
+            node: {
+                "size": round(float(sizes[i]), 1),
+                "color": HEAT_COLOURS[buckets[i]],
+                "title": f"{node}\n{metric}: {values[i]:.6g}",
+            }
+            for i, node in enumerate(self.graph.nodes)
+        }
+
+    def summary(self, top=10):
+        """
+        :return: dict, JSON serializable
+        """
+        return {
+            "datasets": self.graph.n,
+            "edges": int(self.simple_edges[0].size),
+            "critical_path": self.critical_path,
+            "degree_distribution": self.degree_distribution(),
+            "top": {metric: [row["dataset"] for row in self.table(metric, top)] for metric in HOTSPOT_METRICS},
+        }
+
+
+if __name__ == '__main__':
+    # Usage: python -m utils.hotspot_utils program.sas
+    from utils.parse_utils import StructuredSAS
+    struct_SAS = StructuredSAS.from_file(sys.argv[1]).execute_all_processing_steps()
+    print(json.dumps(struct_SAS.get_hotspots().summary(), indent=4))
+    struct_SAS.close()
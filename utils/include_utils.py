@@ -0,0 +1,228 @@
+import os
+import re
+import sys
+import json
+import hashlib
+import threading
+
+from utils.parse_utils import StructuredSAS
+
+# Directories searched for %include files that aren't found next to the including file
+INCLUDE_PATH = [p for p in os.environ.get("SAS2PY_INCLUDE_PATH", "").split(os.pathsep) if p]
+
+# %include 'file.sas'; or %inc "file.sas" / options; Filerefs (%include myref;) can't be resolved and stay opaque.
+INCLUDE_PATTERN = re.compile(r"""%INC(?:LUDE)?\s+(['"])([^'"]+)\1[^;]*;""", re.IGNORECASE)
+
+
+def file_signature(path):
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+def file_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class _CachedFile:
+    __slots__ = ("signature", "hash", "struct_SAS", "includes", "runs", "runs_token")
+
+    def __init__(self, signature, hash_, struct_SAS, includes):
+        self.signature = signature
+        self.hash = hash_
+        self.struct_SAS = struct_SAS  # file parsed on its own: pre_processed without included runs
+        self.includes = includes  # [(section_index, run_index, included path or None), ...] in file order
+        self.runs = None  # runs of the file with runs of included files spliced in
+        self.runs_token = None
+
+
+class IncludeResolver:
+    """
+    Resolves %include statements so lineage continues into included files.
+
+    Every file is parsed on its own (clean_initial_code + parse_sas_script) and its runs are cached by path.
+    A cached file is reused while its mtime and size are unchanged, or, if they changed, while its content hash is
+    the same. Runs of included files are spliced into the runs of the including file at the %include statement,
+    so a shared library included by many programs is parsed once.
+
+    `dependencies` is the file dependency index: path -> included paths. `unresolved` lists includes that
+    couldn't be found, per file.
+    """
+    def __init__(self, search_path=None):
+        """
+        :param search_path: list of directories for %include files, defaults to SAS2PY_INCLUDE_PATH
+        """
+        self.search_path = list(INCLUDE_PATH if search_path is None else search_path)
+        self.dependencies = {}
+        self.unresolved = {}
+        self.parsed_files = 0  # number of files actually parsed, the rest came from cache
+        self._cache = {}
+        self._lock = threading.RLock()
+
+    def find_include(self, include, including_path):
+        """
+        :param include: path as written in the %include statement
+        :param including_path: file with the %include statement
+        :return: absolute path of the included file, None if not found
+        """
+        if os.path.isabs(include):
+            return os.path.normpath(include) if os.path.isfile(include) else None
+        for directory in [os.path.dirname(including_path)] + self.search_path:
+            candidate = os.path.abspath(os.path.join(directory, include))
+            if os.path.isfile(candidate):
+                return candidate
+        return None
+
+    def invalidate(self, path):
+        """
+        Forgets the cached parse of path, e.g. when it was deleted or its %include statements may resolve differently.
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            self._cache.pop(path, None)
+            if not os.path.isfile(path):
+                self.dependencies.pop(path, None)
+                self.unresolved.pop(path, None)
+
+    def dependents(self, path):
+        """
+        :return: set of files that include `path`, directly or through other includes
+        """
+        path = os.path.abspath(path)
+        reverse = {}
+        for parent, children in self.dependencies.items():
+            for child in children:
+                reverse.setdefault(child, set()).add(parent)
+        result = set()
+        stack = [path]
+        while stack:
+            for parent in reverse.get(stack.pop(), ()):
+                if parent not in result:
+                    result.add(parent)
+                    stack.append(parent)
+        return result
+
+    def _load(self, path):
+        """
+        :return: _CachedFile of path with its own runs, parsed only if the file changed
+        """
+        signature = file_signature(path)
+        cached = self._cache.get(path)
+        if cached is not None and any(inc is not None and not os.path.isfile(inc) for _, _, inc in cached.includes):
+            cached = None  # An included file was removed, its %include has to be looked up again
+        if cached is not None and cached.signature == signature:
+            return cached
+
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        text_hash = file_hash(text)
+        if cached is not None and cached.hash == text_hash:
+            cached.signature = signature  # Touched, not changed
+            return cached
+
+        struct_SAS = StructuredSAS(text).clean_initial_code().parse_sas_script()
+        includes = []
+        unresolved = []
+        for m in INCLUDE_PATTERN.finditer(struct_SAS.struct_code):
+            included = self.find_include(m.group(2), path)
+            if included is None:
+                unresolved.append(m.group(2))
+            section_index, run_index = struct_SAS.run_position(m.start())
+            includes.append((section_index, run_index, included))
+
+        self.parsed_files += 1
+        self.unresolved[path] = unresolved
+        self.dependencies[path] = [included for _, _, included in includes if included is not None]
+        cached = _CachedFile(signature, text_hash, struct_SAS, includes)
+        self._cache[path] = cached
+        return cached
+
+    def resolve_runs(self, path):
+        """
+        Runs of a file with the runs of its included files spliced in at the %include statements.
+        Included runs take the section of the %include statement and the odd run_index just before the run block
+        holding it (even indexes are used by parse_sas_script), so they sort in front of it.
+        Each run has `source_file`, and the indexes it had in that file as `source_section_index`/`source_run_index`.
+        Offsets and lines of a run (run_spans, run_lines, input_refs...) refer to its `source_file`.
+
+        :param path: path to SAS file
+        :return: list of run dicts, as StructuredSAS.pre_processed
+        """
+        with self._lock:
+            return self._resolve(os.path.abspath(path), ())[0]
+
+    def _resolve(self, path, stack):
+        """
+        :return: (runs, token). The token changes whenever the file or anything it includes changes,
+                 spliced runs are rebuilt only then.
+        """
+        cached = self._load(path)
+        stack = stack + (path,)
+
+        included_runs = []
+        token_parts = [cached.hash]
+        for section_index, run_index, included in cached.includes:
+            if included is None or included in stack:
+                continue  # unresolved or circular include
+            runs, token = self._resolve(included, stack)
+            included_runs.append((section_index, run_index, included, runs))
+            token_parts.append(token)
+        token = file_hash("|".join(token_parts))
+
+        if cached.runs is not None and cached.runs_token == token:
+            return cached.runs, token
+
+        spliced = [
+            (run["section_index"], run["run_index"], {
+                **run,
+                "source_file": path,
+                "source_section_index": run["section_index"],
+                "source_run_index": run["run_index"],
+            })
+            for run in cached.struct_SAS.pre_processed
+        ]
+        for section_index, run_index, included, runs in included_runs:
+            # Spans of included runs point into their own file, so their code is materialized here
+            included_SAS = self._cache[included].struct_SAS
+            for run in runs:
+                spliced.append((section_index, run_index - 1, {
+                    **run, "section_index": section_index, "run_index": run_index - 1,
+                    "run_code": included_SAS.get_run_code(run),
+                }))
+        # Stable sort keeps included runs in their own order
+        spliced.sort(key=lambda x: (x[0], x[1]))
+        cached.runs = [run for _, _, run in spliced]
+        cached.runs_token = token
+        return cached.runs, token
+
+    def parse_program(self, path):
+        """
+        :param path: path to SAS program
+        :return: StructuredSAS of the program with included files resolved, fully processed. Runs spliced in from
+                 included files have `source_file`, see StructuredSAS.source_of
+        """
+        path = os.path.abspath(path)
+        runs = self.resolve_runs(path)
+        with open(path, "r", encoding="utf-8") as f:
+            struct_SAS = StructuredSAS(f.read())
+        # parse_sas_script, which builds the line index for line_col/reference_locations, isn't run on this object
+        struct_SAS.build_line_index()
+        # The steps after parsing work on copies, except assign_subgraph_ids, which sets `sub_graph_id` on the run
+        # dicts, so the cached ones are copied
+        struct_SAS.pre_processed = [dict(run) for run in runs]
+        # Included runs are located in their own file, with the line index of its cached parse
+        with self._lock:
+            struct_SAS.sources = {run["source_file"]: self._cache[run["source_file"]].struct_SAS
+                                  for run in runs if run["source_file"] != path}
+        return struct_SAS.process_parsed_runs()
+
+
+if __name__ == '__main__':
+    # Usage: python -m utils.include_utils program.sas [include_dir ...]
+    resolver = IncludeResolver(search_path=sys.argv[2:] or None)
+    struct_SAS = resolver.parse_program(sys.argv[1])
+    print(json.dumps({
+        "dependencies": resolver.dependencies,
+        "unresolved": {k: v for k, v in resolver.unresolved.items() if v},
+        "nodes": struct_SAS.nodes,
+        "edges": struct_SAS.edges,
+    }, indent=4))
@@ -0,0 +1,240 @@
+import os
+import sys
+import json
+import math
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from utils.graph_utils import LineageGraph
+from utils.metrics_utils import get_metrics
+
+# Worker processes of the layout pool, shared by every session of this process
+LAYOUT_WORKERS = int(os.environ.get("SAS2PY_LAYOUT_WORKERS", os.cpu_count() or 1))
+
+# Components with fewer nodes are laid out in this process: sending them to a worker costs more than the layout
+POOL_MIN_NODES = int(os.environ.get("SAS2PY_LAYOUT_POOL_MIN_NODES", 200))
+
+# Component layouts kept by the process-wide LayoutCache
+LAYOUT_CACHE_SIZE = int(os.environ.get("SAS2PY_LAYOUT_CACHE_SIZE", 4096))
+
+# Side of a component's box grows with the square root of its nodes, so node density is the same in every component
+NODE_SPACING = 60.0
+COMPONENT_GAP = 80.0
+
+
+def spring_component(n, edges, seed=42):
+    """
+    Force-directed layout (networkx spring_layout) of one connected component.
+    Top level function, so it can run in a worker process.
+    :param n: number of nodes, numbered 0..n-1
+    :param edges: list of (u, v) node numbers
+    :return: float array (n, 2), coordinates in [-1, 1]
+    """
+    if n == 1:
+        return np.zeros((1, 2))
+    if n == 2:
+        return np.array([[-1.0, 0.0], [1.0, 0.0]])
+    import networkx as nx
+    G = nx.DiGraph()
+    G.add_nodes_from(range(n))
+    G.add_edges_from(edges)
+    pos = nx.spring_layout(G, seed=seed)
+    return np.array([pos[i] for i in range(n)], dtype=np.float64)
+
+
+def component_fingerprint(nodes, edges, layout_name="spring"):
+    """
+    Content address of a component's layout: the same component gets the same layout, in any graph it's part of.
+    :param nodes: sorted node names
+    :param edges: sorted (u, v) node numbers into nodes
+    :return: str, sha1 hex digest
+    """
+    h = hashlib.sha1(layout_name.encode("utf-8"))
+    h.update(json.dumps([nodes, edges], separators=(",", ":")).encode("utf-8"))
+    return h.hexdigest()
+
+
+def pack_components(sides, gap=COMPONENT_GAP):
+    """
+    Shelf packing of square component boxes into rows of about equal width, largest first, so boxes never overlap.
+    :param sides: side length of every box
+    :return: float array (k, 2), centre of every box
+    """
+    sides = np.asarray(sides, dtype=np.float64)
+    centres = np.zeros((len(sides), 2))
+    if not len(sides):
+        return centres
+    row_width = max(sides.max(), math.sqrt(float(((sides + gap) ** 2).sum())))
+    x = y = row_height = 0.0
+    for i in np.argsort(-sides, kind="stable").tolist():
+        side = sides[i]
+        if x > 0 and x + side > row_width:
+            x, y = 0.0, y + row_height + gap
+            row_height = 0.0
+        centres[i] = (x + side / 2, y + side / 2)
+        x += side + gap
+        row_height = max(row_height, side)
+    return centres
+
+
+class LayoutCache:
+    """
+    Process-wide LRU cache of component layouts, keyed by component_fingerprint.
+    A component that didn't change between two renders (another view, a pruned graph, a re-upload with edits
+    elsewhere) is not laid out again.
+    """
+    def __init__(self, max_entries=LAYOUT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, fingerprint):
+        with self._lock:
+            positions = self._entries.get(fingerprint)
+            if positions is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(fingerprint)
+            self.hits += 1
+            return positions
+
+    def put(self, fingerprint, positions):
+        with self._lock:
+            self._entries[fingerprint] = positions
+            self._entries.move_to_end(fingerprint)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return positions
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+_layout_cache = None
+_layout_executor = None
+_layout_lock = threading.Lock()
+
+
+def get_layout_cache():
+    """
+    :return: the LayoutCache shared by every session of this process
+    """
+    global _layout_cache
+    with _layout_lock:
+        if _layout_cache is None:
+            _layout_cache = LayoutCache()
+            get_metrics().register_collector("layout_cache", _layout_cache.stats)
+    return _layout_cache
+
+
+def get_layout_executor():
+    """
+    :return: the process pool for component layouts, started on first use
+    """
+    global _layout_executor
+    with _layout_lock:
+        if _layout_executor is None:
+            _layout_executor = ProcessPoolExecutor(max_workers=LAYOUT_WORKERS)
+    return _layout_executor
+
+
+def component_layout(nodes, edges, layout=spring_component, executor=None, cache=None):
+    """
+    Lays out every weakly connected component on its own and packs the results into a non-overlapping grid.
+
+    Layout cost is superlinear in the nodes of a graph, so splitting it makes small components cheap, and components
+    of at least POOL_MIN_NODES nodes are laid out in parallel in the process pool: total time approaches that of the
+    largest component. Layouts are cached per component by content (see LayoutCache).
+
+    :param nodes: list of node names, or a LineageGraph (edges are then taken from it)
+    :param edges: list of (source, target)
+    :param layout: function (n, edges) -> (n, 2) array in [-1, 1], top level so it can be pickled
+    :param executor: concurrent.futures executor, defaults to get_layout_executor()
+    :param cache: LayoutCache, defaults to get_layout_cache()
+    :return: dict node -> (x, y) in pixels
+    """
+    graph = nodes if isinstance(nodes, LineageGraph) else LineageGraph(nodes, edges)
+    cache = cache if cache is not None else get_layout_cache()
+    labels, k = graph.weak_components
+    if graph.n == 0:
+        return {}
+
+    # Nodes of every component, sorted by name so a component gets the same numbering in any graph
+    names = np.array(graph.nodes, dtype=object)
+    name_rank = np.argsort(np.argsort(names, kind="stable"), kind="stable")
+    node_order = np.lexsort((name_rank, labels))
+    node_bounds = np.searchsorted(labels[node_order], np.arange(k + 1))
+    local = np.empty(graph.n, dtype=np.int64)
+    edge_order = np.argsort(labels[graph.src], kind="stable")
+    edge_bounds = np.searchsorted(labels[graph.src][edge_order], np.arange(k + 1))
+
+    members = []
+    pending = {}  # component -> future
+    positions = [None] * k
+    sources = {"cache": 0, "process": 0, "pool": 0}
+    for c in range(k):
+        member = node_order[node_bounds[c]:node_bounds[c + 1]]
+        local[member] = np.arange(len(member))
+        component_edges = edge_order[edge_bounds[c]:edge_bounds[c + 1]]
+        c_edges = sorted(set(zip(local[graph.src[component_edges]].tolist(),
+                                 local[graph.dst[component_edges]].tolist())))
+        c_nodes = names[member].tolist()
+        members.append(member)
+
+        fingerprint = component_fingerprint(c_nodes, c_edges, layout.__name__)
+        cached = cache.get(fingerprint)
+        if cached is not None:
+            positions[c] = cached
+            sources["cache"] += 1
+        elif len(member) >= POOL_MIN_NODES:
+            if executor is None:
+                executor = get_layout_executor()
+            pending[c] = (fingerprint, executor.submit(layout, len(member), c_edges))
+            sources["pool"] += 1
+        else:
+            positions[c] = cache.put(fingerprint, layout(len(member), c_edges))
+            sources["process"] += 1
+
+    for c, (fingerprint, future) in pending.items():
+        positions[c] = cache.put(fingerprint, future.result())
+
+    metrics = get_metrics()
+    for source, count in sources.items():
+        if count:
+            metrics.inc("layout_components_total", count, source=source)
+
+    sides = [NODE_SPACING * math.sqrt(len(member)) for member in members]
+    centres = pack_components(sides)
+    xy = np.empty((graph.n, 2))
+    for c, member in enumerate(members):
+        xy[member] = positions[c] * (sides[c] / 2) + centres[c]
+    xs, ys = xy[:, 0].round(1).tolist(), xy[:, 1].round(1).tolist()
+    return {node: (xs[i], ys[i]) for i, node in enumerate(graph.nodes)}
+
+
+if __name__ == '__main__':
+    # Usage: python -m utils.layout_utils program.sas
+    import time
+    from utils.parse_utils import StructuredSAS
+    struct_SAS = StructuredSAS.from_file(sys.argv[1]).execute_all_processing_steps()
+    graph = struct_SAS.get_lineage_graph()
+    for attempt in ("cold", "cached"):
+        start = time.perf_counter()
+        component_layout(graph, None)
+        print(f"{attempt}: {time.perf_counter() - start:.3f}s, {graph.weak_components[1]} components, "
+              f"cache {get_layout_cache().stats()}")
+    struct_SAS.close()
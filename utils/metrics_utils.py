@@ -0,0 +1,279 @@
+import os
+import sys
+import time
+import threading
+from contextlib import contextmanager
+
+# Port of the metrics endpoint started by the app (see start_metrics_server), off if not set
+METRICS_PORT = int(os.environ["SAS2PY_METRICS_PORT"]) if os.environ.get("SAS2PY_METRICS_PORT") else None
+
+# File the metrics are written to every METRICS_DUMP_S seconds (see start_metrics_dump), e.g. for the node_exporter
+# textfile collector. Off if not set
+METRICS_FILE = os.environ.get("SAS2PY_METRICS_FILE")
+METRICS_DUMP_S = float(os.environ.get("SAS2PY_METRICS_DUMP_S", 60))
+
+METRIC_PREFIX = "sas2py_"
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(10))  # 1 KiB .. 256 MiB
+COUNT_BUCKETS = (10, 30, 100, 300, 1000, 3000, 10000, 30000, 100000, 300000, 1000000)
+
+# name -> (type, help, histogram buckets). Names are exported with METRIC_PREFIX
+METRICS = {
+    "parse_seconds": ("histogram", "Duration of StructuredSAS.execute_all_processing_steps", SECONDS_BUCKETS),
+    "parse_input_size": ("histogram", "Size of parsed SAS code, characters (bytes for memory-mapped files)",
+                         SIZE_BUCKETS),
+    "parse_runs": ("histogram", "Run blocks of a parsed script", COUNT_BUCKETS),
+    "graph_nodes": ("histogram", "Datasets in the lineage graph of a parsed script", COUNT_BUCKETS),
+    "graph_edges": ("histogram", "Edges in the lineage graph of a parsed script", COUNT_BUCKETS),
+    "service_parse_seconds": ("histogram", "Duration of a parse by the lineage service, including its process pool",
+                              SECONDS_BUCKETS),
+    "layout_seconds": ("histogram", "Duration of building a laid out network graph, by layout", SECONDS_BUCKETS),
+    "layout_components_total": ("counter", "Components laid out by component_layout, by where the layout came from",
+                                None),
+    "render_seconds": ("histogram", "Duration of rendering a network graph to html", SECONDS_BUCKETS),
+    "render_nodes": ("histogram", "Nodes of a rendered network graph", COUNT_BUCKETS),
+    "render_html_bytes": ("histogram", "Size of rendered network graph html", SIZE_BUCKETS),
+    "failures_total": ("counter", "Timed operations that raised, by metric and exception type", None),
+    "sessions_total": ("counter", "Streamlit sessions started by this process", None),
+}
+
+# Keys of collector stats that only ever grow: exported as counters <collector>_<key>_total, the rest as gauges
+COUNTER_STATS = ("hits", "misses", "evictions")
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _resident_bytes():
+    """
+    :return: resident memory of this process, from /proc on Linux, otherwise its peak from getrusage. None if unknown
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class MetricsRegistry:
+    """
+    Process-wide counters and histograms of the metrics in METRICS, and gauges and counters read from the `stats()`
+    of registered collectors (caches) when the metrics are exported, in the Prometheus text format.
+    Metrics are kept in this process: with a process pool, record them in the process that waits for the result.
+
+    Usage:
+    >>> metrics = get_metrics()
+    >>> with metrics.timed("layout_seconds", layout="force"):
+    ...     net = build_network()
+    >>> metrics.observe("render_nodes", len(net.nodes))
+    >>> metrics.register_collector("parse_store", store.stats)
+    >>> text = metrics.render()
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts..., +Inf count], sum
+        self._collectors = {}  # name -> function returning a stats dict
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = METRICS[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * (len(buckets) + 1), 0.0]
+            counts = histogram[0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            histogram[1] += value
+
+    @contextmanager
+    def timed(self, name, **labels):
+        """
+        Observes the duration of the block (or decorated function) in seconds. If it raises, failures_total is
+        counted instead.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            self.inc("failures_total", metric=name, error=type(e).__name__)
+            raise
+        self.observe(name, time.perf_counter() - start, **labels)
+
+    def register_collector(self, name, stats):
+        """
+        :param stats: function returning a dict, every numeric value is exported as gauge <name>_<key>, or as
+                      counter <name>_<key>_total for keys in COUNTER_STATS
+        """
+        with self._lock:
+            self._collectors[name] = stats
+
+    def render(self):
+        """
+        :return: str, all metrics in the Prometheus text exposition format (version 0.0.4)
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: ([*counts], total) for key, (counts, total) in self._histograms.items()}
+            collectors = dict(self._collectors)
+
+        lines = []
+        for name, (kind, help_text, buckets) in METRICS.items():
+            series = counters if kind == "counter" else histograms
+            keys = sorted(key for key in series if key[0] == name)
+            if not keys:
+                continue
+            full = METRIC_PREFIX + name
+            lines.append(f"# HELP {full} {help_text}")
+            lines.append(f"# TYPE {full} {kind}")
+            for key in keys:
+                labels = key[1]
+                if kind == "counter":
+                    lines.append(f"{full}{_format_labels(labels)} {_format_value(series[key])}")
+                    continue
+                counts, total = series[key]
+                cumulative = 0
+                for bound, count in zip((*buckets, "+Inf"), counts):
+                    cumulative += count
+                    le = (*labels, ("le", bound if bound == "+Inf" else repr(float(bound))))
+                    lines.append(f"{full}_bucket{_format_labels(le)} {cumulative}")
+                lines.append(f"{full}_sum{_format_labels(labels)} {_format_value(total)}")
+                lines.append(f"{full}_count{_format_labels(labels)} {cumulative}")
+
+        collected = [("process_resident_bytes", "gauge", _resident_bytes())]
+        for collector, stats in sorted(collectors.items()):
+            for stat, value in stats().items():
+                if stat in COUNTER_STATS:
+                    collected.append((f"{collector}_{stat}_total", "counter", value))
+                else:
+                    collected.append((f"{collector}_{stat}", "gauge", value))
+        for name, kind, value in collected:
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            full = METRIC_PREFIX + name
+            lines.append(f"# TYPE {full} {kind}")
+            lines.append(f"{full} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+_metrics = None
+_metrics_server = None
+_metrics_dump = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    """
+    :return: the MetricsRegistry shared by every session of this process
+    """
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = MetricsRegistry()
+    return _metrics
+
+
+def start_metrics_server(port=METRICS_PORT, address="127.0.0.1"):
+    """
+    Serves get_metrics().render() at http://<address>:<port>/metrics from a daemon thread. Started once per process.
+    :return: URL of the endpoint, None if no port is configured or the server couldn't start (e.g. port in use)
+    """
+    global _metrics_server
+    if port is None:
+        return None
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = get_metrics().render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Scraped every few seconds, not worth a log line
+
+    with _metrics_lock:
+        if _metrics_server is None:
+            try:
+                _metrics_server = ThreadingHTTPServer((address, port), MetricsHandler)
+            except OSError:
+                _metrics_server = False
+            else:
+                threading.Thread(target=_metrics_server.serve_forever, name="sas-metrics", daemon=True).start()
+    if not _metrics_server:
+        return None
+    return f"http://{address}:{port}/metrics"
+
+
+def dump_metrics(path):
+    """
+    Writes the metrics to `path` atomically, so a collector reading it never sees a partial file.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(get_metrics().render())
+    os.replace(tmp_path, path)
+
+
+def start_metrics_dump(path=METRICS_FILE, interval=METRICS_DUMP_S):
+    """
+    Writes the metrics to `path` every `interval` seconds from a daemon thread. Started once per process.
+    :return: True if the dump is running, False if no path is configured
+    """
+    global _metrics_dump
+    if path is None:
+        return False
+
+    def run():
+        while True:
+            try:
+                dump_metrics(path)
+            except OSError as e:
+                print(f"Metrics dump to {path} failed: {e}", file=sys.stderr)
+            time.sleep(interval)
+
+    with _metrics_lock:
+        if _metrics_dump is None:
+            _metrics_dump = threading.Thread(target=run, name="sas-metrics-dump", daemon=True)
+            _metrics_dump.start()
+    return True
+
+
+if __name__ == '__main__':
+    # Usage: python -m utils.metrics_utils program.sas [program.sas ...]
+    from utils.parse_utils import StructuredSAS
+    from utils import metrics_utils  # The registry parse_utils records to, not this __main__ module's
+    for path in sys.argv[1:]:
+        StructuredSAS.from_file(path).execute_all_processing_steps().close()
+    print(metrics_utils.get_metrics().render(), end="")
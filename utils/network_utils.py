@@ -1,20 +1,89 @@
-import streamlit as st
-import networkx as nx
-from pyvis.network import Network
+import os
+import json
+from functools import lru_cache
 from collections import defaultdict, deque
 
-def create_pyvis_force_layout(nodes, edges):
+from utils.metrics_utils import get_metrics
+
+# networkx, pyvis and streamlit are imported in the functions that use them, so importing this module
+# (e.g. for render_network_html or the deck/link views of main.py) doesn't load the whole visualisation stack
+
+# Feature: copy node name upon double click. Expects the Vis.js Network in a global variable `network`.
+DOUBLE_CLICK_COPY_JS = """
+    <script>
+    (function() {
+        // Wait until the Vis network is fully initialized
+        // "network" is the variable PyVis uses to reference the Vis.js Network.
+        // We'll attach an event listener for 'doubleClick'
+        network.on("doubleClick", function(params) {
+            if (params.nodes.length > 0) {
+                // 'params.nodes[0]' is the ID of the clicked node
+                var nodeId = params.nodes[0];
+
+                // Retrieve the node's label from the network data
+                var nodeLabel = network.body.data.nodes.get(nodeId).label;
+
+                // Copy to clipboard
+                copyTextToClipboard(nodeLabel);
+
+                // Show an alert (optional)
+                // alert("Copied node label: " + nodeLabel);
+            }
+        });
+
+        function copyTextToClipboard(text) {
+            if (navigator.clipboard && window.isSecureContext) {
+                // modern approach with Clipboard API
+                return navigator.clipboard.writeText(text);
+            } else {
+                // fallback to the 'execCommand()' solution
+                let textArea = document.createElement("textarea");
+                textArea.value = text;
+                // make the textarea out of viewport
+                textArea.style.position = "fixed";
+                textArea.style.left = "-999999px";
+                document.body.appendChild(textArea);
+                textArea.focus();
+                textArea.select();
+                document.execCommand("copy");
+                document.body.removeChild(textArea);
+            }
+        }
+    })();
+    </script>
+"""
+
+def _build_graph(nodes, edges):
     """
-    A force-directed layout using NetworkX's spring_layout
-    (similar in spirit to Graphviz 'neato').
+    :return: networkx DiGraph
     """
+    import networkx as nx
+
     G = nx.DiGraph()
     G.add_nodes_from(nodes)
     G.add_edges_from(edges)
+    return G
+
 
+@get_metrics().timed("layout_seconds", layout="force")
+def create_pyvis_force_layout(nodes, edges, node_styles=None):
+    """
+    A force-directed layout using NetworkX's spring_layout
+    (similar in spirit to Graphviz 'neato').
+    Every weakly connected component is laid out on its own, in parallel, and the components are packed into a grid,
+    see utils.layout_utils.component_layout.
+    :param node_styles: optional dict node -> extra vis node attributes (size, color, title...),
+                        e.g. from HotspotAnalysis.node_styles
+    """
+    from pyvis.network import Network
+    from utils.layout_utils import component_layout
 
-    # Force-directed layout in NetworkX
-    pos = nx.spring_layout(G, seed=42)  # 'pos' = {node: (x, y), ...}
+    node_styles = node_styles or {}
+    G = _build_graph(nodes, edges)
+
+
+    # Force-directed layout per component, in pixels
+    pos = component_layout(list(G.nodes()), list(G.edges()))  # 'pos' = {node: (x, y), ...}
 
     net = Network(
         width="100%",
@@ -28,13 +97,14 @@ def create_pyvis_force_layout(nodes, edges):
 
     for node in G.nodes():
         x, y = pos[node]
-        # Scale and flip Y (optional) so the graph isn't too small or upside-down
+        # component_layout is already in pixels, with y growing downwards as in vis
         net.add_node(
             str(node),
-            x=float(x)*500,
-            y=float(-y)*500,
+            x=float(x),
+            y=float(y),
             label=str(node),
-            physics=False
+            physics=False,
+            **node_styles.get(node, {})
         )
 
     for u, v in G.edges():
@@ -43,14 +113,17 @@ def create_pyvis_force_layout(nodes, edges):
     return net
 
 
-def create_pyvis_hierarchical_layout(nodes, edges):
+@get_metrics().timed("layout_seconds", layout="hierarchical")
+def create_pyvis_hierarchical_layout(nodes, edges, node_styles=None):
     """
     A BFS-based hierarchical layout (top -> down).
     This is somewhat similar to Graphviz 'dot' for DAGs.
+    :param node_styles: optional dict node -> extra vis node attributes, see create_pyvis_force_layout
     """
-    G = nx.DiGraph()
-    G.add_nodes_from(nodes)
-    G.add_edges_from(edges)
+    from pyvis.network import Network
+
+    node_styles = node_styles or {}
+    G = _build_graph(nodes, edges)
 
     # --- 1) Find BFS layers (assuming acyclic graph) ---
     in_degree_zero = [n for n in G.nodes() if G.in_degree(n) == 0]
@@ -107,6 +180,7 @@ def create_pyvis_hierarchical_layout(nodes, edges):
             x=float(x),
             y=float(y),
             label=str(n),
+            **node_styles.get(n, {})
         )
 
     for u, v in G.edges():
@@ -115,14 +189,18 @@ def create_pyvis_hierarchical_layout(nodes, edges):
     return net
 
 
-def create_pyvis_multipartite_layout(nodes, edges, layer_map):
+@get_metrics().timed("layout_seconds", layout="multipartite")
+def create_pyvis_multipartite_layout(nodes, edges, layer_map, node_styles=None):
     """
     Uses NetworkX's multipartite_layout which arranges nodes by 'subset' (layer).
     Similar to a layered approach. Provide each node's layer in 'layer_map'.
+    :param node_styles: optional dict node -> extra vis node attributes, see create_pyvis_force_layout
     """
-    G = nx.DiGraph()
-    G.add_nodes_from(nodes)
-    G.add_edges_from(edges)
+    import networkx as nx
+    from pyvis.network import Network
+
+    node_styles = node_styles or {}
+    G = _build_graph(nodes, edges)
 
     # Attach the 'subset' attribute for multipartite_layout
     for n in G.nodes():
@@ -149,7 +227,8 @@ def create_pyvis_multipartite_layout(nodes, edges, layer_map):
             x=float(x)*300,
             y=float(-y)*300,
             label=str(node),
-            physics=False
+            physics=False,
+            **node_styles.get(node, {})
         )
 
     for u, v in G.edges():
@@ -168,52 +247,257 @@ def inject_js_features(net):
     html_data = net.generate_html()
 
     # Adds feature: copy node name upon double-clicking on it
-    custom_script = """
-    <script>
-    (function() {
-        // Wait until the Vis network is fully initialized
-        // "network" is the variable PyVis uses to reference the Vis.js Network.
-        // We'll attach an event listener for 'doubleClick'
-        network.on("doubleClick", function(params) {
-            if (params.nodes.length > 0) {
-                // 'params.nodes[0]' is the ID of the clicked node
-                var nodeId = params.nodes[0];
+    return html_data.replace("</body>", f"{DOUBLE_CLICK_COPY_JS}\n</body>")
 
-                // Retrieve the node's label from the network data
-                var nodeLabel = network.body.data.nodes.get(nodeId).label;
+# Where render_network_html takes vis-network from:
+# - "remote": cdnjs, as pyvis' cdn_resources='remote'. The default: the browser downloads and caches it once.
+# - "inline": embedded in the html from the copy shipped with pyvis. Works offline, but adds ~470 KB to every
+#   rendered graph, sent to the browser on each render and kept with the html in the ParseStore.
+# - "local": <script src="lib/..."> relative to the html, for html files saved next to pyvis' lib folder.
+VIS_RESOURCES = os.environ.get("SAS2PY_VIS_RESOURCES", "remote")
+VIS_NETWORK_VERSION = "9.1.2"
+VIS_NETWORK_CDN = f"https://cdnjs.cloudflare.com/ajax/libs/vis-network/{VIS_NETWORK_VERSION}/dist/vis-network.min.js"
 
-                // Copy to clipboard
-                copyTextToClipboard(nodeLabel);
+# Node and edge attributes hoisted from every node/edge into vis options by get_network_payload
+NODE_DEFAULT_KEYS = ("shape", "color", "font", "physics")
+EDGE_DEFAULT_KEYS = ("arrows",)
 
-                // Show an alert (optional)
-                // alert("Copied node label: " + nodeLabel);
+
+@lru_cache(maxsize=None)
+def get_vis_network_js():
+    """
+    :return: str, vis-network js bundled with pyvis. Read once per process.
+    """
+    import pyvis
+    path = os.path.join(os.path.dirname(pyvis.__file__), "lib", f"vis-{VIS_NETWORK_VERSION}", "vis-network.min.js")
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+def _hoist_defaults(items, keys):
+    """
+    Finds attributes that have the same value on every item, so they can be set once in vis options.
+    :return: dict of shared attributes
+    """
+    shared = {}
+    for key in keys:
+        values = {json.dumps(item.get(key), sort_keys=True) for item in items}
+        if len(values) == 1 and items and key in items[0]:
+            shared[key] = items[0][key]
+    return shared
+
+
+def get_network_payload(net):
+    """
+    Serializes nodes and edges of a PyVis network into a compact, columnar JSON payload:
+        {"nodes": {"id": [...], "label": [...] or null, "x": [...] or null, "y": [...] or null},
+         "attrs": {node index: {other node attributes}},
+         "edges": [source index, target index, source index, target index, ...],
+         "options": {vis options with attributes shared by every node/edge}}
+    Shared node/edge attributes (shape, colour, font, arrows...) are written once in options instead of per item,
+    edges refer to nodes by index, and coordinates are rounded to 0.1px.
+    The payload depends only on the network, so callers can cache it.
+
+    :param net: pyvis Network
+    :return: str, JSON
+    """
+    nodes = net.nodes
+    edges = net.edges
+    node_defaults = _hoist_defaults(nodes, NODE_DEFAULT_KEYS)
+    edge_defaults = _hoist_defaults(edges, EDGE_DEFAULT_KEYS)
+
+    ids = [n["id"] for n in nodes]
+    index = {node_id: i for i, node_id in enumerate(ids)}
+    labels = [n.get("label", n["id"]) for n in nodes]
+    has_pos = bool(nodes) and all("x" in n and "y" in n for n in nodes)
+
+    skip_keys = {"id", "label", "x", "y", *node_defaults}
+    attrs = {}
+    for i, n in enumerate(nodes):
+        extra = {k: v for k, v in n.items() if k not in skip_keys}
+        if extra:
+            attrs[i] = extra
+
+    flat_edges = []
+    for e in edges:
+        flat_edges.append(index[e["from"]])
+        flat_edges.append(index[e["to"]])
+
+    options = json.loads(net.get_network_data()[5])
+    options.setdefault("nodes", {}).update(node_defaults)
+    options.setdefault("edges", {}).update(edge_defaults)
+
+    payload = {
+        "nodes": {
+            "id": ids,
+            "label": None if labels == ids else labels,
+            "x": [round(n["x"], 1) for n in nodes] if has_pos else None,
+            "y": [round(n["y"], 1) for n in nodes] if has_pos else None,
+        },
+        "attrs": attrs,
+        "edges": flat_edges,
+        "options": options,
+    }
+    return json.dumps(payload, separators=(",", ":"), ensure_ascii=False)
+
+
+# Rebuilds vis DataSets from the payload of get_network_payload. `network` is global, as in PyVis html.
+_PAYLOAD_LOADER_JS = """
+    var network;
+    (function() {
+        var p = JSON.parse(document.getElementById("network-payload").textContent);
+        var ids = p.nodes.id, labels = p.nodes.label, xs = p.nodes.x, ys = p.nodes.y;
+        var nodeItems = new Array(ids.length);
+        for (var i = 0; i < ids.length; i++) {
+            var n = {id: ids[i], label: labels ? labels[i] : ids[i]};
+            if (xs) { n.x = xs[i]; n.y = ys[i]; }
+            if (p.attrs[i]) { Object.assign(n, p.attrs[i]); }
+            nodeItems[i] = n;
+        }
+        var edgeItems = new Array(p.edges.length / 2);
+        for (var j = 0; j < p.edges.length; j += 2) {
+            edgeItems[j / 2] = {id: j / 2, from: ids[p.edges[j]], to: ids[p.edges[j + 1]]};
+        }
+        var data = {nodes: new vis.DataSet(nodeItems), edges: new vis.DataSet(edgeItems)};
+        network = new vis.Network(document.getElementById("mynetwork"), data, p.options);
+
+        // Select menu: focus the chosen node
+        var select = document.getElementById("select-node");
+        if (select) {
+            var fragment = document.createDocumentFragment();
+            for (var k = 0; k < ids.length; k++) {
+                var opt = document.createElement("option");
+                opt.value = k;
+                opt.text = labels ? labels[k] : ids[k];
+                fragment.appendChild(opt);
             }
-        });
+            select.appendChild(fragment);
+            select.addEventListener("change", function() {
+                if (this.value === "") { network.unselectAll(); return; }
+                var nodeId = ids[+this.value];
+                network.selectNodes([nodeId]);
+                network.focus(nodeId, {scale: 1, animation: false});
+            });
+        }
+    })();
+"""
 
-        function copyTextToClipboard(text) {
-            if (navigator.clipboard && window.isSecureContext) {
-                // modern approach with Clipboard API
-                return navigator.clipboard.writeText(text);
-            } else {
-                // fallback to the 'execCommand()' solution
-                let textArea = document.createElement("textarea");
-                textArea.value = text;
-                // make the textarea out of viewport
-                textArea.style.position = "fixed";
-                textArea.style.left = "-999999px";
-                document.body.appendChild(textArea);
-                textArea.focus();
-                textArea.select();
-                document.execCommand("copy");
-                document.body.removeChild(textArea);
+
+# Tooltips with the run code behind an edge or node, fetched from the lineage service (utils.service_utils /runs)
+# on first hover and cached in the page. `network` is the global of _PAYLOAD_LOADER_JS.
+_TOOLTIP_JS = """
+    (function() {
+        var base = TOOLTIP_BASE;
+        var cache = {};  // query -> tooltip text, or a pending promise
+        network.setOptions({interaction: {hover: true, tooltipDelay: 150}});
+
+        function render(header, data) {
+            var pre = document.createElement("pre");
+            pre.style.margin = "0";
+            pre.style.maxWidth = "600px";
+            pre.style.whiteSpace = "pre-wrap";
+            var text = header ? header + "\\n\\n" : "";
+            if (!data.direct) { text += "No run of its own, runs writing the target:\\n\\n"; }
+            data.runs.forEach(function(run) {
+                text += "Lines " + run.lines[0] + "-" + run.lines[1] + "\\n" + run.code + "\\n\\n";
+            });
+            if (data.total > data.runs.length) { text += "... " + (data.total - data.runs.length) + " more runs"; }
+            pre.textContent = text.trim() || header;
+            return pre;
+        }
+
+        function lookup(query, header, update) {
+            if (cache[query] !== undefined) {
+                if (typeof cache[query] === "string") { update(render(header, JSON.parse(cache[query]))); }
+                return;
             }
+            cache[query] = fetch(base + "/runs?" + query)
+                .then(function(response) { return response.ok ? response.text() : Promise.reject(response.status); })
+                .then(function(text) { cache[query] = text; update(render(header, JSON.parse(text))); })
+                .catch(function() { delete cache[query]; });
         }
+
+        network.on("hoverEdge", function(params) {
+            var edge = network.body.data.edges.get(params.edge);
+            if (edge.title) { return; }
+            var query = "source=" + encodeURIComponent(edge.from) + "&target=" + encodeURIComponent(edge.to);
+            lookup(query, edge.from + " -> " + edge.to, function(title) {
+                network.body.data.edges.update({id: edge.id, title: title});
+            });
+        });
+        network.on("hoverNode", function(params) {
+            var node = network.body.data.nodes.get(params.node);
+            if (node.title instanceof Element) { return; }
+            lookup("dataset=" + encodeURIComponent(node.id), node.title || node.id, function(title) {
+                network.body.data.nodes.update({id: node.id, title: title});
+            });
+        });
     })();
-    </script>
-            """
-    return html_data.replace("</body>", f"{custom_script}\n</body>")
+"""
+
+
+@get_metrics().timed("render_seconds")
+def render_network_html(net, payload=None, vis_resources=VIS_RESOURCES, select_menu=True, tooltip_url=None):
+    """
+    Renders a PyVis network into a lean html document, instead of PyVis' own template.
+    Nodes and edges are embedded once as the JSON payload of `get_network_payload`, the double-click copy feature is
+    included, and vis-network is loaded according to `vis_resources` (see VIS_RESOURCES).
+    The document is assembled from parts in a single join, so there are no intermediate full copies of it.
+
+    :param net: pyvis Network
+    :param payload: str, cached result of get_network_payload(net). Computed if not given
+    :param vis_resources: "inline", "local" or "remote"
+    :param select_menu: bool, show a dropdown to find and focus a node
+    :param tooltip_url: optional base URL of a parsed script in the lineage service, e.g.
+                        http://localhost:8766/scripts/<key>. Hovering an edge or node then shows the run code behind
+                        it, fetched on demand. Only this URL is added to the html, not the code
+    :return: str, html
+    """
+    if payload is None:
+        payload = get_network_payload(net)
+
+    if vis_resources == "inline":
+        vis_script = f"<script>{get_vis_network_js()}</script>"
+    elif vis_resources == "local":
+        vis_script = f'<script src="lib/vis-{VIS_NETWORK_VERSION}/vis-network.min.js"></script>'
+    elif vis_resources == "remote":
+        vis_script = f'<script src="{VIS_NETWORK_CDN}"></script>'
+    else:
+        raise ValueError(f"vis_resources must be 'inline', 'local' or 'remote', not {vis_resources!r}")
+
+    select_html = '<select id="select-node"><option value="">Select a node</option></select>' if select_menu else ""
+
+    parts = [
+        '<html>\n<head>\n<meta charset="utf-8">\n',
+        vis_script,
+        "\n<style>",
+        f"#mynetwork {{width: {net.width}; height: {net.height}; background-color: {net.bgcolor};",
+        " border: 1px solid lightgray; position: relative;}",
+        "#select-node {width: 100%; margin-bottom: 4px;}",
+        "</style>\n</head>\n<body>\n",
+        select_html,
+        '<div id="mynetwork"></div>\n',
+        # JSON in a non-executed script tag. "</" is escaped so node names can't close the tag.
+        '<script type="application/json" id="network-payload">',
+        payload.replace("</", "<\\/"),
+        "</script>\n<script>",
+        _PAYLOAD_LOADER_JS,
+        _TOOLTIP_JS.replace("TOOLTIP_BASE", json.dumps(tooltip_url).replace("</", "<\\/")) if tooltip_url else "",
+        "</script>",
+        DOUBLE_CLICK_COPY_JS,
+        "</body>\n</html>\n",
+    ]
+    html = "".join(parts)
+    metrics = get_metrics()
+    metrics.observe("render_nodes", len(net.nodes))
+    metrics.observe("render_html_bytes", len(html))
+    return html
+
 
 def main():
+    import streamlit as st
+    from utils.graph_utils import LineageGraph
+
     st.title("PyVis Layout Examples (Without PyGraphviz)")
 
     st.write("""
@@ -239,14 +523,7 @@ def main():
         net = create_pyvis_hierarchical_layout(nodes, edges)
     else:  # "Multipartite"
         # For multipartite layout, define which layer each node belongs to
-        layer_map = {
-            "A": 0,
-            "B": 1,
-            "C": 1,
-            "D": 2,
-            "E": 2,
-            "F": 3
-        }
+        layer_map = LineageGraph(nodes, edges).layers("depth")
         net = create_pyvis_multipartite_layout(nodes, edges, layer_map)
 
     # Generate HTML from PyVis
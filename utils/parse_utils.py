@@ -1,17 +1,360 @@
 import json
-from pprint import pprint
 from collections import defaultdict
-import networkx as nx
 #
 # with open('example.sas','r', encoding='utf-8')as f:
 #     sas=f.read()
 
+# Parsing only needs the standard library. numpy (graph_utils, hotspot_utils) is imported on first use of the
+# graph methods, keep networkx, pyvis and streamlit out of this module
+import os
 import re
+import hashlib
+from array import array
+from bisect import bisect_left, bisect_right
+import mmap
+import time
+import threading
+
+from utils.cache_utils import block_key, get_run_block_store
+from utils.metrics_utils import get_metrics
+
+
+def _compile_patterns(to_type):
+    def c(pattern, flags=re.IGNORECASE):
+        return re.compile(to_type(pattern), flags)
+    return {
+        "section": c(r'--#+', 0),
+        "run": c(r'\b(RUN|QUIT);\s*\n'),
+        "data": c(r'\bDATA\s+([A-Z0-9_.]+)'),
+        "set": c(r'\bSET\s+([A-Z0-9_.]+)'),
+        "merge": c(r'\bMERGE\s+([^;]+)'),
+        "merge_datasets": c(r'\b([A-Z0-9_.]+)(?:\s*\(IN=[A-Z0-9_]+\))?'),
+        "proc": c(r'\b(DATA|OUT)\s*=\s*([A-Z0-9_.]+)'),
+        # Statement heads for extract_references_heuristic, matched at the start of a statement
+        "stmt_data": c(r'\s*DATA\s+([A-Z0-9_.]+)'),
+        "stmt_set": c(r'\s*SET\s+([A-Z0-9_.]+)'),
+        "stmt_merge": c(r'\s*MERGE\s+'),
+    }
+
+
+# Same patterns for str and for bytes (memory-mapped files)
+_PATTERNS = {
+    str: _compile_patterns(str),
+    bytes: _compile_patterns(lambda p: p.encode("ascii")),
+}
+
+# Comment markers like /*-----*/ removed by `clean_initial_code`
+_COMMENT_MARKER_STR = re.compile(r"/\*-*\*/\s*")
+
+# Classes of `classify_datasets`:
+# - orphan: no edges at all (e.g. only printed, or created from nothing)
+# - source: read, never written (comes from outside the script)
+# - sink: written to a permanent library, never read (a result of the script)
+# - dead: written only to WORK, never read (discarded at the end of the session)
+# - pass_through: one dataset in, one dataset out, e.g. a sort or rename step in a chain
+# - intermediate: everything else
+DATASET_CLASSES = ("orphan", "source", "sink", "dead", "pass_through", "intermediate")
+
+# Budgets of a guarded parse (see ParseBudget): run blocks larger than this, or taking longer than this to scan,
+# and every block after the whole parse took longer than the total, fall back to extract_references_heuristic
+MAX_BLOCK_KB = int(os.environ.get("SAS2PY_MAX_BLOCK_KB", 512))
+BLOCK_TIME_MS = int(os.environ.get("SAS2PY_BLOCK_TIME_MS", 250))
+PARSE_TIME_S = float(os.environ.get("SAS2PY_PARSE_TIME_S", 60))
+
+# Characters of a statement the heuristic looks at
+HEURISTIC_HEAD_CHARS = 256
+
+
+def _as_str(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+def _strip_span(buf, start, end):
+    """
+    Span equivalent of str.strip(): moves start and end past leading and trailing whitespace, without copying.
+    """
+    while start < end and buf[start:start + 1].isspace():
+        start += 1
+    while end > start and buf[end - 1:end].isspace():
+        end -= 1
+    return start, end
+
+
+_RUN_CODE_WHITESPACE = re.compile(r"(?:\s|<br>)+")
+
+
+def normalize_run_code(run_code):
+    """
+    Normalised form of run code for comparing runs: whitespace (and `<br>` left by `clean_run_code`) collapsed
+    to single spaces, upper case.
+    """
+    return _RUN_CODE_WHITESPACE.sub(" ", run_code).strip().upper()
+
+
+def run_code_hash(run_code):
+    """
+    :return: str, content hash of the normalised run code. Runs that differ only in whitespace or case share it
+    """
+    return hashlib.blake2b(normalize_run_code(run_code).encode("utf-8"), digest_size=16).hexdigest()
+
+
+class BudgetExceeded(Exception):
+    """Raised by `extract_references` when scanning a block runs past its deadline."""
+
+
+def _check_deadline(deadline):
+    if deadline is not None and time.perf_counter() > deadline:
+        raise BudgetExceeded()
+
+
+def extract_references(buf, start=0, end=None, deadline=None):
+    """
+    Finds every reference to an input or output dataset in `DATA` and `PROC` steps, with its position.
+    - Outputs: Datasets from `DATA` statements.
+    - Inputs: Datasets from `SET`, `MERGE`, and `DATA=`/`OUT=` options in `PROC` steps.
+
+    :param buf: str, or bytes-like (e.g. mmap) SAS code
+    :param start: offset where the run code starts in buf
+    :param end: offset where the run code ends in buf
+    :param deadline: optional time.perf_counter() value. Checked between matches, BudgetExceeded is raised past it
+    :return: (input_refs, output_refs), lists of (dataset name as str, start offset, end offset) in buf
+    """
+    if end is None:
+        end = len(buf)
+    patterns = _PATTERNS[str if isinstance(buf, str) else bytes]
+    input_refs = []
+    output_refs = []
+
+    # Capture the output dataset from DATA statements
+    data_match = patterns["data"].search(buf, start, end)
+    if data_match:
+        output_refs.append((_as_str(data_match.group(1)), data_match.start(1), data_match.end(1)))
+
+    # Capture input datasets from SET
+    for set_match in patterns["set"].finditer(buf, start, end):
+        input_refs.append((_as_str(set_match.group(1)), set_match.start(1), set_match.end(1)))
+        _check_deadline(deadline)
+
+    # Capture input datasets from MERGE
+    for merge_match in patterns["merge"].finditer(buf, start, end):
+        for merge_dataset in patterns["merge_datasets"].finditer(buf, merge_match.start(1), merge_match.end(1)):
+            input_refs.append((_as_str(merge_dataset.group(1)), merge_dataset.start(1), merge_dataset.end(1)))
+        _check_deadline(deadline)
+
+    # Capture input/output datasets from PROC steps
+    for proc_match in patterns["proc"].finditer(buf, start, end):
+        _check_deadline(deadline)
+        keyword, dataset = _as_str(proc_match.group(1)), _as_str(proc_match.group(2))
+        if keyword.upper() == "DATA":
+            input_refs.append((dataset, proc_match.start(2), proc_match.end(2)))
+        elif keyword.upper() == "OUT":
+            output_refs.append((dataset, proc_match.start(2), proc_match.end(2)))
+
+    return input_refs, output_refs
+
+
+def extract_references_heuristic(buf, start=0, end=None, head_chars=HEURISTIC_HEAD_CHARS):
+    """
+    Cheap, bounded fallback of `extract_references` for blocks over budget: the block is split into statements at
+    `;`, and only the first `head_chars` characters of each statement are matched, against patterns anchored at the
+    statement start (DATA name, SET name, MERGE names, DATA=/OUT= options). Every regex call sees at most
+    `head_chars` characters, so the cost is linear in the block size whatever the block holds.
+    References in the middle of a statement, or past its head, are missed.
+
+    :return: (input_refs, output_refs), as extract_references
+    """
+    if end is None:
+        end = len(buf)
+    patterns = _PATTERNS[str if isinstance(buf, str) else bytes]
+    semicolon = ";" if isinstance(buf, str) else b";"
+    input_refs = []
+    output_refs = []
+
+    pos = start
+    while pos < end:
+        stmt_end = buf.find(semicolon, pos, end)
+        if stmt_end == -1:
+            stmt_end = end
+        head_end = min(stmt_end, pos + head_chars)
+
+        m = patterns["stmt_data"].match(buf, pos, head_end)
+        if m and not output_refs:
+            output_refs.append((_as_str(m.group(1)), m.start(1), m.end(1)))
+        m = patterns["stmt_set"].match(buf, pos, head_end)
+        if m:
+            input_refs.append((_as_str(m.group(1)), m.start(1), m.end(1)))
+        m = patterns["stmt_merge"].match(buf, pos, head_end)
+        if m:
+            for merge_dataset in patterns["merge_datasets"].finditer(buf, m.end(), head_end):
+                input_refs.append((_as_str(merge_dataset.group(1)), merge_dataset.start(1), merge_dataset.end(1)))
+        for proc_match in patterns["proc"].finditer(buf, pos, head_end):
+            keyword, dataset = _as_str(proc_match.group(1)), _as_str(proc_match.group(2))
+            if keyword.upper() == "DATA":
+                input_refs.append((dataset, proc_match.start(2), proc_match.end(2)))
+            elif keyword.upper() == "OUT":
+                output_refs.append((dataset, proc_match.start(2), proc_match.end(2)))
+
+        pos = stmt_end + 1
+
+    return input_refs, output_refs
+
+
+class ParseBudget:
+    """
+    Limits of a guarded parse, so one pathological upload (e.g. generated code without RUN;, making a whole
+    section one block) can't hold a CPU: a run block over `max_block_bytes`, or not scanned within `block_seconds`,
+    is scanned again by `extract_references_heuristic`; after `total_seconds` every remaining block is.
+    Blocks that got the heuristic are recorded in `degraded`.
+    """
+    def __init__(self, max_block_bytes=MAX_BLOCK_KB * 1024, block_seconds=BLOCK_TIME_MS / 1000,
+                 total_seconds=PARSE_TIME_S):
+        self.max_block_bytes = max_block_bytes
+        self.block_seconds = block_seconds
+        self.total_seconds = total_seconds
+        self.parse_deadline = None
+        self.degraded = []  # {"section_index", "run_index", "start", "end", "bytes", "reason"}
+
+    def start(self):
+        self.parse_deadline = time.perf_counter() + self.total_seconds
+        self.degraded = []
+
+    def extract(self, buf, start, end, section_index, run_index):
+        """
+        extract_references within the budget, or the heuristic if the block is over it.
+        """
+        reason = None
+        if end - start > self.max_block_bytes:
+            reason = "size"
+        elif time.perf_counter() > self.parse_deadline:
+            reason = "total_time"
+        else:
+            try:
+                return extract_references(buf, start, end, time.perf_counter() + self.block_seconds)
+            except BudgetExceeded:
+                reason = "time"
+        self.degraded.append({
+            "section_index": section_index, "run_index": run_index,
+            "start": start, "end": end, "bytes": end - start, "reason": reason,
+        })
+        return extract_references_heuristic(buf, start, end)
+
+
+def extract_inputs_outputs(buf, start=0, end=None):
+    """
+    Extracts input and output datasets from `DATA` and `PROC` steps, see `extract_references`.
+    :return: (inputs, outputs), sets of dataset names as str
+    """
+    input_refs, output_refs = extract_references(buf, start, end)
+    return {ref[0] for ref in input_refs}, {ref[0] for ref in output_refs}
+
+
+def escape_run_code(run_code):
+    """
+    Escapes run code for Mermaid:
+    - Removes special characters like `?` and inline comments (`/* */`).
+    - Replaces newlines with `<br>`.
+    - Replaces single and double quotes with `&apos;`.
+    """
+    # Remove inline comments (/* ... */)
+    run_code = re.sub(r"/\*.*?\*/", "", run_code, flags=re.DOTALL)
+
+    # Remove special characters that may break Mermaid
+    run_code = run_code.replace("?", "")
+
+    # Replace raw newlines inside a Mermaid-friendly structure
+    run_code = [x.strip().replace(r'\n', "<br>") for x in run_code.splitlines()]
+    run_code = '<br>'.join(run_code)
+    run_code = re.sub("<br>+", "<br>", run_code)
+
+    # Replacing single and double quotes
+    run_code = run_code.replace("'", "&apos;")
+    run_code = run_code.replace("\"", "&apos;")
+    return run_code
+
+
+class ParseCancelled(Exception):
+    """Raised from inside `StructuredSAS.parse_sas_script` when its progress object has been cancelled."""
+
+
+class ParseProgress:
+    """
+    Thread-safe progress of a single parse. The parsing thread writes to it, the UI thread polls it.
+
+    Progress is counted in sections (blocks split by `--###` comments) and in runs (RUN;/QUIT; blocks)
+    processed by `StructuredSAS.parse_sas_script`. Calling `cancel()` makes the parser stop at the next run
+    by raising `ParseCancelled`.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cancel_event = threading.Event()
+        self.sections_total = 0
+        self.sections_done = 0
+        self.runs_done = 0
+        self.stage = "queued"
+
+    def set_stage(self, stage):
+        with self._lock:
+            self.stage = stage
+
+    def start_sections(self, sections_total):
+        with self._lock:
+            self.sections_total = sections_total
+            self.sections_done = 0
+            self.runs_done = 0
+
+    def advance(self, sections=0, runs=0):
+        with self._lock:
+            self.sections_done += sections
+            self.runs_done += runs
+
+    def cancel(self):
+        self._cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel_event.is_set()
+
+    def check_cancelled(self):
+        if self._cancel_event.is_set():
+            raise ParseCancelled()
+
+    @property
+    def fraction(self):
+        """
+        Share of sections parsed, in [0, 1]. Sections are the coarse unit of work of `parse_sas_script`.
+        """
+        with self._lock:
+            if not self.sections_total:
+                return 0.0
+            return min(self.sections_done / self.sections_total, 1.0)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "stage": self.stage,
+                "sections_total": self.sections_total,
+                "sections_done": self.sections_done,
+                "runs_done": self.runs_done,
+            }
+
+
+# Attributes of StructuredSAS built on demand after parsing, see StructuredSAS.derived_caches
+DERIVED_CACHES = ("lineage_graph", "provenance", "hotspots", "_pruned", "line_offsets")
 
 
 class StructuredSAS:
-    def __init__(self, raw_code):
+    def __init__(self, raw_code, progress=None, budget=None):
+        """
+        :param raw_code: str, SAS code
+        :param progress: optional ParseProgress. If given, parsing reports to it and can be cancelled through it
+        :param budget: optional ParseBudget. If given, run blocks over it are parsed with a cheaper heuristic,
+                       and reported in `degraded_runs`
+        """
         self.raw_code = raw_code
+        self.progress = progress
+        self.budget = budget
+        self.degraded_runs = []
+        self.dedup_stats = None
         self.pre_processed=None
         self.struct_code=None
         self.mermaid_structure=None
@@ -20,135 +363,378 @@ class StructuredSAS:
         self.subgraphs = None
         self.edges=None
         self.nodes=None
+        self.lineage_graph=None
+        self.provenance=None
+        self.hotspots=None
+        self.dataset_classes=None
+        self._pruned={}
+        self.line_offsets=None
+        # path -> StructuredSAS of each file whose runs were spliced in (see IncludeResolver.parse_program).
+        # Offsets and lines of a run with a `source_file` refer to that file, see `source_of`
+        self.sources={}
+        self._removed_at=array("q")
+        self._removed_shift=array("q")
+
+    @classmethod
+    def from_file(cls, path, progress=None, budget=None):
+        """
+        Memory-maps a SAS file instead of reading it into a str. Parsing scans the mapped bytes directly, offsets
+        in run records are byte offsets into the mapping.
+
+        :param path: path to SAS file
+        :param progress: optional ParseProgress
+        :param budget: optional ParseBudget
+        :return: StructuredSAS, call `close()` when done with it
+        """
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:  # Empty files can't be mapped
+                return cls("", progress=progress, budget=budget)
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(mapped, progress=progress, budget=budget)
+
+    @property
+    def is_mapped(self):
+        return not isinstance(self.raw_code, str)
+
+    def close(self):
+        if self.is_mapped:
+            self.raw_code.close()
+
+    def get_run_code(self, run):
+        """
+        Returns SAS code of a run record. Records keep only `run_spans` into `raw_code` and the text is
+        materialized here (decoded for memory-mapped files), without the comment markers `clean_initial_code` removes.
+        Records that carry their own `run_code` (e.g. runs of %included files) return it.
+        """
+        if "run_code" in run:
+            return run["run_code"]
+        parts = []
+        for start, end in run["run_spans"]:
+            code = self.raw_code[start:end]
+            if self.is_mapped:
+                code = code.decode("utf-8", errors="replace")
+            parts.append(_COMMENT_MARKER_STR.sub("", code))
+        return "\n".join(parts)
 
     def clean_initial_code(self):
-        self.struct_code = re.sub(r"/\*-*\*/\s*", "", self.raw_code)
+        """
+        Removes comment markers like /*-----*/. Their positions are kept, so offsets in the cleaned text can be
+        mapped back to `raw_code` (`to_raw_offset`).
+        """
+        self._removed_at = array("q")  # offsets in cleaned text where a marker was removed
+        self._removed_shift = array("q")  # total length removed up to and including that marker
+        if self.is_mapped:
+            # Comment markers don't affect parsing. For mapped files they're removed when run code is materialized,
+            # copying the whole file here would defeat the mapping.
+            self.struct_code = self.raw_code
+            return self
+
+        pieces = []
+        last = 0
+        shift = 0
+        for m in _COMMENT_MARKER_STR.finditer(self.raw_code):
+            pieces.append(self.raw_code[last:m.start()])
+            self._removed_at.append(m.start() - shift)
+            shift += m.end() - m.start()
+            self._removed_shift.append(shift)
+            last = m.end()
+        pieces.append(self.raw_code[last:])
+        self.struct_code = "".join(pieces)
         return self
 
+    def to_raw_offset(self, pos, is_end=False):
+        """
+        Maps an offset in the text cleaned by `clean_initial_code` to `raw_code`.
+        :param is_end: True for (exclusive) end offsets: an end right at a removed marker stays before it
+        """
+        i = bisect_left(self._removed_at, pos) if is_end else bisect_right(self._removed_at, pos)
+        return pos + (self._removed_shift[i - 1] if i else 0)
+
+    def build_line_index(self):
+        """
+        Offsets where each line of `raw_code` starts, for `line_col`.
+        """
+        newline = b"\n" if self.is_mapped else "\n"
+        self.line_offsets = array("q", [0])
+        pos = self.raw_code.find(newline)
+        while pos != -1:
+            self.line_offsets.append(pos + 1)
+            pos = self.raw_code.find(newline, pos + 1)
+        return self
+
+    @property
+    def line_count(self):
+        if self.line_offsets is None:
+            self.build_line_index()
+        return len(self.line_offsets)
+
+    def get_lines(self, first, last):
+        """
+        Text of a window of lines of `raw_code`, sliced with the line index, so the rest of the code isn't copied
+        (or, for memory-mapped files, read).
+        :param first: first line, starting at 1
+        :param last: last line, included. Clipped to the end of the code
+        :return: str
+        """
+        n = self.line_count
+        first, last = max(first, 1), min(last, n)
+        if first > last:
+            return ""
+        start = self.line_offsets[first - 1]
+        end = self.line_offsets[last] - 1 if last < n else len(self.raw_code)
+        text = self.raw_code[start:end]
+        return text.decode("utf-8", errors="replace") if self.is_mapped else text
+
+    def line_col(self, offset):
+        """
+        :param offset: offset in `raw_code` (characters, or bytes for memory-mapped files)
+        :return: (line, column), both starting at 1
+        """
+        line = bisect_right(self.line_offsets, offset)
+        return line, offset - self.line_offsets[line - 1] + 1
+
+    def source_of(self, run):
+        """
+        :return: StructuredSAS whose `raw_code` the offsets and lines of a run refer to: the file it was spliced in
+                 from, or this program
+        """
+        return self.sources.get(run.get("source_file"), self)
+
+    def reference_locations(self, dataset, kind=None):
+        """
+        Where a dataset is referenced in the code. Names are compared as in the graph, i.e. without library prefix.
+        :param dataset: dataset name as in `nodes`
+        :param kind: "input", "output" or None for both
+        :return: list of dicts with kind, name as written, start/end offsets in `raw_code`, line and column, in file
+                 order. For references in runs spliced in from an %include, `source_file` is the included file and
+                 offsets, line and column are in it
+        """
+        locations = []
+        for run in self.struct_code:
+            source = self.source_of(run)
+            source_file = run.get("source_file") if source is not self else None
+            for ref_kind, key in (("input", "input_refs"), ("output", "output_refs")):
+                if kind is not None and kind != ref_kind:
+                    continue
+                for name, start, end, line in run[key]:
+                    if name.split('.', 1)[-1] == dataset:
+                        locations.append({
+                            "kind": ref_kind, "name": name, "start": start, "end": end,
+                            "line": line, "column": source.line_col(start)[1], "source_file": source_file,
+                            "section_index": run["section_index"], "run_index": run["run_index"],
+                        })
+        # This program's references first
+        locations.sort(key=lambda x: (x["source_file"] is not None, x["source_file"] or "", x["start"]))
+        return locations
+
     def parse_sas_script(self):
-        def extract_inputs_outputs(run_code_):
-            """
-            Extracts input and output datasets from `DATA` and `PROC` steps.
-            - Outputs: Datasets from `DATA` statements.
-            - Inputs: Datasets from `SET`, `MERGE`, and `DATA=`/`OUT=` options in `PROC` steps.
-            """
-            inputs = set()
-            outputs = set()
-
-            # Capture the output dataset from DATA statements
-            data_match = re.search(r'\bDATA\s+([A-Z0-9_.]+)', run_code_, re.IGNORECASE)
-            if data_match:
-                outputs.add(data_match.group(1))
-
-            # Capture input datasets from SET
-            set_match = re.findall(r'\bSET\s+([A-Z0-9_.]+)', run_code_, re.IGNORECASE)
-            inputs.update(set_match)
-
-            # Capture input datasets from MERGE
-            merge_match = re.findall(r'\bMERGE\s+([^;]+)', run_code_, re.IGNORECASE)
-            for merge_group in merge_match:
-                merge_datasets = re.findall(r'\b([A-Z0-9_.]+)(?:\s*\(IN=[A-Z0-9_]+\))?', merge_group, re.IGNORECASE)
-                inputs.update(merge_datasets)
-
-            # Capture input/output datasets from PROC steps
-            proc_match = re.findall(r'\b(DATA|OUT)\s*=\s*([A-Z0-9_.]+)', run_code_, re.IGNORECASE)
-            for keyword, dataset in proc_match:
-                if keyword.upper() == "DATA":
-                    inputs.add(dataset)
-                elif keyword.upper() == "OUT":
-                    outputs.add(dataset)
-
-            return inputs, outputs
         """
         Parses a SAS script and extracts sections, runs, inputs, and outputs.
+
+        Sections and runs are located as (start, end) offsets into `self.struct_code`, which can be a str or a
+        memory-mapped file, and the regexes are run over those spans without copying them.
+        Each record keeps the offsets of its code in `raw_code` as `run_spans`, its first and last line as
+        `run_lines` and the position of every dataset reference as `input_refs`/`output_refs`. The code itself is
+        not copied, see `get_run_code`.
         """
+        self.build_line_index()
+        buf = self.struct_code
+        patterns = _PATTERNS[bytes if self.is_mapped else str]
+
+        # Split by comment blocks
+        sections = []
+        sec_start = 0
+        for m in patterns["section"].finditer(buf):
+            sections.append((sec_start, m.start()))
+            sec_start = m.end()
+        sections.append((sec_start, len(buf)))
 
-        sections = re.split(r'--#+', self.struct_code)  # Split by comment blocks
         parsed_data = []
-
-        for i_sec, section in enumerate(sections):
+        self.degraded_runs = []
+        if self.budget is not None:
+            self.budget.start()
+        run_blocks = get_run_block_store()
+        block_keys = []
+        memo_hits = 0
+
+        if self.progress is not None:
+            self.progress.set_stage("parsing")
+            self.progress.start_sections(len(sections))
+
+        for i_sec, (sec_start, sec_end) in enumerate(sections):
             """
               Splits a SAS section into individual runs based on full-line `RUN;` and `QUIT;`.
               This ensures comments and conditions remain part of the correct block.
             """
-            runs = re.split(r'\b(RUN|QUIT);\s*\n', section, flags=re.IGNORECASE)
-
-            for i_run, run_code in enumerate(runs):
-                run_code = run_code.strip()
-                if not run_code:
+            runs = []
+            run_start = sec_start
+            for m in patterns["run"].finditer(buf, sec_start, sec_end):
+                runs.append((run_start, m.start()))
+                run_start = m.end()
+            runs.append((run_start, sec_end))
+
+            for k, (run_start, run_end) in enumerate(runs):
+                if self.progress is not None:
+                    self.progress.check_cancelled()
+
+                run_start, run_end = _strip_span(buf, run_start, run_end)
+                if run_start == run_end:
                     continue
 
-                inputs, outputs = extract_inputs_outputs(run_code)
+                # Copies of a block seen before (in this program or any other) reuse its references
+                key = block_key(buf, run_start, run_end)
+                block_keys.append(key)
+                memo = run_blocks.get(key)
+                if memo is not None:
+                    memo_hits += 1
+                    input_rel, output_rel, code_hash = memo
+                    input_refs = [(name, run_start + start, run_start + end) for name, start, end in input_rel]
+                    output_refs = [(name, run_start + start, run_start + end) for name, start, end in output_rel]
+                else:
+                    code_hash = None
+                    degraded = len(self.budget.degraded) if self.budget is not None else 0
+                    if self.budget is None:
+                        input_refs, output_refs = extract_references(buf, run_start, run_end)
+                    else:
+                        input_refs, output_refs = self.budget.extract(buf, run_start, run_end, i_sec, 2 * k)
+                inputs = {ref[0] for ref in input_refs}
+                outputs = {ref[0] for ref in output_refs}
 
                 """
-                When split on RUN or QUIT is done, these split sites are separated from the run script. 
-                These parts result into output dictionaries with empty inputs,outputs and run_code stating only 'run' or quit'
-                That is split_residual (rubbish), therefore removed with this if statement 
-                (dont append to final output if its a split residual)
+                Runs without inputs and outputs are dropped.
                 NOTE: This also removes dictionary if it holds no inputs and run_code is only a comment
-
-                Other attemts to deal with it: 
-                Tried to use lookup regex, but it requires len('QUIT')==len('RUN') which is false. 
-                Could not by pass it by adding ';' to 'RUN' - returns more aforementioned split_residuals 
                 """
 
                 is_split_residual = all([inputs == set(), outputs == set()])
                 if not is_split_residual:
-                    parsed_data.append({
+                    raw_start, raw_end = self.to_raw_offset(run_start), self.to_raw_offset(run_end, is_end=True)
+                    if code_hash is None:
+                        code_hash = run_code_hash(self.get_run_code({"run_spans": [(raw_start, raw_end)]}))
+                    run = {
                         "section_index": i_sec,  # index of a section in code
-                        "run_index": i_run,  # index of a run in section
-                        "run_code": run_code + '',
+                        # index of a run in section. Kept as re.split(r'\b(RUN|QUIT);...') numbered them,
+                        # where every other element was the captured 'RUN'/'QUIT' residual
+                        "run_index": 2 * k,
+                        "run_spans": [(raw_start, raw_end)],  # offsets of the run's code in raw_code
+                        "run_lines": [(self.line_col(raw_start)[0], self.line_col(raw_end)[0])],  # first, last line
                         "inputs": list(inputs),
-                        "outputs": list(outputs)
-                    })
+                        "outputs": list(outputs),
+                        # (name as written, start, end, line) of every reference, offsets in raw_code
+                        "input_refs": [self._raw_ref(ref) for ref in input_refs],
+                        "output_refs": [self._raw_ref(ref) for ref in output_refs],
+                        "code_hash": code_hash,  # run_code_hash of the run's code, see get_code_hash
+                    }
+                    parsed_data.append(run)
+                    if self.progress is not None:
+                        self.progress.advance(runs=1)
+
+                # Heuristic results of blocks over budget are not memoized, they'd stand in for a full parse later
+                if memo is None and (self.budget is None or len(self.budget.degraded) == degraded):
+                    run_blocks.put(
+                        key,
+                        [(name, start - run_start, end - run_start) for name, start, end in input_refs],
+                        [(name, start - run_start, end - run_start) for name, start, end in output_refs],
+                        code_hash,
+                    )
+
+            if self.progress is not None:
+                self.progress.advance(sections=1)
+
+        if self.budget is not None:
+            # Degraded blocks located in raw_code, for the report
+            for block in self.budget.degraded:
+                raw_start = self.to_raw_offset(block["start"])
+                raw_end = self.to_raw_offset(block["end"], is_end=True)
+                self.degraded_runs.append({
+                    **block, "start": raw_start, "end": raw_end,
+                    "lines": (self.line_col(raw_start)[0], self.line_col(raw_end)[0]),
+                })
+
+        code_hashes = [run["code_hash"] for run in parsed_data]
+        self.dedup_stats = {
+            "blocks": len(block_keys),
+            "unique_blocks": len(set(block_keys)),
+            "memo_hits": memo_hits,  # blocks not scanned, their copy was parsed before in this process
+            "runs": len(code_hashes),
+            "unique_runs": len(set(code_hashes)),  # up to whitespace and case
+            "duplicate_ratio": 1 - len(set(code_hashes)) / len(code_hashes) if code_hashes else 0.0,
+        }
+
         self.pre_processed=parsed_data
         return self
 
+    def get_code_hash(self, run):
+        """
+        :return: run_code_hash of a run record's code, from the parse if it was computed there
+        """
+        code_hash = run.get("code_hash")
+        return code_hash if code_hash is not None else run_code_hash(self.get_run_code(run))
+
+    def _raw_ref(self, ref):
+        name, start, end = ref
+        start, end = self.to_raw_offset(start), self.to_raw_offset(end, is_end=True)
+        return name, start, end, self.line_col(start)[0]
+
     def merge_identity_runs(self):
         """
         Detects runs where `inputs` and `outputs` are identical single-element sets.
         Groups them by `inputs`, sorts by `section_index` and `run_index`,
         and concatenates their `run_code` with a newline separator.
+        Runs spliced in from different files (`source_file`) are grouped apart, so spans and lines of a merged run
+        all refer to one file.
         """
         grouped_runs = defaultdict(list)
 
         # Step 1: Identify and group runs with identical input/output
         for run in self.pre_processed:
             if len(run["inputs"]) == 1 and run["inputs"] == run["outputs"]:
-                key = tuple(run["inputs"])  # Convert set to a tuple (since it's a single element)
+                key = (run["inputs"][0], run.get("source_file"))  # The single dataset, per file
                 grouped_runs[key].append(run)
 
         # Step 2: Merge grouped runs
+        # Runs spliced in from an %include share the (section_index, run_index) of the statement, so runs are tracked
+        # by identity and ties are kept in their order in pre_processed
+        position = {id(run): i for i, run in enumerate(self.pre_processed)}
         merged_runs = []
-        seen_run_keys = set()
+        merged_position = {}
+        seen_runs = set()
 
         for group_key, runs in grouped_runs.items():
             # Sort by section_index and run_index
-            runs.sort(key=lambda x: (x["section_index"], x["run_index"]))
-
-            # Concatenate run_code
-            merged_run_code = "\n".join(run["run_code"] for run in runs)
+            runs.sort(key=lambda x: (x["section_index"], x["run_index"], position[id(x)]))
 
             # Create a new merged dictionary
             merged_run = {
                 "section_index": runs[0]["section_index"],
                 "run_index": runs[0]["run_index"],  # Keep the first run index
-                "run_code": merged_run_code,
+                "run_spans": [span for run in runs for span in run["run_spans"]],
                 "inputs": runs[0]["inputs"],
                 "outputs": runs[0]["outputs"]
             }
+            # Concatenated run_code is available with `get_run_code`, unless runs carry their own code
+            for key in ("run_lines", "input_refs", "output_refs"):
+                merged_run[key] = [item for run in runs for item in run[key]]
+            if len(runs) == 1 and "code_hash" in runs[0]:
+                merged_run["code_hash"] = runs[0]["code_hash"]
+            if any("run_code" in run for run in runs):
+                merged_run["run_code"] = "\n".join(self.get_run_code(run) for run in runs)
+            # Runs keep the file they came from (see IncludeResolver.resolve_runs)
+            if "source_file" in runs[0]:
+                for key in ("source_file", "source_section_index", "source_run_index"):
+                    merged_run[key] = runs[0][key]
             merged_runs.append(merged_run)
+            merged_position[id(merged_run)] = position[id(runs[0])]
 
-            # Track seen runs using (section_index, run_index)
+            # Track seen runs by identity
             for run in runs:
-                seen_run_keys.add((run["section_index"], run["run_index"]))
+                seen_runs.add(id(run))
 
         # Step 3: Keep other runs that were not merged
-        final_data = [run for run in self.pre_processed if
-                      (run["section_index"], run["run_index"]) not in seen_run_keys] + merged_runs
+        final_data = [run for run in self.pre_processed if id(run) not in seen_runs] + merged_runs
 
         # Sort final data by section_index and run_index again
-        final_data.sort(key=lambda x: (x["section_index"], x["run_index"]))
+        position.update(merged_position)
+        final_data.sort(key=lambda x: (x["section_index"], x["run_index"], position[id(x)]))
 
         self.struct_code=final_data
         return self
@@ -156,21 +742,36 @@ class StructuredSAS:
     def assign_subgraph_ids(self):
         """
         Assigns a unique `sub_graph_id` to each SAS run based on dataset dependencies.
-        Uses `networkx` to detect subnetworks.
+        Subnetworks (weakly connected components of the input -> output graph) are found with union-find.
+        Subgraphs are numbered in the order their first dataset appears.
         """
-        G = nx.DiGraph()
+        parent = {}
 
-        # Step 1: Build the directed graph
-        for run in self.struct_code:
-            for inp in set(run["inputs"]):  # Ensure inputs are treated as a set
-                for out in set(run["outputs"]):  # Ensure outputs are treated as a set
-                    G.add_edge(inp, out)  # Directed edge from input to output
+        def find(dataset):
+            root = dataset
+            while parent[root] != root:
+                root = parent[root]
+            while parent[dataset] != root:  # Path compression
+                parent[dataset], dataset = root, parent[dataset]
+            return root
 
-        # Step 2: Identify weakly connected components (subgraphs)
+        # Step 1: Union the datasets of every input -> output edge
+        for run in self.struct_code:
+            if not run["inputs"] or not run["outputs"]:
+                continue
+            for dataset in (*run["inputs"], *run["outputs"]):
+                parent.setdefault(dataset, dataset)
+            root = find(run["inputs"][0])
+            for dataset in (*run["inputs"], *run["outputs"]):
+                other = find(dataset)
+                if other != root:
+                    parent[other] = root
+
+        # Step 2: Number the components (subgraphs)
         subgraph_mapping = {}
-        for subgraph_id, component in enumerate(nx.connected_components(G.to_undirected())):
-            for dataset in component:
-                subgraph_mapping[dataset] = subgraph_id  # Map datasets to a subgraph ID
+        subgraph_ids = {}
+        for dataset in parent:
+            subgraph_mapping[dataset] = subgraph_ids.setdefault(find(dataset), len(subgraph_ids))
 
         # Step 3: Assign `sub_graph_id` to each run
         for run in self.struct_code:
@@ -183,47 +784,15 @@ class StructuredSAS:
 
     def clean_run_code(self):
         """
-        Cleans the `run_code` values in the parsed SAS results dictionary list.
-
-        Fixes:
-        - Removes special characters like `?` and inline comments (`/* */`).
-        - Replaces newlines with `\n` literal inside Mermaid `[ ... ]` brackets.
-        - Ensures Mermaid compatibility for `run_code` values.
+        Adds Mermaid-compatible `run_code` (see `escape_run_code`) to the records of `struct_code`.
 
-        Args:
-            parsed_results (list): List of dictionaries containing SAS parsing results.
-
-        Returns:
-            list: Cleaned list of dictionaries.
+        Not part of `execute_all_processing_steps`: records locate their code with `run_spans` and the escaped text
+        is only needed for Mermaid charts, so call this (or `escape_run_code`) when generating them.
         """
-        cleaned_results = []
-
-        for entry in self.struct_code:
-            run_code = entry.get("run_code", "")
-
-            # Remove inline comments (/* ... */)
-            run_code = re.sub(r"/\*.*?\*/", "", run_code, flags=re.DOTALL)
-
-            # Remove special characters that may break Mermaid
-            run_code = run_code.replace("?", "")
-
-            # Replace raw newlines inside a Mermaid-friendly structure
-            run_code = [x.strip().replace(r'\n', "<br>") for x in run_code.splitlines()]
-            run_code = '<br>'.join(run_code)
-            run_code = re.sub("<br>+", "<br>", run_code)
-
-            # run_code = run_code.replace("\n", r"\n")
-
-            # Replacing single and double quotes
-            run_code = run_code.replace("'", "&apos;")
-            run_code = run_code.replace("\"", "&apos;")
-
-            # Store cleaned result
-            cleaned_entry = entry.copy()
-            cleaned_entry["run_code"] = run_code
-            cleaned_results.append(cleaned_entry)
-
-        self.struct_code=cleaned_results
+        # Identical run code is escaped once and shares one str, see RunBlockStore.escaped
+        run_blocks = get_run_block_store()
+        self.struct_code = [{**entry, "run_code": run_blocks.escaped(self.get_run_code(entry), escape_run_code)}
+                            for entry in self.struct_code]
         return self
 
     def clean_input_output_names(self):
@@ -235,12 +804,13 @@ class StructuredSAS:
             in the network - they reduce accuracy of the graph
 
             :param run_structured:
-            :return: dict of structured run code
+            :return: dict of structured run code, a copy: records of `pre_processed` keep their full names
             """
-            run_structured['inputs'] = [val.split('.', 1)[1] if '.' in val else val for val in run_structured['inputs']]
-            run_structured['outputs'] = [val.split('.', 1)[1] if '.' in val else val for val in run_structured['outputs']]
-
-            return run_structured
+            return {
+                **run_structured,
+                'inputs': [val.split('.', 1)[1] if '.' in val else val for val in run_structured['inputs']],
+                'outputs': [val.split('.', 1)[1] if '.' in val else val for val in run_structured['outputs']],
+            }
 
         self.struct_code = [keep_tbl_name_only(run) for run in self.struct_code]
         return self
@@ -320,16 +890,173 @@ class StructuredSAS:
 
         return self
 
+    def classify_datasets(self):
+        """
+        Classifies every dataset into one of DATASET_CLASSES with set operations on inputs, outputs and edges.
+        Librefs are taken from the output references, as `clean_input_output_names` strips them from the names.
+        :return: self (values for dataset_classes: dict dataset -> class)
+        """
+        read = set(self.inputs)
+        written = set(self.outputs)
+
+        # Written to a permanent library (libref other than WORK) at least once
+        persisted = set()
+        for run in self.struct_code:
+            for name, *_ in run.get('output_refs', ()):
+                name = _as_str(name)
+                if '.' in name and name.split('.', 1)[0].lower() != 'work':
+                    persisted.add(name.split('.', 1)[1])
+
+        fan_in = defaultdict(int)
+        fan_out = defaultdict(int)
+        for u, v in set(self.edges):
+            fan_out[u] += 1
+            fan_in[v] += 1
+
+        classes = {}
+        for node in self.nodes:
+            if not fan_in[node] and not fan_out[node]:
+                classes[node] = 'orphan'
+            elif node not in written:
+                classes[node] = 'source'
+            elif node not in read:
+                classes[node] = 'sink' if node in persisted else 'dead'
+            elif fan_in[node] == 1 and fan_out[node] == 1:
+                classes[node] = 'pass_through'
+            else:
+                classes[node] = 'intermediate'
+        self.dataset_classes = classes
+        self._pruned = {}
+        return self
+
+    def get_pruned_graph(self, drop=("orphan", "dead"), collapse_pass_through=True):
+        """
+        Nodes and edges without the clutter found by `classify_datasets`, for the create_pyvis_*_layout functions.
+        Cached per set of options.
+        :param drop: classes of datasets to leave out, with their edges
+        :param collapse_pass_through: replace chains a -> pass_through -> ... -> b by the edge a -> b
+        :return: (nodes, edges)
+        """
+        from utils.graph_utils import prune_graph
+        key = (tuple(sorted(drop)), collapse_pass_through)
+        if key not in self._pruned:
+            self._pruned[key] = prune_graph(self.nodes, self.edges, self.dataset_classes, drop, collapse_pass_through)
+        return self._pruned[key]
+
+    def get_lineage_graph(self):
+        """
+        Array representation of nodes and edges (utils.graph_utils.LineageGraph). Built once and kept with
+        this object, together with everything computed on it (layers, components...).
+        """
+        if self.lineage_graph is None:
+            from utils.graph_utils import LineageGraph
+            self.lineage_graph = LineageGraph(self.nodes, self.edges)
+        return self.lineage_graph
+
+    def get_provenance_index(self):
+        """
+        Which runs are behind every edge and dataset, for looking up run code on demand (e.g. graph tooltips served
+        by utils.service_utils) instead of shipping it with the graph. Built once from struct_code.
+        :return: {"edges": {(input, output): [run numbers]}, "outputs": {dataset: [run numbers writing it]}},
+                 run numbers index struct_code
+        """
+        if self.provenance is None:
+            edge_runs = {}
+            output_runs = {}
+            for j, run in enumerate(self.struct_code):
+                for out in run["outputs"]:
+                    output_runs.setdefault(out, []).append(j)
+                    for inp in run["inputs"]:
+                        if inp != out:
+                            edge_runs.setdefault((inp, out), []).append(j)
+            self.provenance = {"edges": edge_runs, "outputs": output_runs}
+        return self.provenance
+
+    def get_hotspots(self):
+        """
+        Bottleneck analytics of the lineage graph (utils.hotspot_utils.HotspotAnalysis): fan-in/out, PageRank,
+        betweenness, critical path. Kept with this object, so every metric is computed once.
+        """
+        if self.hotspots is None:
+            from utils.hotspot_utils import HotspotAnalysis
+            self.hotspots = HotspotAnalysis(self.get_lineage_graph())
+        return self.hotspots
+
+    def derived_caches(self):
+        """
+        Caches attached on demand after parsing (see DERIVED_CACHES), which grow the object while it's stored.
+        :return: dict attribute name -> cache, for the ones built
+        """
+        return {name: getattr(self, name) for name in DERIVED_CACHES if getattr(self, name) is not None}
+
+    def derived_signature(self):
+        """
+        Cheap fingerprint of what the derived caches hold: changes when a cache is attached, or caches a result of
+        its own (cached_property values and dicts in the cache's __dict__).
+        :return: tuple
+        """
+        signature = []
+        for name in DERIVED_CACHES:
+            cache = getattr(self, name)
+            if cache is None:
+                signature.append(-1)
+            elif hasattr(cache, "__dict__"):
+                attrs = vars(cache)
+                signature.append(len(attrs) + sum(len(v) for v in attrs.values() if isinstance(v, dict)))
+            else:
+                signature.append(len(cache))
+        return tuple(signature)
+
+    def run_position(self, pos):
+        """
+        Locates an offset of the parsed text (after `clean_initial_code`, before `merge_identity_runs`) in the
+        section/run numbering of `parse_sas_script`.
+        :return: (section_index, run_index) of the run block containing pos
+        """
+        buf = self.struct_code
+        patterns = _PATTERNS[bytes if self.is_mapped else str]
+        section_index = 0
+        sec_start = 0
+        for m in patterns["section"].finditer(buf, 0, pos):
+            section_index += 1
+            sec_start = m.end()
+        k = sum(1 for m in patterns["run"].finditer(buf, sec_start, pos) if m.end() <= pos)
+        return section_index, 2 * k
+
+    def process_parsed_runs(self):
+        """
+        Steps after `parse_sas_script`: builds `struct_code`, metadata, nodes and edges from `pre_processed`.
+        """
+        if self.progress is not None:
+            self.progress.set_stage("building graph")
+        self.merge_identity_runs()\
+            .assign_subgraph_ids()\
+            .clean_input_output_names()\
+            .get_metadata()\
+            .get_metadata_network()\
+            .classify_datasets()
+        if self.progress is not None:
+            self.progress.set_stage("done")
+        return self
+
     def execute_all_processing_steps(self):
-        return (
-            self.clean_initial_code()\
-                .parse_sas_script()\
-                .merge_identity_runs()\
-                .assign_subgraph_ids()\
-                .clean_run_code()\
-                .clean_input_output_names()\
-                .get_metadata()\
-                .get_metadata_network())
+        with get_metrics().timed("parse_seconds"):
+            self.clean_initial_code().parse_sas_script().process_parsed_runs()
+        return self.record_metrics()
+
+    def record_metrics(self, seconds=None):
+        """
+        Records the size of this parse in the process-wide metrics, which execute_all_processing_steps does itself.
+        :param seconds: duration of the parse, for a parse that ran in another process (see utils.worker_utils)
+        """
+        metrics = get_metrics()
+        if seconds is not None:
+            metrics.observe("parse_seconds", seconds)
+        metrics.observe("parse_input_size", len(self.raw_code))
+        metrics.observe("parse_runs", len(self.struct_code))
+        metrics.observe("graph_nodes", len(self.nodes))
+        metrics.observe("graph_edges", len(self.edges))
+        return self
 
     def save_results(self):
         # Save parsed results as JSON
@@ -337,7 +1064,7 @@ class StructuredSAS:
         output_json_path = "../data/parsed_sas_results.json"
 
         with open(output_json_path, "w", encoding="utf-8") as json_file:
-            json.dump(self.struct_code, json_file, indent=4)
+            json.dump([{**run, "run_code": self.get_run_code(run)} for run in self.struct_code], json_file, indent=4)
 
         print(f"Parsed results saved to {output_json_path}")
         print("Head of saved file:")
@@ -348,10 +1075,8 @@ class StructuredSAS:
 if __name__ == '__main__':
     # Example usage
     sas_file_path = "../data/example.sas"  # Replace with your actual SAS file
-    with open(sas_file_path, 'r', encoding='utf-8') as file:
-        sas_script = file.read()
 
-    struct_SAS = StructuredSAS(sas_script)
+    struct_SAS = StructuredSAS.from_file(sas_file_path)
     struct_SAS = struct_SAS.clean_initial_code()
     struct_SAS = struct_SAS.parse_sas_script()
     struct_SAS = struct_SAS.merge_identity_runs()
@@ -360,6 +1085,7 @@ if __name__ == '__main__':
     struct_SAS = struct_SAS.get_metadata()
     struct_SAS = struct_SAS.get_metadata_network()
     struct_SAS.save_results()
+    struct_SAS.close()
 
 
 
@@ -0,0 +1,209 @@
+import json
+import heapq
+import argparse
+
+
+def run_lines_cost(run):
+    """
+    Default cost of a run: number of lines of its code. A rough proxy for runtime, pass measured durations instead
+    when they are known (e.g. real times from SAS logs).
+    """
+    return sum(end - start + 1 for start, end in run.get("run_lines", ())) or 1
+
+
+class ExecutionPlan:
+    """
+    Parallel execution plan of the runs (DATA/PROC steps) of a parsed SAS program.
+
+    Runs depend on each other through the datasets they read and write, in file order:
+    - read after write: a run reading a dataset waits for the last run that wrote it before,
+    - write after read: a run writing a dataset waits for the runs that read its previous version,
+    - write after write: a run writing a dataset waits for the last run that wrote it before.
+    Dependencies only point back in file order, so the plan is acyclic even where the lineage graph has cycles
+    (e.g. `DATA a; SET a; RUN;`), and running it gives the same result as running the file top to bottom.
+
+    Runs are grouped into waves (every run of a wave can run at once, once the waves before it are done),
+    the critical path is the chain of dependent runs with the largest total cost, and `simulate` estimates the
+    makespan with N workers by list scheduling, longest remaining path first.
+
+    Usage:
+    >>> plan = ExecutionPlan(struct_SAS).build()
+    >>> plan.simulate(workers=4)["makespan"]
+    """
+    def __init__(self, struct_SAS, costs=None):
+        """
+        :param struct_SAS: StructuredSAS processed with execute_all_processing_steps
+        :param costs: optional list with the cost (e.g. runtime in seconds) of every run of struct_SAS.struct_code,
+                      defaults to run_lines_cost
+        """
+        self.runs = struct_SAS.struct_code
+        self.costs = list(costs) if costs is not None else [run_lines_cost(run) for run in self.runs]
+        if len(self.costs) != len(self.runs):
+            raise ValueError(f"Expected {len(self.runs)} costs, one per run, got {len(self.costs)}")
+        self.dependencies = None
+        self.hazards = None
+        self.waves = None
+        self.earliest_finish = None
+        self.remaining = None
+        self._simulations = {}  # workers -> result of simulate
+
+    def build_dependencies(self):
+        """
+        :return: self (values for dependencies: list of sorted run numbers each run waits for,
+                 hazards: counts of 'read_after_write', 'write_after_read', 'write_after_write' dependencies)
+        """
+        last_writer = {}
+        readers = {}  # dataset -> runs that read its current version
+        self.dependencies = []
+        self.hazards = {"read_after_write": 0, "write_after_read": 0, "write_after_write": 0}
+
+        for j, run in enumerate(self.runs):
+            deps = set()
+            for dataset in run["inputs"]:
+                if dataset in last_writer:
+                    deps.add(last_writer[dataset])
+                    self.hazards["read_after_write"] += 1
+            for dataset in run["outputs"]:
+                if dataset in last_writer:
+                    deps.add(last_writer[dataset])
+                    self.hazards["write_after_write"] += 1
+                war = [i for i in readers.get(dataset, ()) if i != j]
+                deps.update(war)
+                self.hazards["write_after_read"] += len(war)
+            for dataset in run["outputs"]:
+                last_writer[dataset] = j
+                readers[dataset] = []
+            outputs = set(run["outputs"])
+            for dataset in run["inputs"]:
+                if dataset not in outputs:
+                    readers.setdefault(dataset, []).append(j)
+            deps.discard(j)
+            self.dependencies.append(sorted(deps))
+        return self
+
+    def compute_waves(self):
+        """
+        Dependencies point back in file order, so one pass in file order gives waves and earliest finish times,
+        and one pass backwards the remaining critical path of every run.
+        :return: self (values for waves: list of lists of run numbers, earliest_finish and remaining per run)
+        """
+        n = len(self.runs)
+        level = [0] * n
+        self.earliest_finish = [0.0] * n
+        for j, deps in enumerate(self.dependencies):
+            if deps:
+                level[j] = 1 + max(level[i] for i in deps)
+                self.earliest_finish[j] = self.costs[j] + max(self.earliest_finish[i] for i in deps)
+            else:
+                self.earliest_finish[j] = self.costs[j]
+
+        self.waves = [[] for _ in range(max(level, default=-1) + 1)]
+        for j, lvl in enumerate(level):
+            self.waves[lvl].append(j)
+
+        # Cost of the heaviest chain from each run to the end of the program, the run included
+        self.remaining = list(self.costs)
+        for j in range(n - 1, -1, -1):
+            for i in self.dependencies[j]:
+                self.remaining[i] = max(self.remaining[i], self.costs[i] + self.remaining[j])
+        self._simulations = {}
+        return self
+
+    def build(self):
+        return self.build_dependencies().compute_waves()
+
+    def critical_path(self):
+        """
+        :return: (list of run numbers on the critical path in execution order, its total cost)
+        """
+        if not self.runs:
+            return [], 0
+        j = max(range(len(self.runs)), key=lambda k: self.earliest_finish[k])
+        length = self.earliest_finish[j]
+        path = [j]
+        while self.dependencies[j]:
+            j = max(self.dependencies[j], key=lambda k: self.earliest_finish[k])
+            path.append(j)
+        return path[::-1], length
+
+    def simulate(self, workers):
+        """
+        Simulates running the plan on `workers` parallel workers. Whenever a worker is free it takes the ready run
+        with the longest remaining critical path. Kept per number of workers, so repeated calls (e.g. every rerun
+        of the app) are free.
+        :return: dict with makespan, speedup over one worker, utilization and the schedule:
+                 list of (run number, worker, start, finish). Shared by every call, don't modify it
+        """
+        if workers < 1:
+            raise ValueError("workers must be at least 1")
+        if workers not in self._simulations:
+            self._simulations[workers] = self._simulate(workers)
+        return self._simulations[workers]
+
+    def _simulate(self, workers):
+        n = len(self.runs)
+        waiting = [len(deps) for deps in self.dependencies]
+        dependents = [[] for _ in range(n)]
+        for j, deps in enumerate(self.dependencies):
+            for i in deps:
+                dependents[i].append(j)
+
+        ready = [(-self.remaining[j], j) for j in range(n) if not waiting[j]]
+        heapq.heapify(ready)
+        running = []  # (finish, worker, run)
+        free_workers = list(range(min(workers, n)))  # already a heap
+        schedule = []
+        now = 0.0
+
+        while ready or running:
+            while ready and free_workers:
+                _, j = heapq.heappop(ready)
+                worker = heapq.heappop(free_workers)
+                heapq.heappush(running, (now + self.costs[j], worker, j))
+                schedule.append((j, worker, now, now + self.costs[j]))
+            now, worker, j = heapq.heappop(running)
+            heapq.heappush(free_workers, worker)
+            for k in dependents[j]:
+                waiting[k] -= 1
+                if not waiting[k]:
+                    heapq.heappush(ready, (-self.remaining[k], k))
+
+        total = float(sum(self.costs))
+        makespan = now
+        return {
+            "workers": workers,
+            "makespan": makespan,
+            "speedup": total / makespan if makespan else 1.0,
+            "utilization": total / (makespan * workers) if makespan else 1.0,
+            "schedule": sorted(schedule, key=lambda x: (x[2], x[1])),
+        }
+
+    def summary(self, workers=(1, 2, 4, 8, 16)):
+        """
+        :return: dict, JSON serializable
+        """
+        path, length = self.critical_path()
+        total = float(sum(self.costs))
+        return {
+            "runs": len(self.runs),
+            "waves": len(self.waves),
+            "max_wave_width": max((len(wave) for wave in self.waves), default=0),
+            "hazards": self.hazards,
+            "total_cost": total,
+            "critical_path": path,
+            "critical_path_cost": length,
+            "max_speedup": total / length if length else 1.0,
+            "makespan": {w: {k: v for k, v in self.simulate(w).items() if k != "schedule"} for w in workers},
+        }
+
+
+if __name__ == '__main__':
+    # Usage: python -m utils.schedule_utils program.sas [--workers 1 2 4 8]
+    from utils.parse_utils import StructuredSAS
+    parser = argparse.ArgumentParser(description="Parallel execution plan of a SAS program")
+    parser.add_argument("path")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    args = parser.parse_args()
+    struct_SAS = StructuredSAS.from_file(args.path).execute_all_processing_steps()
+    print(json.dumps(ExecutionPlan(struct_SAS).build().summary(args.workers), indent=4))
+    struct_SAS.close()
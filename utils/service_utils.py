@@ -0,0 +1,334 @@
+import os
+import sys
+import json
+import asyncio
+import threading
+from urllib.parse import urlsplit
+from concurrent.futures import ProcessPoolExecutor
+
+import tornado.web
+
+from utils.parse_utils import StructuredSAS, ParseBudget
+from utils.cache_utils import get_parse_store, script_key
+from utils.metrics_utils import get_metrics
+
+SERVICE_PORT = int(os.environ.get("SAS2PY_SERVICE_PORT", 8765))
+SERVICE_WORKERS = int(os.environ.get("SAS2PY_SERVICE_WORKERS", os.cpu_count() or 1))
+
+# Service started inside the Streamlit process for graph tooltips (see start_tooltip_service), the address it binds
+# to, and the URL the browser reaches it at. Without a URL, tooltips work only for browsers on the server host
+# (http://localhost:<port>): behind a proxy or on another host, set it to the public URL routed to the service.
+TOOLTIP_PORT = int(os.environ.get("SAS2PY_TOOLTIP_PORT", 8766))
+TOOLTIP_ADDRESS = os.environ.get("SAS2PY_TOOLTIP_ADDRESS", "127.0.0.1")
+TOOLTIP_URL = os.environ.get("SAS2PY_TOOLTIP_URL")
+
+# Origins allowed to read the service from a browser (CORS), comma separated. start_tooltip_service adds the origin
+# of the Streamlit app, other web pages can't read run code
+CORS_ORIGINS = [o.strip().rstrip("/") for o in os.environ.get("SAS2PY_CORS_ORIGINS", "").split(",") if o.strip()]
+
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1")
+
+# Runs and lines of run code returned per lookup of /runs, tooltips don't need more
+RUNS_LIMIT = 5
+RUN_CODE_MAX_LINES = 40
+
+
+def _parse_in_process(sas_script):
+    # Runs in a worker process, the parsed object is pickled back to the service
+    return StructuredSAS(sas_script, budget=ParseBudget()).execute_all_processing_steps()
+
+
+class LineageService:
+    """
+    State shared by the request handlers: the process-wide ParseStore, a process pool for parsing,
+    the parses in flight, so identical scripts sent concurrently are parsed once, and the origins allowed to read
+    responses from a browser.
+    Work on parsed objects that can take a while (storing them, building their graph or indexes) runs in the
+    loop's default thread pool through `compute`, never on the event loop.
+    """
+    def __init__(self, workers=SERVICE_WORKERS, store=None, allowed_origins=CORS_ORIGINS):
+        """
+        :param workers: size of the parse process pool, 0 for a read-only service without one (see make_tooltip_app)
+        """
+        self.store = store if store is not None else get_parse_store()
+        self.executor = ProcessPoolExecutor(max_workers=workers) if workers else None
+        self.allowed_origins = set(allowed_origins)
+        self._in_flight = {}
+
+    async def parse(self, sas_script):
+        """
+        :return: (key, StructuredSAS), from the store if this script was parsed before
+        """
+        key = script_key(sas_script)
+        struct_SAS = await self.compute(self.store.get, key)
+        if struct_SAS is not None:
+            return key, struct_SAS
+
+        future = self._in_flight.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = asyncio.ensure_future(self._parse_and_store(loop, key, sas_script))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return key, await asyncio.shield(future)
+
+    async def _parse_and_store(self, loop, key, sas_script):
+        # Metrics of the parse itself stay in the worker process, so the service times it here
+        with get_metrics().timed("service_parse_seconds"):
+            struct_SAS = await loop.run_in_executor(self.executor, _parse_in_process, sas_script)
+        # Sizing it for the store walks the whole object
+        await self.compute(self.store.put, key, struct_SAS)
+        return struct_SAS
+
+    async def compute(self, function, *args):
+        """
+        :return: function(*args), run in a thread so the event loop keeps serving other requests
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class _BaseHandler(tornado.web.RequestHandler):
+    def initialize(self, service):
+        self.service = service
+
+    def write_json(self, data, status=200):
+        self.set_status(status)
+        self.set_header("Content-Type", "application/json")
+        # Graph html of the app fetches run code cross-origin (Streamlit components are srcdoc iframes, with the
+        # app's origin). Only allowed origins may read the response
+        origin = self.request.headers.get("Origin")
+        if origin in self.service.allowed_origins:
+            self.set_header("Access-Control-Allow-Origin", origin)
+        self.set_header("Vary", "Origin")
+        self.finish(json.dumps(data, separators=(",", ":")))
+
+    async def get_parsed(self, key):
+        # A store lookup measures caches built on the entry since its last lookup, see ParseStore.get
+        struct_SAS = await self.service.compute(self.service.store.get, key)
+        if struct_SAS is None:
+            raise tornado.web.HTTPError(404, reason="Unknown script key, POST the script to /parse first")
+        return struct_SAS
+
+    def write_error(self, status_code, exc_info=None, **kwargs):
+        # e.g. "Missing argument dataset" of a MissingArgumentError, otherwise the reason
+        message = getattr(exc_info[1], "log_message", None) if exc_info else None
+        self.write_json({"error": message or self._reason}, status=status_code)
+
+
+class ParseHandler(_BaseHandler):
+    async def post(self):
+        """
+        Body: SAS script (utf-8 text). Returns its key for the other endpoints and graph size.
+        """
+        sas_script = self.request.body.decode("utf-8", errors="replace")
+        key, struct_SAS = await self.service.parse(sas_script)
+        self.write_json({
+            "key": key, "nodes": len(struct_SAS.nodes), "edges": len(struct_SAS.edges),
+            "degraded_runs": [
+                {"lines": block["lines"], "bytes": block["bytes"], "reason": block["reason"]}
+                for block in struct_SAS.degraded_runs
+            ],
+            "dedup": struct_SAS.dedup_stats,
+        })
+
+
+class NodesHandler(_BaseHandler):
+    async def get(self, key):
+        self.write_json({"nodes": sorted((await self.get_parsed(key)).nodes)})
+
+
+class EdgesHandler(_BaseHandler):
+    async def get(self, key):
+        self.write_json({"edges": (await self.get_parsed(key)).edges})
+
+
+def _lineage_of(struct_SAS, dataset, direction, max_hops):
+    """
+    :return: {name: hops} of the datasets reached from dataset, None if it isn't in the graph
+    """
+    graph = struct_SAS.get_lineage_graph()
+    if dataset not in graph.index:
+        return None
+    distances = graph.hop_distances([dataset], direction, max_hops)
+    return {graph.nodes[i]: int(distances[i]) for i in (distances > 0).nonzero()[0]}
+
+
+def _runs_of(struct_SAS, source, target, dataset):
+    """
+    :return: (runs as returned by RunsHandler, number of runs found, whether they are the edge's own runs)
+    """
+    provenance = struct_SAS.get_provenance_index()
+    direct = True
+    if target is not None:
+        runs = provenance["edges"].get((source, target))
+        if runs is None:
+            runs, direct = provenance["outputs"].get(target, []), False
+    else:
+        runs = provenance["outputs"].get(dataset, [])
+
+    result = []
+    for j in runs[:RUNS_LIMIT]:
+        run = struct_SAS.struct_code[j]
+        lines = struct_SAS.get_run_code(run).split("\n")
+        code = "\n".join(lines[:RUN_CODE_MAX_LINES])
+        if len(lines) > RUN_CODE_MAX_LINES:
+            code += f"\n... {len(lines) - RUN_CODE_MAX_LINES} more lines"
+        result.append({"lines": [run["run_lines"][0][0], run["run_lines"][-1][1]], "code": code})
+    return result, len(runs), direct
+
+
+class LineageHandler(_BaseHandler):
+    async def get(self, key, direction):
+        """
+        Query: dataset=<name>, optional hops=<max number of hops>
+        """
+        dataset = self.get_query_argument("dataset")
+        hops = self.get_query_argument("hops", None)
+        max_hops = None
+        if hops:
+            try:
+                max_hops = int(hops)
+            except ValueError:
+                max_hops = -1
+            if max_hops < 0:
+                raise tornado.web.HTTPError(400, reason=f"hops must be a non-negative integer, not {hops!r}")
+        struct_SAS = await self.get_parsed(key)
+        reached = await self.service.compute(_lineage_of, struct_SAS, dataset, direction, max_hops)
+        if reached is None:
+            raise tornado.web.HTTPError(404, reason=f"Unknown dataset {dataset}")
+        self.write_json({"dataset": dataset, direction: reached})
+
+
+class RunsHandler(_BaseHandler):
+    async def get(self, key):
+        """
+        Query: source=<name>&target=<name> for the runs behind an edge, or dataset=<name> for the runs writing it.
+        Edges without a run of their own (e.g. collapsed pass-through chains of the pruned graph) fall back to
+        the runs writing the target, with "direct": false.
+        """
+        struct_SAS = await self.get_parsed(key)
+        target = self.get_query_argument("target", None)
+        if target is not None:
+            source, dataset = self.get_query_argument("source"), None
+        else:
+            source, dataset = None, self.get_query_argument("dataset")
+        runs, total, direct = await self.service.compute(_runs_of, struct_SAS, source, target, dataset)
+        self.write_json({"runs": runs, "total": total, "direct": direct})
+
+
+class StatsHandler(_BaseHandler):
+    def get(self):
+        self.write_json({"store": self.service.store.stats(), "parses_in_flight": len(self.service._in_flight)})
+
+
+class MetricsHandler(_BaseHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.finish(get_metrics().render())
+
+
+def make_app(service=None):
+    """
+    Endpoints:
+        POST /parse                                       -> {"key", "nodes", "edges", "degraded_runs", "dedup"}
+        GET  /scripts/<key>/nodes                         -> {"nodes": [...]}
+        GET  /scripts/<key>/edges                         -> {"edges": [[src, dst], ...]}
+        GET  /scripts/<key>/upstream?dataset=X&hops=N     -> {"dataset", "upstream": {name: hops}}
+        GET  /scripts/<key>/downstream?dataset=X&hops=N   -> {"dataset", "downstream": {name: hops}}
+        GET  /scripts/<key>/runs?source=X&target=Y       -> {"runs": [{"lines", "code"}], "total", "direct"}
+        GET  /scripts/<key>/runs?dataset=X                -> runs writing X, as above
+        GET  /stats                                       -> parse store statistics
+        GET  /metrics                                     -> metrics of this process, Prometheus text format
+    """
+    service = service if service is not None else LineageService()
+    args = {"service": service}
+    return tornado.web.Application([
+        (r"/parse", ParseHandler, args),
+        (r"/scripts/([0-9a-f]+)/nodes", NodesHandler, args),
+        (r"/scripts/([0-9a-f]+)/edges", EdgesHandler, args),
+        (r"/scripts/([0-9a-f]+)/(upstream|downstream)", LineageHandler, args),
+        (r"/scripts/([0-9a-f]+)/runs", RunsHandler, args),
+        (r"/stats", StatsHandler, args),
+        (r"/metrics", MetricsHandler, args),
+    ])
+
+
+def make_tooltip_app(service):
+    """
+    Read-only app for graph tooltips: only GET /scripts/<key>/runs (see make_app), on scripts the Streamlit app
+    already parsed into the store. Nothing can be parsed through it.
+    """
+    return tornado.web.Application([
+        (r"/scripts/([0-9a-f]+)/runs", RunsHandler, {"service": service}),
+    ])
+
+
+async def serve(port=SERVICE_PORT, address="127.0.0.1"):
+    service = LineageService()
+    app = make_app(service)
+    server = app.listen(port, address=address)
+    print(f"Lineage service on http://{address}:{port}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        server.stop()
+        service.shutdown()
+
+
+def is_local_origin(origin):
+    """
+    :return: True if a browser at `origin` runs on this host, so it can reach the service at localhost
+    """
+    return origin is not None and urlsplit(origin).hostname in LOCAL_HOSTS
+
+
+_tooltip_service = None
+_tooltip_lock = threading.Lock()
+
+
+def start_tooltip_service(app_origin, port=TOOLTIP_PORT, address=TOOLTIP_ADDRESS):
+    """
+    Runs the read-only tooltip app (make_tooltip_app) in a daemon thread of this process, on the process-wide parse
+    store, so graph html rendered by this process can fetch run code of its edges and nodes on demand. Started once per process, every call
+    allows its app origin to read the service.
+    :param app_origin: origin the browser reaches the Streamlit app at, e.g. http://analytics.example.com:8501
+    :return: base URL for the browser (TOOLTIP_URL or http://localhost:<port>), None if the service couldn't start
+             (e.g. port in use) or the browser can't reach it (not on this host and no TOOLTIP_URL)
+    """
+    global _tooltip_service
+    if app_origin is None or (TOOLTIP_URL is None and not is_local_origin(app_origin)):
+        return None
+    with _tooltip_lock:
+        if _tooltip_service is None:
+            started = threading.Event()
+            state = {"error": None, "service": LineageService(workers=0)}
+
+            async def run():
+                try:
+                    make_tooltip_app(state["service"]).listen(port, address=address)
+                except OSError as e:
+                    state["error"] = e
+                    return
+                finally:
+                    started.set()
+                await asyncio.Event().wait()
+
+            threading.Thread(target=asyncio.run, args=(run(),), name="sas-tooltips", daemon=True).start()
+            started.wait()
+            _tooltip_service = state
+        if _tooltip_service["error"]:
+            return None
+        _tooltip_service["service"].allowed_origins.add(app_origin.rstrip("/"))
+    return TOOLTIP_URL or f"http://localhost:{port}"
+
+
+if __name__ == '__main__':
+    # Usage: python -m utils.service_utils [port]
+    try:
+        asyncio.run(serve(int(sys.argv[1]) if len(sys.argv) > 1 else SERVICE_PORT))
+    except KeyboardInterrupt:
+        pass
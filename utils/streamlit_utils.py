@@ -1,50 +1,93 @@
 
 class StLink:
-    def __init__(self, SAS_obj):
+    """
+    Elements of the lineage graph for the st-link-analysis component (Cytoscape.js):
+        {"nodes": [{"data": {"id", "label", "name"}}, ...], "edges": [{"data": {"id", "label", "source", "target"}}, ...]}
+
+    Node ids are interned: every dataset name gets an int id the first time it's seen (in sorted order for the first
+    graph), and keeps it for the life of the object, also after it's removed and added back. Edge ids are derived from
+    node ids, so the same graph always gets the same ids. Element dicts are built once per node/edge and
+    `st_link_data` is assembled only after the graph changed, `update` changes only the difference to the new graph.
+
+    Usage:
+    >>> st_link = StLink(struct_SAS).prepare_data()
+    >>> st_link_analysis(st_link.st_link_data, ...)
+    >>> delta = st_link.update(pruned_nodes, pruned_edges)
+    """
+    NODE_LABEL = "VARIABLE"
+    EDGE_LABEL = "graph_edge"
+
+    def __init__(self, SAS_obj=None):
         self.SAS_obj = SAS_obj
         self.st_link_data = None
+        self.ids = {}  # name -> interned id
+        self.version = 0
+        self._node_elements = {}  # name -> element
+        self._edge_elements = {}  # (source name, target name) -> element
+
+    def intern(self, name):
+        node_id = self.ids.get(name)
+        if node_id is None:
+            node_id = self.ids[name] = len(self.ids) + 1
+        return node_id
+
+    def _node_element(self, name):
+        return {"data": {"id": self.intern(name), "label": self.NODE_LABEL, "name": name}}
+
+    def _edge_element(self, src, tgt):
+        source, target = self.intern(src), self.intern(tgt)
+        return {"data": {"id": f"{source}-{target}", "label": self.EDGE_LABEL, "source": source, "target": target}}
 
     def prepare_data(self):
-        def struct_nodes():
-            nodes_struct=[
-                {"data": {"id": index + 1, "label": "VARIABLE", "name": node}}
-                for index, node in enumerate(self.SAS_obj.nodes)
-            ]
-            return nodes_struct
-
-        def struct_edges(nodes_structured):
-            """
-            Given a list of edges (tuples) and a list of node dictionaries of the form:
-                {"data": {"id": <int>, "label": <str>, "name": <str>}}
-            This function returns a list of edge dictionaries:
-                {"data": {"id": <edge_index + 1>,
-                          "label": None,
-                          "source": <node_id_of_first_in_tuple>,
-                          "target": <node_id_of_second_in_tuple>}}
-            """
-            # Create a map from node name -> node id for quick lookup
-            node_map = {d["data"]["name"]: d["data"]["id"] for d in nodes_structured}
-
-            # Build each edge dict using list comprehension
-            edges_structured = [
-                {
-                    "data": {
-                        "id": i + 1,
-                        "label": "graph_edge",
-                        "source": node_map[src],
-                        "target": node_map[tgt],
-                    }
-                }
-                for i, (src, tgt) in enumerate(self.SAS_obj.edges)
-            ]
-            return edges_structured
-
-        nodes_struct=struct_nodes()
-        edges_struct=struct_edges(nodes_struct)
-
-        self.st_link_data={
-            "nodes":nodes_struct,
-            "edges":edges_struct
-        }
+        """
+        Builds st_link_data from SAS_obj nodes and edges. Does nothing if it's already built.
+        :return: self (values for st_link_data)
+        """
+        if self.st_link_data is None:
+            self.update(self.SAS_obj.nodes, self.SAS_obj.edges)
         return self
 
+    def update(self, nodes, edges):
+        """
+        Makes the elements match a new graph, creating elements only for new nodes and edges.
+        :param nodes: list of node names
+        :param edges: list of (source, target), duplicates are ignored
+        :return: delta dict: {"added_nodes": [elements], "removed_nodes": [ids],
+                              "added_edges": [elements], "removed_edges": [ids]}
+        """
+        nodes = set(nodes)
+        edges = set(edges)
+        for u, v in edges:
+            nodes.add(u)
+            nodes.add(v)
+
+        removed_nodes = self._node_elements.keys() - nodes
+        removed_edges = self._edge_elements.keys() - edges
+        # First build: interned in sorted order, so ids don't depend on set iteration order
+        added_nodes = sorted(nodes - self._node_elements.keys())
+        added_edges = sorted(edges - self._edge_elements.keys())
+
+        delta = {
+            "added_nodes": [],
+            "removed_nodes": [self.ids[name] for name in removed_nodes],
+            "added_edges": [],
+            "removed_edges": [self._edge_elements[edge]["data"]["id"] for edge in removed_edges],
+        }
+        for name in removed_nodes:
+            del self._node_elements[name]
+        for edge in removed_edges:
+            del self._edge_elements[edge]
+        for name in added_nodes:
+            element = self._node_elements[name] = self._node_element(name)
+            delta["added_nodes"].append(element)
+        for src, tgt in added_edges:
+            element = self._edge_elements[(src, tgt)] = self._edge_element(src, tgt)
+            delta["added_edges"].append(element)
+
+        if any(delta.values()) or self.st_link_data is None:
+            self.version += 1
+            self.st_link_data = {
+                "nodes": sorted(self._node_elements.values(), key=lambda e: e["data"]["id"]),
+                "edges": list(self._edge_elements.values()),
+            }
+        return delta
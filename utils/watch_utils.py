@@ -0,0 +1,318 @@
+import os
+import sys
+import time
+import fnmatch
+import threading
+from collections import Counter
+
+from watchdog.observers import Observer
+from watchdog.events import (FileSystemEventHandler, FileCreatedEvent, FileModifiedEvent, FileDeletedEvent,
+                             FileMovedEvent, FileClosedEvent)
+
+from utils.include_utils import IncludeResolver
+
+# Files of the watched directory treated as SAS programs
+WATCH_PATTERNS = ("*.sas", "*.txt")
+
+# Seconds without new file events before a burst of saves is processed
+DEBOUNCE_SECONDS = float(os.environ.get("SAS2PY_WATCH_DEBOUNCE", 0.5))
+
+# File events that can change a program. Opened and closed-without-write events are left out: the watcher reads every
+# file it parses, so reacting to them would make each refresh trigger the next one
+CHANGE_EVENTS = (FileCreatedEvent, FileModifiedEvent, FileDeletedEvent, FileMovedEvent, FileClosedEvent)
+
+
+class MergedLineage:
+    """
+    Lineage graph merged from many programs, patched file by file.
+
+    Every file contributes a set of nodes and edges. The merged graph counts how many files contribute each
+    node/edge, so replacing or removing one file touches only that file's nodes and edges. The adjacency
+    (`successors`/`predecessors`) is patched in place with them, and `reachable` searches it directly: a file event
+    costs the size of the file's lineage, a query the size of what it reaches, never the whole merged graph.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.file_nodes = {}
+        self.file_edges = {}
+        self.node_counts = Counter()
+        self.edge_counts = Counter()
+        self.successors = {}  # node -> set of nodes, edges of the merged graph
+        self.predecessors = {}
+        self.version = 0
+        self._graph = None
+        self._graph_version = None
+
+    def update_file(self, path, nodes, edges):
+        nodes, edges = set(nodes), set(edges)
+        with self._lock:
+            old_nodes = self.file_nodes.get(path, set())
+            old_edges = self.file_edges.get(path, set())
+            if nodes == old_nodes and edges == old_edges:
+                return False
+            self._patch(old_nodes - nodes, old_edges - edges, nodes - old_nodes, edges - old_edges)
+            self.file_nodes[path] = nodes
+            self.file_edges[path] = edges
+            return True
+
+    def remove_file(self, path):
+        with self._lock:
+            if path not in self.file_nodes:
+                return False
+            self._patch(self.file_nodes.pop(path), self.file_edges.pop(path), (), ())
+            return True
+
+    def _patch(self, removed_nodes, removed_edges, added_nodes, added_edges):
+        for item in removed_nodes:
+            self.node_counts[item] -= 1
+            if self.node_counts[item] <= 0:
+                del self.node_counts[item]
+        for item in added_nodes:
+            self.node_counts[item] += 1
+        # An edge enters or leaves the adjacency when the first file adds it or the last file removes it
+        for u, v in removed_edges:
+            self.edge_counts[(u, v)] -= 1
+            if self.edge_counts[(u, v)] <= 0:
+                del self.edge_counts[(u, v)]
+                self._unlink(self.successors, u, v)
+                self._unlink(self.predecessors, v, u)
+        for u, v in added_edges:
+            self.edge_counts[(u, v)] += 1
+            if self.edge_counts[(u, v)] == 1:
+                self.successors.setdefault(u, set()).add(v)
+                self.predecessors.setdefault(v, set()).add(u)
+        self.version += 1
+
+    @staticmethod
+    def _unlink(adjacency, u, v):
+        neighbours = adjacency[u]
+        neighbours.discard(v)
+        if not neighbours:
+            del adjacency[u]
+
+    @property
+    def nodes(self):
+        with self._lock:
+            return list(self.node_counts)
+
+    @property
+    def edges(self):
+        with self._lock:
+            return list(self.edge_counts)
+
+    def hop_distances(self, start_nodes, direction="downstream", max_hops=None):
+        """
+        Breadth-first search over the patched adjacency, see utils.graph_utils.LineageGraph.hop_distances.
+        :return: dict node -> hops from the nearest start node, for the reached nodes (start nodes included)
+        """
+        if direction == "downstream":
+            adjacency = self.successors
+        elif direction == "upstream":
+            adjacency = self.predecessors
+        else:
+            raise ValueError(f"direction must be 'downstream' or 'upstream', not {direction!r}")
+        with self._lock:
+            distances = {node: 0 for node in start_nodes if node in self.node_counts}
+            frontier = list(distances)
+            hops = 0
+            while frontier and (max_hops is None or hops < max_hops):
+                hops += 1
+                next_frontier = []
+                for node in frontier:
+                    for neighbour in adjacency.get(node, ()):
+                        if neighbour not in distances:
+                            distances[neighbour] = hops
+                            next_frontier.append(neighbour)
+                frontier = next_frontier
+            return distances
+
+    def reachable(self, start_nodes, direction="downstream", max_hops=None):
+        """
+        :return: list of node names reachable from start_nodes (start nodes included)
+        """
+        return list(self.hop_distances(start_nodes, direction, max_hops))
+
+    def get_lineage_graph(self):
+        """
+        utils.graph_utils.LineageGraph of the current merged graph, for the array algorithms (hotspots, layers...).
+        Built from the whole graph when called after it changed, so use `reachable` for lineage queries.
+        """
+        from utils.graph_utils import LineageGraph
+        with self._lock:
+            if self._graph is None or self._graph_version != self.version:
+                self._graph = LineageGraph(list(self.node_counts), list(self.edge_counts))
+                self._graph_version = self.version
+            return self._graph
+
+    def files_with(self, dataset):
+        """
+        :return: sorted list of files whose lineage contains dataset
+        """
+        with self._lock:
+            return sorted(path for path, nodes in self.file_nodes.items() if dataset in nodes)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "files": len(self.file_nodes),
+                "nodes": len(self.node_counts),
+                "edges": len(self.edge_counts),
+                "version": self.version,
+            }
+
+
+class _ChangeHandler(FileSystemEventHandler):
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        # Observers without event_filter support still deliver every event type
+        if event.is_directory or not isinstance(event, CHANGE_EVENTS):
+            return
+        for path in (event.src_path, getattr(event, "dest_path", "")):
+            if path:
+                self.watcher.notify(path)
+
+
+class LineageWatcher:
+    """
+    Keeps a MergedLineage of every SAS program in a directory fresh.
+
+    File events are collected and processed after DEBOUNCE_SECONDS without new events, so an editor's burst of
+    saves means one re-parse. Only changed files, and files that %include them, are parsed again; unchanged
+    includes come from the IncludeResolver cache.
+
+    Usage:
+    >>> watcher = LineageWatcher("sas_code/").start()
+    >>> watcher.lineage.reachable(["my_table"], "upstream")
+    >>> watcher.stop()
+    """
+    def __init__(self, directory, patterns=WATCH_PATTERNS, debounce=DEBOUNCE_SECONDS, search_path=None):
+        self.directory = os.path.abspath(directory)
+        self.patterns = patterns
+        self.debounce = debounce
+        self.resolver = IncludeResolver(search_path=search_path)
+        self.lineage = MergedLineage()
+        self.errors = {}  # path -> last parse error
+        self._pending = set()
+        self._last_event = 0.0
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._observer = None
+        self._worker = None
+
+    def is_program(self, path):
+        name = os.path.basename(path)
+        return any(fnmatch.fnmatch(name, pattern) for pattern in self.patterns)
+
+    def notify(self, path):
+        path = os.path.abspath(path)
+        if not self.is_program(path):
+            return
+        with self._cond:
+            self._pending.add(path)
+            self._last_event = time.monotonic()
+            self._cond.notify()
+
+    def refresh(self, paths):
+        """
+        Re-parses paths and the files including them, and patches the merged lineage.
+        :return: number of files whose lineage changed
+        """
+        affected = set(paths)
+        for path in paths:
+            affected |= self.resolver.dependents(path)
+            # A new file may be what another file's unresolved %include was looking for
+            name = os.path.basename(path)
+            for including, missing in list(self.resolver.unresolved.items()):
+                if any(os.path.basename(include) == name for include in missing):
+                    self.resolver.invalidate(including)
+                    affected.add(including)
+
+        changed = 0
+        for path in sorted(affected):
+            if not os.path.isfile(path):
+                self.resolver.invalidate(path)
+                changed += self.lineage.remove_file(path)
+                self.errors.pop(path, None)
+                continue
+            try:
+                struct_SAS = self.resolver.parse_program(path)
+            except Exception as e:  # A broken file must not stop the daemon
+                self.errors[path] = repr(e)
+                continue
+            self.errors.pop(path, None)
+            changed += self.lineage.update_file(path, struct_SAS.nodes, struct_SAS.edges)
+        return changed
+
+    def scan(self):
+        """
+        Initial full parse of the directory.
+        """
+        paths = []
+        for root, _, files in os.walk(self.directory):
+            paths.extend(os.path.join(root, f) for f in files if self.is_program(f))
+        self.refresh(paths)
+        return self
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped and not self._pending:
+                    self._cond.wait()
+                # Debounce: wait until events stop coming
+                while not self._stopped and time.monotonic() - self._last_event < self.debounce:
+                    self._cond.wait(self.debounce - (time.monotonic() - self._last_event))
+                if self._stopped:
+                    return
+                paths, self._pending = self._pending, set()
+            self.refresh(paths)
+
+    def start(self):
+        self.scan()
+        self._observer = Observer()
+        self._observer.schedule(_ChangeHandler(self), self.directory, recursive=True, event_filter=list(CHANGE_EVENTS))
+        self._observer.start()
+        self._worker = threading.Thread(target=self._run, name="sas-lineage-watch", daemon=True)
+        self._worker.start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+        if self._worker is not None:
+            self._worker.join()
+
+
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+
+def get_watcher(directory):
+    """
+    :return: LineageWatcher of directory shared by the whole process (e.g. all Streamlit sessions), started on first use
+    """
+    directory = os.path.abspath(directory)
+    with _watchers_lock:
+        if directory not in _watchers:
+            _watchers[directory] = LineageWatcher(directory).start()
+        return _watchers[directory]
+
+
+if __name__ == '__main__':
+    # Usage: python -m utils.watch_utils sas_code_dir [include_dir ...]
+    watcher = LineageWatcher(sys.argv[1], search_path=sys.argv[2:] or None).start()
+    print(f"Watching {watcher.directory}: {watcher.lineage.stats()}")
+    last_version = watcher.lineage.version
+    try:
+        while True:
+            time.sleep(1)
+            if watcher.lineage.version != last_version:
+                last_version = watcher.lineage.version
+                print(f"Lineage updated: {watcher.lineage.stats()}, parse errors: {len(watcher.errors)}")
+    except KeyboardInterrupt:
+        watcher.stop()
@@ -0,0 +1,235 @@
+import os
+import mmap
+import time
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from utils.parse_utils import StructuredSAS, ParseProgress, ParseCancelled, ParseBudget
+from utils.cache_utils import get_parse_store, script_key
+from utils.metrics_utils import get_metrics
+
+# One process pool per process, shared by every Streamlit session. Parsing is pure Python and holds the GIL, so
+# parses only run in parallel in separate processes: with threads, a large upload would slow down every other parse
+# and the app itself.
+PARSE_WORKERS = int(os.environ.get("SAS2PY_PARSE_WORKERS", os.cpu_count() or 1))
+
+_executor = None
+_in_flight = {}  # script key -> _SharedParse, one per script being parsed
+_lock = threading.Lock()
+
+
+def get_parse_executor():
+    """
+    :return: the process pool for parses, started on first use
+    """
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=PARSE_WORKERS)
+    return _executor
+
+
+class SharedParseProgress(ParseProgress):
+    """
+    ParseProgress of a parse running in a worker process. Counters, stage and the cancel flag are slots of a small
+    memory-mapped file that both processes map: the parser updates them for every run without sending anything to
+    this process, and sees a cancel at its next run.
+
+    The object is pickled as the path of the file. The process that created it removes the file with `close()`,
+    after which the last values can still be read.
+    """
+    STAGES = ("queued", "parsing", "building graph", "done")
+    _SECTIONS_TOTAL, _SECTIONS_DONE, _RUNS_DONE, _STAGE, _CANCELLED = range(5)
+
+    def __init__(self):
+        fd, self.path = tempfile.mkstemp(prefix="sas2py-progress-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(bytes(8 * 5))
+        self._owner = True
+        self._open()
+
+    def _open(self):
+        self._lock = threading.Lock()
+        with open(self.path, "r+b") as f:
+            self._map = mmap.mmap(f.fileno(), 0)
+        self._slots = memoryview(self._map).cast("q")
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self._owner = False
+        self._open()
+
+    def close(self):
+        """
+        Unmaps the file, keeping a copy of the last values, and removes it if this process created it.
+        """
+        with self._lock:
+            if self._map is None:
+                return
+            slots, self._slots = self._slots, list(self._slots)
+            slots.release()
+            self._map.close()
+            self._map = None
+        if self._owner:
+            os.remove(self.path)
+
+    # The parsing process is the only writer of the counters, so they are updated without the lock
+    def set_stage(self, stage):
+        self._slots[self._STAGE] = self.STAGES.index(stage)
+
+    def start_sections(self, sections_total):
+        self._slots[self._SECTIONS_TOTAL] = sections_total
+        self._slots[self._SECTIONS_DONE] = 0
+        self._slots[self._RUNS_DONE] = 0
+
+    def advance(self, sections=0, runs=0):
+        if sections:
+            self._slots[self._SECTIONS_DONE] += sections
+        if runs:
+            self._slots[self._RUNS_DONE] += runs
+
+    def cancel(self):
+        with self._lock:
+            if self._map is not None:
+                self._slots[self._CANCELLED] = 1
+
+    @property
+    def cancelled(self):
+        return bool(self._slots[self._CANCELLED])
+
+    def check_cancelled(self):
+        if self._slots[self._CANCELLED]:
+            raise ParseCancelled()
+
+    @property
+    def fraction(self):
+        with self._lock:
+            total, done = self._slots[self._SECTIONS_TOTAL], self._slots[self._SECTIONS_DONE]
+        return min(done / total, 1.0) if total else 0.0
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "stage": self.STAGES[self._slots[self._STAGE]],
+                "sections_total": self._slots[self._SECTIONS_TOTAL],
+                "sections_done": self._slots[self._SECTIONS_DONE],
+                "runs_done": self._slots[self._RUNS_DONE],
+            }
+
+
+def _parse_in_worker(sas_script, progress):
+    # Runs in a worker process, the parsed object is pickled back with the time parsing took there
+    try:
+        start = time.perf_counter()
+        # Uploads are untrusted: oversized or slow run blocks fall back to the heuristic parse
+        struct_SAS = StructuredSAS(sas_script, progress=progress, budget=ParseBudget()).execute_all_processing_steps()
+        struct_SAS.progress = None
+        return struct_SAS, time.perf_counter() - start
+    finally:
+        progress.close()
+
+
+class _SharedParse:
+    """
+    One parse in the pool, shared by the ParseJobs of every session that submitted the same script.
+    """
+    def __init__(self, key):
+        self.key = key
+        self.progress = SharedParseProgress()
+        self.jobs = 0  # ParseJobs not cancelled, see ParseJob.cancel
+        self.future = None
+        self.result = None
+        self.error = None
+        self.finished = threading.Event()  # Set once the result is in the store, or the parse failed
+
+    def start(self, sas_script):
+        self.future = get_parse_executor().submit(_parse_in_worker, sas_script, self.progress)
+        self.future.add_done_callback(self._finish)
+
+    def _finish(self, future):
+        # Called in the pool's management thread, so storing (and sizing) the result doesn't block a session
+        try:
+            if future.cancelled():
+                raise ParseCancelled()
+            struct_SAS, seconds = future.result()
+            struct_SAS.record_metrics(seconds)  # Metrics recorded in the worker stay there
+            self.result = get_parse_store().put(self.key, struct_SAS)
+        except BaseException as e:
+            self.error = e
+            if not isinstance(e, ParseCancelled):
+                get_metrics().inc("failures_total", metric="parse_seconds", error=type(e).__name__)
+        finally:
+            with _lock:
+                if _in_flight.get(self.key) is self:
+                    del _in_flight[self.key]
+            self.progress.close()
+            self.finished.set()
+
+
+class ParseJob:
+    """
+    Background parse of a single SAS script, in the process pool.
+    Concurrent jobs of the same script (e.g. the same file uploaded in two sessions) share one parse, its progress
+    and result; the parse is cancelled once every job sharing it was cancelled.
+    The result is put into the shared parse store under `key`.
+    """
+    def __init__(self, sas_script, key=None):
+        self.key = key if key is not None else script_key(sas_script)
+        self._cancelled = False
+        with _lock:
+            parse = _in_flight.get(self.key)
+            new = parse is None
+            if new:
+                parse = _in_flight[self.key] = _SharedParse(self.key)
+            parse.jobs += 1
+        self._parse = parse
+        if new:
+            parse.start(sas_script)
+
+    @property
+    def progress(self):
+        return self._parse.progress
+
+    def cancel(self):
+        parse = self._parse
+        with _lock:
+            if self._cancelled:
+                return
+            self._cancelled = True
+            parse.jobs -= 1
+            if parse.jobs or parse.finished.is_set():
+                return  # Other sessions still wait for it, or there's nothing left to cancel
+            # A new upload of the script starts a new parse
+            if _in_flight.get(self.key) is parse:
+                del _in_flight[self.key]
+        parse.progress.cancel()
+        parse.future.cancel()  # Succeeds only if the parse hasn't started yet
+
+    @property
+    def done(self):
+        return self._cancelled or self._parse.finished.is_set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled or (self._parse.finished.is_set() and isinstance(self._parse.error, ParseCancelled))
+
+    @property
+    def error(self):
+        """
+        :return: exception raised by the parse, None if it is still running, succeeded or was cancelled
+        """
+        if not self.done or self.cancelled:
+            return None
+        return self._parse.error
+
+    def result(self):
+        """
+        :return: StructuredSAS if the parse succeeded, otherwise None
+        """
+        if not self.done or self.cancelled:
+            return None
+        return self._parse.result